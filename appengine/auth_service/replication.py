@@ -30,6 +30,16 @@ PUSH_STATUS_SUCCESS = 0
 PUSH_STATUS_TRANSIENT_ERROR = 1
 PUSH_STATUS_FATAL_ERROR = 2
 
+# Replicas that are at most this many revisions behind get only the changes
+# made since their revision instead of an entire AuthDB.
+MAX_DELTA_REVISIONS = 50
+
+# Replicas that run older versions of 'auth' component can't apply deltas.
+MIN_DELTA_AUTH_CODE_VERSION = (1, 2, 13)
+
+# Replicas that run older versions of 'auth' component can't inflate pushes.
+MIN_COMPRESSION_AUTH_CODE_VERSION = (1, 2, 14)
+
 
 class ReplicationTriggerError(Exception):
   """Failed to trigger a replication task."""
@@ -47,6 +57,10 @@ class FatalReplicaUpdateError(ReplicaUpdateError):
   """Failed to update a replica, update must not be retried."""
 
 
+class BadBaseRevisionError(TransientReplicaUpdateError):
+  """Replica can't apply a delta, it should get an entire AuthDB instead."""
+
+
 class AuthReplicaState(ndb.Model, datastore_utils.SerializableModelMixin):
   """Last known state of a Replica as known by Primary.
 
@@ -230,7 +244,8 @@ def update_replicas_task(auth_db_rev):
 
   # Pack an entire AuthDB into a blob to be to stored in the datastore and
   # pushed to Replicas.
-  replication_state, auth_db_blob = pack_auth_db()
+  replication_state, snapshot = replication.new_auth_db_snapshot()
+  auth_db_blob = pack_auth_db_snapshot(replication_state, snapshot)
 
   # Put the blob into datastore. Also updates pointer to the latest stored blob.
   store_auth_db_snapshot(replication_state, auth_db_blob)
@@ -247,16 +262,41 @@ def update_replicas_task(auth_db_rev):
     logging.info('All replicas are up-to-date.')
     return True
 
-  # Sign the blob, replicas check the signature.
-  key_name, sig = sign_auth_db_blob(auth_db_blob)
+  # Replicas that are only a bit behind get only the changes since their
+  # revision. Replicas at the same revision share the same delta.
+  delta_blobs = {}
+  for replica in stale_replicas:
+    base_rev = replica.auth_db_rev
+    if base_rev not in delta_blobs and can_push_delta(replica, auth_db_rev):
+      delta_blob = pack_auth_db_delta(replication_state, snapshot, base_rev)
+      if len(delta_blob) < len(auth_db_blob):
+        delta_blobs[base_rev] = delta_blob
+      else:
+        delta_blobs[base_rev] = None
+
+  # Compress (if replica supports it) and sign the blobs, replicas check the
+  # signature. Each variant of a blob is prepared only once.
+  prepared = {}
+  def prepare(blob_id, blob, compression):
+    if (blob_id, compression) not in prepared:
+      prepared[blob_id, compression] = prepare_push(blob, compression)
+    return prepared[blob_id, compression]
 
-  # Push the blob to all out-of-date replicas, in parallel.
+  # Push the blobs to all out-of-date replicas, in parallel.
   push_started_ts = utils.utcnow()
-  futures = {
-    push_to_replica(
-        replica.replica_url, auth_db_blob, key_name, sig): replica
-    for replica in stale_replicas
-  }
+  futures = {}
+  for replica in stale_replicas:
+    compression = None
+    if is_auth_code_version_at_least(
+        replica, MIN_COMPRESSION_AUTH_CODE_VERSION):
+      compression = replication.PUSH_COMPRESSION_DEFLATE
+    delta_push = None
+    delta_blob = delta_blobs.get(replica.auth_db_rev)
+    if delta_blob:
+      delta_push = prepare(replica.auth_db_rev, delta_blob, compression)
+    full_push = prepare('full', auth_db_blob, compression)
+    future = push_update_to_replica(replica.replica_url, delta_push, full_push)
+    futures[future] = replica
 
   # Wait for all attempts to complete.
   retry = []
@@ -324,26 +364,142 @@ def update_replicas_task(auth_db_rev):
   return not retry
 
 
-def pack_auth_db():
-  """Packs an entire AuthDB into a blob (serialized protobuf message).
+def pack_auth_db_snapshot(state, snapshot):
+  """Packs AuthDBSnapshot into a blob (serialized ReplicationPushRequest).
+
+  Args:
+    state: AuthReplicationState that corresponds to |snapshot|.
+    snapshot: replication.AuthDBSnapshot with an entire AuthDB.
+
+  Returns:
+    Serialized ReplicationPushRequest with auth_db field set.
+  """
+  req = _new_push_request(state)
+  replication.auth_db_snapshot_to_proto(snapshot, req.auth_db)
+  auth_db_blob = req.SerializeToString()
+  logging.debug('AuthDB blob size is %d bytes', len(auth_db_blob))
+  return auth_db_blob
+
+
+def pack_auth_db_delta(state, snapshot, base_auth_db_rev):
+  """Packs changes made since |base_auth_db_rev| into a blob.
+
+  Names of changed groups and IP whitelists are discovered through the
+  historical log (see model.historical_revision_key), their current values are
+  taken from |snapshot|. Entities missing from |snapshot| were deleted.
+
+  Args:
+    state: AuthReplicationState that corresponds to |snapshot|.
+    snapshot: replication.AuthDBSnapshot with an entire AuthDB.
+    base_auth_db_rev: revision to calculate the delta against.
+
+  Returns:
+    Serialized ReplicationPushRequest with auth_db_delta field set.
+  """
+  groups, ip_whitelists = get_changed_entity_names(
+      base_auth_db_rev, state.auth_db_rev)
+  changed = replication.AuthDBSnapshot(
+      global_config=snapshot.global_config,
+      groups=[e for e in snapshot.groups if e.key.id() in groups],
+      secrets=snapshot.secrets,
+      ip_whitelists=[
+        e for e in snapshot.ip_whitelists if e.key.id() in ip_whitelists
+      ],
+      ip_whitelist_assignments=snapshot.ip_whitelist_assignments)
+
+  req = _new_push_request(state)
+  delta = req.auth_db_delta
+  delta.base_auth_db_rev = base_auth_db_rev
+  replication.auth_db_snapshot_to_proto(changed, delta.changed)
+  delta.deleted_groups.extend(
+      sorted(groups - set(e.key.id() for e in snapshot.groups)))
+  delta.deleted_ip_whitelists.extend(
+      sorted(ip_whitelists - set(e.key.id() for e in snapshot.ip_whitelists)))
+  delta_blob = req.SerializeToString()
+
+  logging.debug(
+      'AuthDB delta since rev %d: %d groups, %d IP whitelists, %d bytes',
+      base_auth_db_rev, len(groups), len(ip_whitelists), len(delta_blob))
+  return delta_blob
+
+
+def get_changed_entity_names(base_auth_db_rev, auth_db_rev):
+  """Returns names of groups and IP whitelists touched after base revision.
+
+  Looks at the historical log of revisions (base_auth_db_rev, auth_db_rev].
 
   Returns:
-    Tuple (AuthReplicationState, blob).
+    Tuple (set of group names, set of IP whitelist names).
+  """
+  # Use kindless keys only queries, since *History classes are generated
+  # dynamically (see change_log.generate_changes).
+  futures = [
+    ndb.Query(ancestor=model.historical_revision_key(rev)).fetch_async(
+        keys_only=True)
+    for rev in xrange(base_auth_db_rev + 1, auth_db_rev + 1)
+  ]
+  groups = set()
+  ip_whitelists = set()
+  for future in futures:
+    for key in future.get_result():
+      if key.kind() == 'AuthGroupHistory':
+        groups.add(key.id())
+      elif key.kind() == 'AuthIPWhitelistHistory':
+        ip_whitelists.add(key.id())
+  return groups, ip_whitelists
+
+
+def can_push_delta(replica, auth_db_rev):
+  """True if |replica| can be updated to |auth_db_rev| with a delta."""
+  if not replica.auth_db_rev:
+    return False
+  if auth_db_rev - replica.auth_db_rev > MAX_DELTA_REVISIONS:
+    return False
+  return is_auth_code_version_at_least(replica, MIN_DELTA_AUTH_CODE_VERSION)
+
+
+def is_auth_code_version_at_least(replica, min_version):
+  """True if |replica| reported auth component version >= |min_version|.
+
+  Args:
+    replica: AuthReplicaState entity.
+    min_version: tuple of integers, e.g. (1, 2, 13).
   """
-  # Grab the snapshot.
-  state, snapshot = replication.new_auth_db_snapshot()
+  try:
+    replica_version = tuple(
+        int(x) for x in (replica.auth_code_version or '').split('.'))
+  except ValueError:
+    return False
+  return replica_version >= min_version
+
 
-  # Serialize to binary proto message.
+def _new_push_request(state):
+  """Returns ReplicationPushRequest with revision for |state| filled in."""
   req = replication_pb2.ReplicationPushRequest()
   req.revision.primary_id = app_identity.get_application_id()
   req.revision.auth_db_rev = state.auth_db_rev
   req.revision.modified_ts = utils.datetime_to_timestamp(state.modified_ts)
-  replication.auth_db_snapshot_to_proto(snapshot, req.auth_db)
   req.auth_code_version = version.__version__
-  auth_db_blob = req.SerializeToString()
+  return req
 
-  logging.debug('AuthDB blob size is %d bytes', len(auth_db_blob))
-  return state, auth_db_blob
+
+def prepare_push(blob, compression):
+  """Compresses and signs a serialized ReplicationPushRequest.
+
+  Args:
+    blob: serialized ReplicationPushRequest.
+    compression: None or replication.PUSH_COMPRESSION_DEFLATE.
+
+  Returns:
+    Tuple (body, key_name, sig, compression) to pass to push_to_replica.
+  """
+  body = replication.compress_push_body(blob, compression)
+  if compression:
+    logging.debug(
+        'Push body compressed with %s: %d -> %d bytes',
+        compression, len(blob), len(body))
+  key_name, sig = sign_auth_db_blob(body)
+  return body, key_name, sig, compression
 
 
 def sign_auth_db_blob(auth_db_blob):
@@ -397,7 +553,32 @@ def store_auth_db_snapshot(replication_state, auth_db_blob):
 
 
 @ndb.tasklet
-def push_to_replica(replica_url, auth_db_blob, key_name, sig):
+def push_update_to_replica(replica_url, delta_push, full_push):
+  """Pushes a delta to a replica, falling back to an entire AuthDB.
+
+  Args:
+    replica_url: root URL of a replica (i.e. https://<host>).
+    delta_push: tuple returned by prepare_push for the delta, or None to push
+        an entire AuthDB right away.
+    full_push: tuple returned by prepare_push for an entire AuthDB.
+
+  Returns:
+    Same as push_to_replica.
+  """
+  if delta_push:
+    try:
+      result = yield push_to_replica(replica_url, *delta_push)
+      raise ndb.Return(result)
+    except BadBaseRevisionError:
+      logging.warning(
+          'Replica %s rejected the delta, pushing an entire AuthDB',
+          replica_url)
+  result = yield push_to_replica(replica_url, *full_push)
+  raise ndb.Return(result)
+
+
+@ndb.tasklet
+def push_to_replica(replica_url, auth_db_blob, key_name, sig, compression=None):
   """Pushes |auth_db_blob| to a replica via URLFetch POST.
 
   Args:
@@ -405,6 +586,7 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
     auth_db_blob: binary blob with serialized Auth DB.
     key_name: name of a RSA key used to generate a signature.
     sig: base64 encoded signature of |auth_db_blob|.
+    compression: how |auth_db_blob| is compressed, if at all.
 
   Returns:
     Tuple:
@@ -427,6 +609,8 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
     'X-AuthDB-SigKey-v1': key_name,
     'X-AuthDB-SigVal-v1': sig,
   }
+  if compression:
+    headers['X-AuthDB-Compression-v1'] = compression
 
   # On dev appserver emulate X-Appengine-Inbound-Appid header.
   if utils.is_local_dev_server():
@@ -457,6 +641,9 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
     raise FatalReplicaUpdateError('Incomplete response, status is missing')
 
   # Convert errors to exceptions.
+  if (response.status == cls.TRANSIENT_ERROR and
+      response.error_code == cls.BAD_BASE_REVISION):
+    raise BadBaseRevisionError('Replica is not at the base revision.')
   if response.status == cls.TRANSIENT_ERROR:
     raise TransientReplicaUpdateError(
         'Transient error (error code %d).' % response.error_code)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import base64
+import datetime
+import hashlib
+import sys
+import unittest
+import zlib
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from components import utils
+from components.auth import model
+from components.auth import replication as auth_replication
+from components.auth.proto import replication_pb2
+from test_support import test_case
+
+import replication
+
+
+REPLICATION_PATH = '/auth/api/v1/internal/replication'
+
+
+def ident(name):
+  return model.Identity(model.IDENTITY_USER, '%s@example.com' % name)
+
+
+def put_group(name, **kwargs):
+  """Returns a callback that creates or updates a group."""
+  def callback():
+    group = model.group_key(name).get() or model.AuthGroup(
+        key=model.group_key(name),
+        created_ts=utils.utcnow(),
+        created_by=ident('admin'))
+    group.populate(**kwargs)
+    group.record_revision(modified_by=ident('admin'))
+    group.put()
+  return callback
+
+
+def put_ip_whitelist(name, subnets):
+  """Returns a callback that creates or updates an IP whitelist."""
+  def callback():
+    ip_whitelist = model.ip_whitelist_key(name).get() or model.AuthIPWhitelist(
+        key=model.ip_whitelist_key(name),
+        created_ts=utils.utcnow(),
+        created_by=ident('admin'))
+    ip_whitelist.subnets = subnets
+    ip_whitelist.record_revision(modified_by=ident('admin'))
+    ip_whitelist.put()
+  return callback
+
+
+def assign_ip_whitelist(identity, ip_whitelist):
+  """Returns a callback that assigns an IP whitelist to an identity."""
+  def callback():
+    assignments = (
+        model.ip_whitelist_assignments_key().get() or
+        model.AuthIPWhitelistAssignments(
+            key=model.ip_whitelist_assignments_key()))
+    assignments.assignments.append(
+        model.AuthIPWhitelistAssignments.Assignment(
+            identity=identity,
+            ip_whitelist=ip_whitelist,
+            comment='',
+            created_ts=utils.utcnow(),
+            created_by=ident('admin')))
+    assignments.record_revision(modified_by=ident('admin'))
+    assignments.put()
+  return callback
+
+
+def delete_entity(key):
+  """Returns a callback that deletes a group or an IP whitelist."""
+  def callback():
+    key.get().record_deletion(modified_by=ident('admin'))
+    key.delete()
+  return callback
+
+
+def auth_db_transaction(*callbacks):
+  """Runs callbacks in one AuthDB transaction, returns the new revision."""
+  @ndb.transactional
+  def run():
+    for callback in callbacks:
+      callback()
+    return model.replicate_auth_db()
+  return run()
+
+
+class ReplicationTest(test_case.TestCase):
+  """Tests for pushing AuthDB and its deltas from Primary."""
+
+  def setUp(self):
+    super(ReplicationTest, self).setUp()
+    self.mock_now(datetime.datetime(2017, 1, 2, 3, 4, 5))
+    # Be a Primary, but don't enqueue replication tasks.
+    self.mock(model, '_replication_callback', lambda _: None)
+    # The "signature" is the signed digest itself, see check_signature.
+    self.mock(
+        replication.signature, 'sign_blob', lambda digest: ('key', digest))
+    self.mock(replication.pubsub, 'publish_authdb_change', lambda _: None)
+    # Push over https, as in prod.
+    self.mock(replication.utils, 'is_local_dev_server', lambda: False)
+    self.mock(replication.utils, 'get_urlfetch_service_id', lambda: 'APPSPOT')
+
+    # History: base revision, then a modified group, then a deleted group and
+    # a new one, then a deleted IP whitelist, a modified one and an assignment.
+    model.AuthSecret.bootstrap('secret', 'global')
+    self.base_rev = auth_db_transaction(
+        put_group('A', members=[ident('a')]),
+        put_group('B', members=[ident('b')]),
+        put_group(
+            'C',
+            members=[ident('c%d' % i) for i in xrange(20)],
+            nested=['A'],
+            description='Never changes'),
+        put_ip_whitelist('bots', ['1.2.3.4/32']),
+        put_ip_whitelist('old', ['5.6.7.8/32']))
+    self.base_blob = self.pack()
+    auth_db_transaction(put_group('A', members=[ident('a'), ident('d')]))
+    auth_db_transaction(
+        delete_entity(model.group_key('B')),
+        put_group('D', description='New'))
+    self.auth_db_rev = auth_db_transaction(
+        delete_entity(model.ip_whitelist_key('old')),
+        put_ip_whitelist('bots', ['1.2.3.0/24']),
+        assign_ip_whitelist(ident('bot'), 'bots'))
+
+  @staticmethod
+  def pack(base_auth_db_rev=None):
+    """Packs current AuthDB or its delta since |base_auth_db_rev|."""
+    state, snapshot = auth_replication.new_auth_db_snapshot()
+    if base_auth_db_rev is None:
+      return replication.pack_auth_db_snapshot(state, snapshot)
+    return replication.pack_auth_db_delta(state, snapshot, base_auth_db_rev)
+
+  def become_replica(self):
+    """Wipes AuthDB and switches to Replica mode of current Primary."""
+    ndb.delete_multi(ndb.Query(ancestor=model.root_key()).fetch(keys_only=True))
+    ndb.get_context().clear_cache()
+    self.mock(model, '_replication_callback', None)
+    model.AuthReplicationState(
+        key=model.replication_state_key(),
+        primary_id=app_identity.get_application_id(),
+        primary_url='https://primary',
+        auth_db_rev=0).put()
+    self.assertTrue(model.is_replica())
+
+  @staticmethod
+  def push(blob):
+    """Applies a blob made by pack() on Replica, returns True if applied."""
+    request = replication_pb2.ReplicationPushRequest.FromString(blob)
+    if request.HasField('auth_db_delta'):
+      applied, _ = auth_replication.push_auth_db_delta(
+          request.revision, request.auth_db_delta)
+    else:
+      applied, _ = auth_replication.push_auth_db(
+          request.revision, request.auth_db)
+    return applied
+
+  @staticmethod
+  def get_auth_db_proto():
+    """Returns current AuthDB as replication_pb2.AuthDB."""
+    _, snapshot = auth_replication.new_auth_db_snapshot()
+    return auth_replication.auth_db_snapshot_to_proto(snapshot)
+
+  def add_replica(self, name, auth_db_rev, auth_code_version):
+    replication.AuthReplicaState(
+        key=replication.replica_state_key(name),
+        replica_url='https://%s' % name,
+        auth_db_rev=auth_db_rev,
+        auth_code_version=auth_code_version).put()
+
+  def mock_urlfetch(self, bad_base_revision_replicas=()):
+    """Mocks replicas that apply all pushes.
+
+    Replicas in |bad_base_revision_replicas| reject deltas.
+
+    Returns:
+      List of (replica URL, 'full' or 'delta', body, headers) for each push.
+    """
+    pushes = []
+    @ndb.tasklet
+    def urlfetch(url, payload, headers, **_kwargs):
+      self.assertTrue(url.endswith(REPLICATION_PATH), url)
+      replica_url = url[:-len(REPLICATION_PATH)]
+      request = replication_pb2.ReplicationPushRequest.FromString(
+          auth_replication.decompress_push_body(
+              payload, headers.get('X-AuthDB-Compression-v1')))
+      is_delta = request.HasField('auth_db_delta')
+      pushes.append(
+          (replica_url, 'delta' if is_delta else 'full', payload, headers))
+
+      response = replication_pb2.ReplicationPushResponse()
+      if is_delta and replica_url in bad_base_revision_replicas:
+        response.status = response.TRANSIENT_ERROR
+        response.error_code = response.BAD_BASE_REVISION
+      else:
+        response.status = response.APPLIED
+        response.current_revision.CopyFrom(request.revision)
+      class ReturnValue(object):
+        status_code = 200
+        content = response.SerializeToString()
+      raise ndb.Return(ReturnValue())
+    self.mock(ndb.get_context(), 'urlfetch', urlfetch)
+    return pushes
+
+  def check_signature(self, body, headers):
+    """Asserts the push headers carry a signature of |body| as sent."""
+    self.assertEqual('key', headers['X-AuthDB-SigKey-v1'])
+    self.assertEqual(
+        base64.b64encode(hashlib.sha512(body).digest()),
+        headers['X-AuthDB-SigVal-v1'])
+
+  def test_get_changed_entity_names(self):
+    self.assertEqual(
+        ({'A', 'B', 'D'}, {'bots', 'old'}),
+        replication.get_changed_entity_names(self.base_rev, self.auth_db_rev))
+    self.assertEqual(
+        ({'A'}, set()),
+        replication.get_changed_entity_names(self.base_rev, self.base_rev + 1))
+
+  def test_delta_matches_full_push(self):
+    full_blob = self.pack()
+    delta_blob = self.pack(self.base_rev)
+    self.assertLess(len(delta_blob), len(full_blob))
+
+    request = replication_pb2.ReplicationPushRequest.FromString(delta_blob)
+    delta = request.auth_db_delta
+    self.assertEqual(self.auth_db_rev, request.revision.auth_db_rev)
+    self.assertEqual(self.base_rev, delta.base_auth_db_rev)
+    self.assertEqual(['A', 'D'], [g.name for g in delta.changed.groups])
+    self.assertEqual(['B'], list(delta.deleted_groups))
+    self.assertEqual(['bots'], [l.name for l in delta.changed.ip_whitelists])
+    self.assertEqual(['old'], list(delta.deleted_ip_whitelists))
+    self.assertEqual(1, len(delta.changed.ip_whitelist_assignments))
+    self.assertEqual(['secret'], [s.name for s in delta.changed.secrets])
+
+    # A replica that applies the delta on top of the base revision ends up with
+    # the same AuthDB as one that gets an entire AuthDB.
+    self.become_replica()
+    self.assertTrue(self.push(self.base_blob))
+    self.assertTrue(self.push(delta_blob))
+    self.assertEqual(self.auth_db_rev, model.get_auth_db_revision())
+    via_delta = self.get_auth_db_proto()
+
+    self.become_replica()
+    self.assertTrue(self.push(full_blob))
+    self.assertEqual(self.auth_db_rev, model.get_auth_db_revision())
+    self.assertEqual(self.get_auth_db_proto(), via_delta)
+    self.assertEqual(['A', 'C', 'D'], [g.name for g in via_delta.groups])
+    self.assertEqual(['bots'], [l.name for l in via_delta.ip_whitelists])
+
+  def test_delta_not_applied_on_other_revision(self):
+    delta_blob = self.pack(self.base_rev + 1)
+    self.become_replica()
+    self.assertTrue(self.push(self.base_blob))
+    self.assertFalse(self.push(delta_blob))
+    self.assertEqual(self.base_rev, model.get_auth_db_revision())
+
+  def test_can_push_delta(self):
+    rev = replication.MAX_DELTA_REVISIONS + 10
+    def can_push_delta(auth_db_rev, auth_code_version):
+      return replication.can_push_delta(
+          replication.AuthReplicaState(
+              auth_db_rev=auth_db_rev, auth_code_version=auth_code_version),
+          rev)
+    self.assertTrue(can_push_delta(10, '1.2.13'))
+    self.assertTrue(can_push_delta(rev - 1, '1.3.0'))
+    # Too far behind.
+    self.assertFalse(can_push_delta(9, '1.2.13'))
+    # Never got AuthDB.
+    self.assertFalse(can_push_delta(0, '1.2.13'))
+    # Can't apply deltas.
+    self.assertFalse(can_push_delta(10, '1.2.12'))
+    self.assertFalse(can_push_delta(10, None))
+    self.assertFalse(can_push_delta(10, 'unknown'))
+
+  def test_push_update_to_replica_bad_base_revision(self):
+    pushes = self.mock_urlfetch(bad_base_revision_replicas=['https://replica'])
+    delta_push = replication.prepare_push(self.pack(self.base_rev), None)
+    full_push = replication.prepare_push(self.pack(), None)
+    revision, _ = replication.push_update_to_replica(
+        'https://replica', delta_push, full_push).get_result()
+    self.assertEqual(self.auth_db_rev, revision.auth_db_rev)
+    self.assertEqual(['delta', 'full'], [kind for _, kind, _, _ in pushes])
+
+  def test_push_update_to_replica_transient_error(self):
+    # Only BAD_BASE_REVISION makes Primary fall back to an entire AuthDB.
+    calls = []
+    @ndb.tasklet
+    def urlfetch(**kwargs):
+      calls.append(kwargs['url'])
+      class ReturnValue(object):
+        status_code = 500
+        content = ''
+      raise ndb.Return(ReturnValue())
+    self.mock(ndb.get_context(), 'urlfetch', urlfetch)
+    future = replication.push_update_to_replica(
+        'https://replica',
+        replication.prepare_push(self.pack(self.base_rev), None),
+        replication.prepare_push(self.pack(), None))
+    with self.assertRaises(replication.TransientReplicaUpdateError):
+      future.get_result()
+    self.assertEqual(1, len(calls))
+
+  def test_update_replicas_task(self):
+    self.mock(replication, 'MAX_DELTA_REVISIONS', 2)
+    pushes = self.mock_urlfetch(bad_base_revision_replicas=['https://lagging'])
+    delta_base_rev = self.auth_db_rev - 2
+    self.add_replica('delta', delta_base_rev, '1.2.13')
+    self.add_replica('lagging', delta_base_rev, '1.2.13')
+    self.add_replica('far', delta_base_rev - 1, '1.2.13')
+    self.add_replica('old', delta_base_rev, '1.2.12')
+    self.add_replica('new', 0, None)
+    self.add_replica('synced', self.auth_db_rev, '1.2.13')
+
+    self.assertTrue(replication.update_replicas_task(self.auth_db_rev))
+    self.assertEqual([
+      ('https://delta', 'delta'),
+      ('https://far', 'full'),
+      ('https://lagging', 'delta'),
+      ('https://lagging', 'full'),
+      ('https://new', 'full'),
+      ('https://old', 'full'),
+    ], sorted((url, kind) for url, kind, _, _ in pushes))
+    for replica in replication.AuthReplicaState.query(
+        ancestor=replication.replicas_root_key()):
+      self.assertEqual(self.auth_db_rev, replica.auth_db_rev)
+
+
+  def test_is_auth_code_version_at_least(self):
+    def check(auth_code_version):
+      return replication.is_auth_code_version_at_least(
+          replication.AuthReplicaState(auth_code_version=auth_code_version),
+          replication.MIN_COMPRESSION_AUTH_CODE_VERSION)
+    self.assertTrue(check('1.2.14'))
+    self.assertTrue(check('1.2.100'))
+    self.assertTrue(check('1.3.0'))
+    self.assertTrue(check('2.0'))
+    self.assertFalse(check('1.2.13'))
+    self.assertFalse(check('1.2'))
+    self.assertFalse(check('0.9.20'))
+    self.assertFalse(check(None))
+    self.assertFalse(check('1.2.14-dev'))
+
+  def test_prepare_push(self):
+    blob = self.pack()
+    body, key_name, sig, compression = replication.prepare_push(blob, None)
+    self.assertEqual(blob, body)
+    self.assertIsNone(compression)
+    self.check_signature(
+        blob, {'X-AuthDB-SigKey-v1': key_name, 'X-AuthDB-SigVal-v1': sig})
+
+  def test_prepare_push_compressed(self):
+    blob = self.pack()
+    body, key_name, sig, compression = replication.prepare_push(
+        blob, auth_replication.PUSH_COMPRESSION_DEFLATE)
+    self.assertEqual(auth_replication.PUSH_COMPRESSION_DEFLATE, compression)
+    self.assertEqual(blob, zlib.decompress(body))
+    # The signature covers the compressed body.
+    self.check_signature(
+        body, {'X-AuthDB-SigKey-v1': key_name, 'X-AuthDB-SigVal-v1': sig})
+
+  def test_update_replicas_task_compression(self):
+    pushes = self.mock_urlfetch()
+    self.add_replica('new', self.base_rev, '1.2.14')
+    self.add_replica('old', self.base_rev, '1.2.13')
+    self.add_replica('ancient', 0, None)
+
+    self.assertTrue(replication.update_replicas_task(self.auth_db_rev))
+    pushes = {url: (body, headers) for url, _, body, headers in pushes}
+    self.assertEqual(
+        ['https://ancient', 'https://new', 'https://old'], sorted(pushes))
+
+    # Only replicas that understand compressed pushes get them.
+    body, headers = pushes['https://new']
+    self.assertEqual(
+        auth_replication.PUSH_COMPRESSION_DEFLATE,
+        headers['X-AuthDB-Compression-v1'])
+    self.assertEqual(self.pack(self.base_rev), zlib.decompress(body))
+    self.check_signature(body, headers)
+
+    body, headers = pushes['https://old']
+    self.assertNotIn('X-AuthDB-Compression-v1', headers)
+    self.assertEqual(self.pack(self.base_rev), body)
+    self.check_signature(body, headers)
+
+    body, headers = pushes['https://ancient']
+    self.assertNotIn('X-AuthDB-Compression-v1', headers)
+    self.assertEqual(self.pack(), body)
+    self.check_signature(body, headers)
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  unittest.main()
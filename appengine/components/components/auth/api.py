@@ -16,24 +16,29 @@ generally should not be used outside of Auth components implementation.
 
 import collections
 import functools
+import hashlib
 import json
 import logging
 import os
 import threading
 import time
 import urllib
+import zlib
 
+from google.appengine.api import memcache
 from google.appengine.api import oauth
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import metadata
 from google.appengine.runtime import apiproxy_errors
+from google.protobuf import message
 
 from components import utils
 
 from . import config
 from . import ipaddr
 from . import model
+from .proto import replication_pb2
 
 # Part of public API of 'auth' component, exposed by this module.
 __all__ = [
@@ -73,6 +78,12 @@ _auth_db_expiration = None
 # Holds id of a thread that is currently fetching AuthDB (or None).
 _auth_db_fetching_thread = None
 
+# Max size of a chunk of AuthDB snapshot stored in memcache (the limit on the
+# value size is 1 MB).
+_SNAPSHOT_CHUNK_SIZE = 1000 * 1000
+# How long AuthDB snapshots are kept in memcache, sec. They are immutable.
+_SNAPSHOT_EXPIRATION_SEC = 24 * 3600
+
 # Thread local storage for RequestCache (see 'get_request_cache').
 _thread_local = threading.local()
 
@@ -83,6 +94,19 @@ TOKEN_INFO_ENDPOINT = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
 # OAuth2 client_id of the "API Explorer" web app.
 API_EXPLORER_CLIENT_ID = '292824132082.apps.googleusercontent.com'
 
+# Maximum number of entries in the process-global verified token cache.
+_VERIFIED_TOKEN_CACHE_MAX_SIZE = 10000
+# Maximum number of failed validations in it, on top of _MAX_SIZE. Kept apart so
+# that a flood of bad tokens doesn't evict good ones.
+_VERIFIED_TOKEN_CACHE_MAX_NEGATIVE_SIZE = 1000
+# For how long successful token validations are cached, at most, sec.
+_VERIFIED_TOKEN_CACHE_MAX_TTL_SEC = 5 * 60
+# For how long failed token validations are cached, sec.
+_VERIFIED_TOKEN_CACHE_NEGATIVE_TTL_SEC = 10
+# For how long OAuth token validations are cached. GAE OAuth API doesn't expose
+# token expiration time, so it also bounds how long a revoked token is usable.
+_OAUTH_TOKEN_CACHE_TTL_SEC = 60
+
 
 ################################################################################
 ## Exception classes.
@@ -102,6 +126,10 @@ class AuthorizationError(Error):
   """Access is denied."""
 
 
+class _InvalidOAuthTokenError(AuthenticationError):
+  """OAuth API rejected the token."""
+
+
 ################################################################################
 ## AuthDB.
 
@@ -127,6 +155,27 @@ CachedGroup = collections.namedtuple('CachedGroup', [
 ])
 
 
+# Transitive closure of a group, precomputed by AuthDB when it is constructed,
+# so that membership checks do not walk the group graph.
+ExpandedGroup = collections.namedtuple('ExpandedGroup', [
+  'members',  # frozenset of identities (as bytes) of the group and its nested,
+              # or only of the group itself if 'lazy'
+  'globs',    # tuple of unique IdentityGlobs of the group and its nested
+  'glob_matcher',  # IdentityGlobMatcher built from 'globs'
+  'nested',   # frozenset of names of all transitively included groups
+  'lazy',     # True if members of 'nested' groups must be checked one by one
+])
+
+
+# Maximum number of (group, identity) results cached by each AuthDB instance.
+_MEMBERSHIP_CACHE_MAX_SIZE = 10000
+
+
+# Maximum number of identities copied into the flattened members of a group with
+# nested groups. Larger groups are checked one nested group at a time instead.
+_EXPANDED_GROUP_MAX_SIZE = 10000
+
+
 class AuthDB(object):
   """A read only in-memory database of auth configuration of a service.
 
@@ -165,6 +214,18 @@ class AuthDB(object):
         ip_whitelist_assignments or model.AuthIPWhitelistAssignments())
     self.entity_group_version = entity_group_version
 
+    # Parse all subnets once, it's immutable for the lifetime of AuthDB.
+    self._ip_whitelist_subnets = {
+      name: _compile_ip_whitelist(entity)
+      for name, entity in self.ip_whitelists.iteritems()
+    }
+    # Identity => name of the IP whitelist assigned to it. The first assignment
+    # wins if there are duplicates.
+    self._ip_whitelist_by_identity = {}
+    for assignment in self.ip_whitelist_assignments.assignments:
+      self._ip_whitelist_by_identity.setdefault(
+          assignment.identity, assignment.ip_whitelist)
+
     # Split |secrets| into local and global ones based on parent key id.
     for secret in (secrets or []):
       scope = secret.key.parent().string_id()
@@ -187,6 +248,16 @@ class AuthDB(object):
           modified_ts=entity.modified_ts,
           modified_by=entity.modified_by)
 
+    # Flatten the group graph once, it's immutable for the lifetime of AuthDB.
+    # Copying the members of nested groups into each of their ancestors costs
+    # memory that grows with the members and the depth of the graph, so it is
+    # bounded by _EXPANDED_GROUP_MAX_SIZE per group. Membership checks in
+    # bigger groups look into each nested group instead, which is slower but
+    # cached by _membership_cache.
+    self._expanded_groups = _expand_groups(self.groups)
+    # (group name, identity as bytes) => bool, see is_group_member.
+    self._membership_cache = {}
+
   @property
   def auth_db_rev(self):
     """Returns the revision number of groups database."""
@@ -212,59 +283,37 @@ class AuthDB(object):
 
     Unknown groups are considered empty.
     """
-    # Will be used when checking self.group_members_set sets.
-    ident_as_bytes = identity.to_bytes()
-
-    # While the code to add groups refuses to add cycle, this code ensures that
-    # it doesn't go in a cycle by keeping track of the groups currently being
-    # visited via |current| stack.
-    current = []
+    # Wildcard group that matches all identities (including anonymous!).
+    if group_name == model.GROUP_ALL:
+      return True
 
-    # Used to avoid revisiting same groups multiple times in case of
-    # diamond-like graphs, e.g. A->B, A->C, B->D, C->D.
-    visited = set()
-
-    def is_member(group_name):
-      # Wildcard group that matches all identities (including anonymous!).
-      if group_name == model.GROUP_ALL:
-        return True
-
-      # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
-      if not group_obj:
-        logging.warning(
-            'Querying unknown group: %s via %s', group_name, current)
-        return False
-
-      # In a group DAG a group can not reference any of its ancestors, since it
-      # creates a cycle.
-      if group_name in current:
-        logging.warning(
-            'Cycle in a group graph: %s via %s', group_name, current)
-        return False
-
-      # Explored this group already (and didn't find |identity| there) while
-      # visiting some sibling branch? Can happen in diamond-like graphs.
-      if group_name in visited:
-        return False
-
-      current.append(group_name)
-      try:
-        # Note that we don't include nested groups in GroupEssense.members sets
-        # because it blows up memory usage pretty bad. We don't have very deep
-        # nesting graphs, so checking nested groups separately is OK.
-        if ident_as_bytes in group_obj.members:
-          return True
-
-        if any(glob.match(identity) for glob in group_obj.globs):
-          return True
-
-        return any(is_member(nested) for nested in group_obj.nested)
-      finally:
-        current.pop()
-        visited.add(group_name)
+    ident_as_bytes = identity.to_bytes()
+    cache_key = (group_name, ident_as_bytes)
+    result = self._membership_cache.get(cache_key)
+    if result is not None:
+      return result
+
+    expanded = self._expanded_groups.get(group_name)
+    if not expanded:
+      logging.warning('Querying unknown group: %s', group_name)
+      return False
 
-    return is_member(group_name)
+    result = (
+        model.GROUP_ALL in expanded.nested or
+        ident_as_bytes in expanded.members or
+        expanded.glob_matcher.match(identity))
+    if not result and expanded.lazy:
+      result = any(
+          ident_as_bytes in self.groups[nested].members
+          for nested in expanded.nested if nested in self.groups)
+
+    # Dict operations are atomic, so concurrent requests sharing this AuthDB
+    # can safely race here. Dropping the whole cache when it is full is cheaper
+    # than maintaining LRU order on every check.
+    if len(self._membership_cache) >= _MEMBERSHIP_CACHE_MAX_SIZE:
+      self._membership_cache.clear()
+    self._membership_cache[cache_key] = result
+    return result
 
   def get_group(self, group_name):
     """Returns AuthGroup entity reconstructing it from the cache.
@@ -307,29 +356,15 @@ class AuthDB(object):
         return set()
       return set(model.Identity.from_bytes(m) for m in group_obj.members)
 
-    # Set of groups already added to 'listing'.
-    visited = set()
-
-    # Updated by visit_group. We keep it in the closure to avoid passing more
-    # stuff through the thread stack.
-    listing = set()
-
-    def visit_group(group_name):
-      # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
-      if not group_obj:
-        return
-
-      if group_name in visited:
-        return
-      visited.add(group_name)
-
-      listing.update(group_obj.members)
-      for nested in group_obj.nested:
-        visit_group(nested)
-
-    visit_group(group_name)
-    return set(model.Identity.from_bytes(m) for m in listing)
+    expanded = self._expanded_groups.get(group_name)
+    if not expanded:
+      return set()
+    members = set(expanded.members)
+    if expanded.lazy:
+      for nested in expanded.nested:
+        if nested in self.groups:
+          members.update(self.groups[nested].members)
+    return set(model.Identity.from_bytes(m) for m in members)
 
   def get_secret(self, secret_key):
     """Returns list of strings with last known values of a secret.
@@ -361,11 +396,11 @@ class AuthDB(object):
       whitelist_name: name of the IP whitelist (e.g. 'bots').
       ip: instance of ipaddr.IP.
     """
-    whitelist = self.ip_whitelists.get(whitelist_name)
-    if not whitelist:
+    subnets = self._ip_whitelist_subnets.get(whitelist_name)
+    if subnets is None:
       logging.error('Unknown IP whitelist: %s', whitelist_name)
       return False
-    return whitelist.is_ip_whitelisted(ip)
+    return ip in subnets
 
   def verify_ip_whitelisted(self, identity, ip):
     """Verifies IP is in a whitelist assigned to the Identity.
@@ -382,11 +417,8 @@ class AuthDB(object):
     """
     assert isinstance(identity, model.Identity), identity
 
-    for assignment in self.ip_whitelist_assignments.assignments:
-      if assignment.identity == identity:
-        whitelist_name = assignment.ip_whitelist
-        break
-    else:
+    whitelist_name = self._ip_whitelist_by_identity.get(identity)
+    if whitelist_name is None:
       return
 
     if not self.is_in_ip_whitelist(whitelist_name, ip):
@@ -420,6 +452,98 @@ class AuthDB(object):
         self.global_config.oauth_additional_client_ids)
 
 
+def _expand_groups(groups):
+  """Computes the transitive closure of each group.
+
+  Nested groups that are unknown are considered empty. Cycles in the graph (that
+  the code adding groups refuses to create) are reported and broken. Groups
+  whose members would exceed _EXPANDED_GROUP_MAX_SIZE are only partially
+  flattened, see ExpandedGroup.
+
+  Args:
+    groups: dict {group name -> CachedGroup}.
+
+  Returns:
+    Dict {group name -> ExpandedGroup}.
+  """
+  # group name => set of names of groups reachable from it (including itself).
+  reachable = {}
+  cycles = set()
+
+  def visit(group_name, current):
+    """Returns (set of reachable groups, False if a cycle was broken)."""
+    if group_name in reachable:
+      return reachable[group_name], True
+    # A group can not reference any of its ancestors, it's a cycle. The result
+    # is still correct for the ancestor being visited, but not for the groups
+    # in between, so they are not memoized.
+    if group_name in current:
+      cycles.add(group_name)
+      return set(), False
+    result = set([group_name])
+    complete = True
+    group_obj = groups.get(group_name)
+    if group_obj:
+      current.append(group_name)
+      for nested in group_obj.nested:
+        nested_result, nested_complete = visit(nested, current)
+        result.update(nested_result)
+        complete = complete and nested_complete
+      current.pop()
+    if complete:
+      reachable[group_name] = result
+    return result, complete
+
+  expanded = {}
+  for group_name, group_obj in groups.iteritems():
+    names, _ = visit(group_name, [])
+    names = names - set([group_name])
+    # Groups without nested groups share the frozenset with CachedGroup.
+    members = group_obj.members
+    # Compare an upper bound of the flattened size, to not build the union at
+    # all when it's too big.
+    lazy = bool(names) and (
+        len(members) + sum(len(groups[n].members) for n in names if n in groups)
+        > _EXPANDED_GROUP_MAX_SIZE)
+    globs = list(group_obj.globs)
+    seen_globs = set(globs)
+    for nested in names:
+      nested_obj = groups.get(nested)
+      if not nested_obj:
+        continue
+      if nested_obj.members and not lazy:
+        members = members | nested_obj.members
+      for glob in nested_obj.globs:
+        if glob not in seen_globs:
+          seen_globs.add(glob)
+          globs.append(glob)
+    expanded[group_name] = ExpandedGroup(
+        members=members,
+        globs=tuple(globs),
+        glob_matcher=model.IdentityGlobMatcher(globs),
+        nested=frozenset(names),
+        lazy=lazy)
+
+  if cycles:
+    logging.warning('Cycle in a group graph: %s', sorted(cycles))
+  return expanded
+
+
+def _compile_ip_whitelist(entity):
+  """Returns ipaddr.SubnetSet with subnets of AuthIPWhitelist entity.
+
+  Invalid subnets (that the entity validator refuses to store) are skipped.
+  """
+  subnets = []
+  for net in entity.subnets:
+    try:
+      subnets.append(ipaddr.subnet_from_string(net))
+    except ValueError:
+      logging.error(
+          'Invalid subnet in IP whitelist %s: %s', entity.key.id(), net)
+  return ipaddr.SubnetSet(subnets)
+
+
 ################################################################################
 ## OAuth token check.
 
@@ -429,6 +553,10 @@ def attempt_oauth_initialization(scope):
 
   The result it cached in appengine.api.oauth guts. Never raises exceptions,
   just gives up letting subsequent oauth.* calls fail in a proper way.
+
+  Returns:
+    True if OAuth API replied, False if all attempts failed with transient
+    errors.
   """
   # 4 attempts: ~20 sec (default RPC deadline is 5 sec).
   attempt = 0
@@ -436,7 +564,7 @@ def attempt_oauth_initialization(scope):
     attempt += 1
     try:
       oauth.get_client_id(scope)
-      return
+      return True
     except apiproxy_errors.DeadlineExceededError as e:
       logging.warning('DeadlineExceededError: %s', e)
       continue
@@ -452,10 +580,11 @@ def attempt_oauth_initialization(scope):
       # Next call to oauth.get_client_id() will trigger same error and it will
       # be handled for real.
       logging.warning('oauth.Error (%s): %s', e.__class__.__name__, e)
-      return
+      return True
+  return False
 
 
-def extract_oauth_caller_identity():
+def extract_oauth_caller_identity(header=None):
   """Extracts and validates Identity of a caller for the current request.
 
   Implemented on top of GAE OAuth2 API.
@@ -465,6 +594,11 @@ def extract_oauth_caller_identity():
   and verifies that their client_id is what it should be. Service account's
   client_id doesn't have to be in client_id whitelist.
 
+  Args:
+    header: value of 'Authorization' header of the current request. If given,
+        results of the token validation are cached in the verified token cache
+        (the client_id whitelist is still checked each time).
+
   Returns:
     Identity of the caller in case the request was successfully validated.
 
@@ -472,22 +606,11 @@ def extract_oauth_caller_identity():
     AuthenticationError in case access_token is missing or invalid.
     AuthorizationError in case client_id is forbidden.
   """
-  # OAuth2 scope a token should have.
-  oauth_scope = 'https://www.googleapis.com/auth/userinfo.email'
-
-  # Fetch OAuth request state with retries. oauth.* calls use it internally.
-  attempt_oauth_initialization(oauth_scope)
-
-  # Extract client_id and email from access token. That also validates the token
-  # and raises OAuthRequestError if token is revoked or otherwise not valid.
-  try:
-    client_id = oauth.get_client_id(oauth_scope)
-  except oauth.OAuthRequestError:
-    raise AuthenticationError('Invalid OAuth token')
-
-  # This call just reads data cached by oauth.get_client_id, and thus should
-  # never fail.
-  email = oauth.get_current_user(oauth_scope).email()
+  if header:
+    client_id, email = _verified_token_cache.get_or_verify(
+        'oauth', header, _verify_oauth_token, (_InvalidOAuthTokenError,))
+  else:
+    client_id, email = _verify_oauth_token()[0]
 
   # Is client_id in the explicit whitelist? Used with three legged OAuth. Detect
   # Google service accounts. No need to whitelist client_ids for each of them,
@@ -508,6 +631,39 @@ def extract_oauth_caller_identity():
     raise AuthenticationError('Unsupported user email: %s' % email)
 
 
+def _verify_oauth_token():
+  """Validates the access token of the current request with GAE OAuth2 API.
+
+  Returns:
+    Tuple ((client_id, email), expiration time as unix timestamp).
+
+  Raises:
+    AuthenticationError in case access_token is missing or invalid.
+  """
+  # OAuth2 scope a token should have.
+  oauth_scope = 'https://www.googleapis.com/auth/userinfo.email'
+
+  # Fetch OAuth request state with retries. oauth.* calls use it internally.
+  initialized = attempt_oauth_initialization(oauth_scope)
+
+  # Extract client_id and email from access token. That also validates the token
+  # and raises OAuthRequestError if token is revoked or otherwise not valid.
+  try:
+    client_id = oauth.get_client_id(oauth_scope)
+  except oauth.OAuthRequestError:
+    # If OAuth API is having issues, the token may well be valid. Raise an error
+    # that is not cached by the verified token cache.
+    if not initialized:
+      raise AuthenticationError('Failed to validate OAuth token')
+    raise _InvalidOAuthTokenError('Invalid OAuth token')
+
+  # This call just reads data cached by oauth.get_client_id, and thus should
+  # never fail.
+  email = oauth.get_current_user(oauth_scope).email()
+  return (
+      (client_id, email), utils.time_time() + _OAUTH_TOKEN_CACHE_TTL_SEC)
+
+
 def check_oauth_access_token(headers):
   """Verifies the access token of the current request.
 
@@ -543,7 +699,7 @@ def check_oauth_access_token(headers):
 
   # Non-development instances always use real OAuth API.
   if not utils.is_local_dev_server() and not utils.is_dev():
-    return extract_oauth_caller_identity()
+    return extract_oauth_caller_identity(header)
 
   # OAuth2 library is mocked on dev server to return some nonsense. Use (slow,
   # but real) OAuth2 API endpoint instead to validate access_token. It is also
@@ -616,6 +772,118 @@ def dev_oauth_authentication(header, token_info_endpoint, suffix=''):
     raise AuthorizationError('Unsupported user email: %s' % email)
 
 
+################################################################################
+## Verified token cache.
+
+
+class VerifiedTokenCache(object):
+  """Process-global cache of token validation results.
+
+  Entries are keyed by a digest of the token, so tokens themselves are not
+  kept in memory. Successful validations are cached until the token expires,
+  but no longer than |max_ttl_sec|. Failed validations are cached for
+  |negative_ttl_sec| to absorb retry storms.
+
+  Successful and failed validations are bounded separately, by |max_size| and
+  |max_negative_size|. When full, entries that expire first are evicted.
+
+  Thread-safe.
+  """
+
+  def __init__(self, max_size, max_negative_size, max_ttl_sec,
+               negative_ttl_sec):
+    self._max_size = max_size
+    self._max_negative_size = max_negative_size
+    self._max_ttl_sec = max_ttl_sec
+    self._negative_ttl_sec = negative_ttl_sec
+    self._lock = threading.Lock()
+    # Digest -> (expiration timestamp, result, None).
+    self._entries = {}
+    # Digest -> (expiration timestamp, None, exception).
+    self._negative_entries = {}
+
+  def get_or_verify(self, kind, token, verify, negative_errors):
+    """Returns cached result of |verify| call for the token or calls it.
+
+    Args:
+      kind: kind of the token (e.g. 'oauth'), to avoid collisions between
+          tokens of different kinds.
+      token: the token string.
+      verify: function that validates the token and returns a tuple
+          (result, token expiration as unix timestamp or None if unknown).
+      negative_errors: tuple of exception classes raised by |verify| that
+          should be cached. Other exceptions (e.g. transient errors) are not.
+
+    Returns:
+      The result returned by |verify|.
+
+    Raises:
+      Whatever |verify| raised (possibly a cached exception).
+    """
+    key = hashlib.sha256('%s\n%s' % (kind, token)).digest()
+    now = utils.time_time()
+    with self._lock:
+      entry = self._entries.get(key) or self._negative_entries.get(key)
+    if entry and entry[0] > now:
+      _, result, exc = entry
+      if exc:
+        raise exc
+      return result
+
+    try:
+      result, expiration = verify()
+    except negative_errors as exc:
+      self._put(
+          self._negative_entries, self._max_negative_size,
+          key, (now + self._negative_ttl_sec, None, exc))
+      raise
+
+    max_expiration = now + self._max_ttl_sec
+    if expiration is None or expiration > max_expiration:
+      expiration = max_expiration
+    if expiration > now:
+      self._put(
+          self._entries, self._max_size, key, (expiration, result, None))
+    return result
+
+  def clear(self):
+    """Removes all entries from the cache."""
+    with self._lock:
+      self._entries.clear()
+      self._negative_entries.clear()
+
+  def _put(self, entries, max_size, key, entry):
+    with self._lock:
+      if key not in entries and len(entries) >= max_size:
+        # Drop expired entries first, and a quarter of entries that expire
+        # first if it didn't help. Cheaper than maintaining LRU order on every
+        # check.
+        now = utils.time_time()
+        for k in [k for k, v in entries.iteritems() if v[0] <= now]:
+          del entries[k]
+        if len(entries) >= max_size:
+          by_expiration = sorted(entries, key=lambda k: entries[k][0])
+          for k in by_expiration[:max(1, max_size / 4)]:
+            del entries[k]
+      # A token is either valid or not, drop the stale opposite entry.
+      self._entries.pop(key, None)
+      self._negative_entries.pop(key, None)
+      entries[key] = entry
+
+
+# Shared by OAuth and delegation tokens validation.
+_verified_token_cache = VerifiedTokenCache(
+    _VERIFIED_TOKEN_CACHE_MAX_SIZE,
+    _VERIFIED_TOKEN_CACHE_MAX_NEGATIVE_SIZE,
+    _VERIFIED_TOKEN_CACHE_MAX_TTL_SEC,
+    _VERIFIED_TOKEN_CACHE_NEGATIVE_TTL_SEC)
+
+
+def get_verified_token_cache():
+  """Returns process-global VerifiedTokenCache."""
+  return _verified_token_cache
+
+
 ################################################################################
 ## RequestCache.
 
@@ -777,13 +1045,29 @@ def fetch_auth_db(known_version=None):
     # likely to change without any apparent reason (like entity group version
     # does).
 
-    # TODO(vadimsh): Add memcache keyed at |current_version| so only one
-    # frontend instance have to pay the cost of fetching AuthDB from Datastore
-    # via multiple RPCs. All other instances will fetch it via single
-    # memcache 'get'.
+    replication_state = model.replication_state_key().get()
+    auth_db_rev = replication_state.auth_db_rev if replication_state else 0
+
+    # Only one instance has to pay the cost of fetching AuthDB from Datastore
+    # via multiple RPCs, others fetch the snapshot of |auth_db_rev| it stored in
+    # memcache. Disabled on dev server for the same reason as above.
+    use_snapshot_cache = current_version is not None and auth_db_rev > 0
+    if use_snapshot_cache:
+      snapshot = _get_cached_auth_db_snapshot(auth_db_rev)
+      if snapshot:
+        # Local secrets are not in the snapshot, they are not replicated.
+        local_secrets = model.AuthSecret.query(
+            ancestor=model.secret_scope_key('local')).fetch()
+        return AuthDB(
+            replication_state=replication_state,
+            global_config=snapshot.global_config,
+            groups=snapshot.groups,
+            secrets=snapshot.secrets + local_secrets,
+            ip_whitelists=snapshot.ip_whitelists,
+            ip_whitelist_assignments=snapshot.ip_whitelist_assignments,
+            entity_group_version=current_version)
 
     # Fetch all stuff in parallel. Fetch ALL groups and ALL secrets.
-    replication_state_future = model.replication_state_key().get_async()
     global_config_future = root_key.get_async()
     groups_future = model.AuthGroup.query(ancestor=root_key).fetch_async()
     secrets_future = model.AuthSecret.query(ancestor=root_key).fetch_async()
@@ -791,14 +1075,27 @@ def fetch_auth_db(known_version=None):
     # It's fine to block here as long as it's the last fetch.
     ip_whitelist_assignments, ip_whitelists = model.fetch_ip_whitelists()
 
+    global_config = global_config_future.get_result()
+    groups = groups_future.get_result()
+    secrets = secrets_future.get_result()
+    if use_snapshot_cache and global_config:
+      global_scope = model.secret_scope_key('global')
+      _cache_auth_db_snapshot(
+          auth_db_rev,
+          global_config=global_config,
+          groups=groups,
+          secrets=[s for s in secrets if s.key.parent() == global_scope],
+          ip_whitelists=ip_whitelists,
+          ip_whitelist_assignments=ip_whitelist_assignments)
+
     # Note that get_entity_group_version() uses same entity group (root_key)
     # internally and respects transactions. So all data fetched here does indeed
     # correspond to |current_version|.
     return AuthDB(
-        replication_state=replication_state_future.get_result(),
-        global_config=global_config_future.get_result(),
-        groups=groups_future.get_result(),
-        secrets=secrets_future.get_result(),
+        replication_state=replication_state,
+        global_config=global_config,
+        groups=groups,
+        secrets=secrets,
         ip_whitelists=ip_whitelists,
         ip_whitelist_assignments=ip_whitelist_assignments,
         entity_group_version=current_version)
@@ -807,6 +1104,73 @@ def fetch_auth_db(known_version=None):
   return fetch()
 
 
+def _auth_db_snapshot_memcache_key(auth_db_rev):
+  """Memcache key of the header of AuthDB snapshot at given revision."""
+  return 'auth_db_snapshot/v1/%d' % auth_db_rev
+
+
+def _get_cached_auth_db_snapshot(auth_db_rev):
+  """Returns AuthDBSnapshot stored by _cache_auth_db_snapshot or None."""
+  # Import lazily to avoid module reference cycle.
+  from . import replication
+  key = _auth_db_snapshot_memcache_key(auth_db_rev)
+  header = memcache.get(key)
+  if not header:
+    return None
+  chunks_count, sha256 = header
+  chunk_keys = ['%s/%d' % (key, i) for i in xrange(chunks_count)]
+  chunks = memcache.get_multi(chunk_keys)
+  if len(chunks) != chunks_count:
+    logging.warning('AuthDB snapshot at rev %d is evicted', auth_db_rev)
+    return None
+  blob = ''.join(chunks[k] for k in chunk_keys)
+  try:
+    if hashlib.sha256(blob).hexdigest() != sha256:
+      raise ValueError('digest mismatch')
+    auth_db_proto = replication_pb2.AuthDB.FromString(zlib.decompress(blob))
+  except (ValueError, zlib.error, message.DecodeError) as e:
+    logging.error('AuthDB snapshot at rev %d is corrupted: %s', auth_db_rev, e)
+    return None
+  return replication.proto_to_auth_db_snapshot(auth_db_proto)
+
+
+def _cache_auth_db_snapshot(auth_db_rev, **kwargs):
+  """Stores deflated serialized AuthDB snapshot in memcache.
+
+  The blob is split into chunks that fit into a memcache value. The header with
+  the number of chunks is added last, only once all chunks are stored.
+
+  Args:
+    auth_db_rev: revision of the snapshot.
+    kwargs: fields of replication.AuthDBSnapshot, i.e. the replicated subset of
+        AuthDB entities (only global secrets).
+  """
+  # Import lazily to avoid module reference cycle.
+  from . import replication
+  snapshot = replication.AuthDBSnapshot(**kwargs)
+  try:
+    blob = zlib.compress(
+        replication.auth_db_snapshot_to_proto(snapshot).SerializeToString())
+  except Exception:
+    # The cache is an optimization, it must not break fetch_auth_db.
+    logging.exception('Failed to serialize AuthDB at rev %d', auth_db_rev)
+    return
+  key = _auth_db_snapshot_memcache_key(auth_db_rev)
+  chunks = {
+    '%s/%d' % (key, i / _SNAPSHOT_CHUNK_SIZE):
+        blob[i:i+_SNAPSHOT_CHUNK_SIZE]
+    for i in xrange(0, len(blob), _SNAPSHOT_CHUNK_SIZE)
+  }
+  if memcache.set_multi(chunks, time=_SNAPSHOT_EXPIRATION_SEC):
+    logging.warning('Failed to store AuthDB snapshot at rev %d', auth_db_rev)
+    return
+  memcache.add(
+      key, (len(chunks), hashlib.sha256(blob).hexdigest()),
+      time=_SNAPSHOT_EXPIRATION_SEC)
+  logging.info(
+      'Stored AuthDB snapshot at rev %d: %d bytes', auth_db_rev, len(blob))
+
+
 def reset_local_state():
   """Resets all local caches to an initial state. Only for testing."""
   global _auth_db
@@ -818,6 +1182,7 @@ def reset_local_state():
   _auth_db_fetching_thread = None
   _lazy_bootstrap_ran = False
   _thread_local.request_cache = None
+  _verified_token_cache.clear()
 
 
 def get_process_auth_db():
@@ -16,8 +16,10 @@ import unittest
 from test_support import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from components import utils
 from components.auth import api
 from components.auth import ipaddr
 from components.auth import model
@@ -109,6 +111,79 @@ class AuthDBTest(test_case.TestCase):
     self.assertFalse(
         is_member([with_nesting, with_listing], model.Anonymous, 'WithNesting'))
 
+  def test_is_group_member_transitive(self):
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    bot = model.Identity(model.IDENTITY_BOT, 'bot-1')
+
+    # A -> B -> C, B -> D (missing), E -> *.
+    group_a = model.AuthGroup(id='A', nested=['B'])
+    group_b = model.AuthGroup(id='B', nested=['C', 'D'])
+    group_c = model.AuthGroup(
+        id='C',
+        members=[joe],
+        globs=[model.IdentityGlob(model.IDENTITY_BOT, 'bot-*')])
+    group_e = model.AuthGroup(id='E', nested=['*'])
+    db = api.AuthDB(groups=[group_a, group_b, group_c, group_e])
+
+    expanded = db._expanded_groups['A']
+    self.assertEqual(frozenset([joe.to_bytes()]), expanded.members)
+    self.assertEqual(
+        (model.IdentityGlob(model.IDENTITY_BOT, 'bot-*'),), expanded.globs)
+    self.assertEqual(frozenset(['B', 'C', 'D']), expanded.nested)
+
+    self.assertTrue(db.is_group_member('A', joe))
+    self.assertTrue(db.is_group_member('A', bot))
+    self.assertFalse(db.is_group_member('A', model.Anonymous))
+    self.assertTrue(db.is_group_member('E', model.Anonymous))
+
+  def test_is_group_member_lazy(self):
+    # Members of nested groups are not copied past _EXPANDED_GROUP_MAX_SIZE.
+    self.mock(api, '_EXPANDED_GROUP_MAX_SIZE', 2)
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    bob = model.Identity(model.IDENTITY_USER, 'bob@example.com')
+    ann = model.Identity(model.IDENTITY_USER, 'ann@example.com')
+    group_a = model.AuthGroup(id='A', members=[joe], nested=['B'])
+    group_b = model.AuthGroup(id='B', members=[bob], nested=['C'])
+    group_c = model.AuthGroup(id='C', members=[ann])
+    db = api.AuthDB(groups=[group_a, group_b, group_c])
+
+    expanded = db._expanded_groups['A']
+    self.assertTrue(expanded.lazy)
+    self.assertEqual(frozenset([joe.to_bytes()]), expanded.members)
+    expanded = db._expanded_groups['B']
+    self.assertFalse(expanded.lazy)
+    self.assertEqual(
+        frozenset([bob.to_bytes(), ann.to_bytes()]), expanded.members)
+
+    self.assertTrue(db.is_group_member('A', joe))
+    self.assertTrue(db.is_group_member('A', bob))
+    self.assertTrue(db.is_group_member('A', ann))
+    self.assertFalse(db.is_group_member('A', model.Anonymous))
+    self.assertEqual(set([joe, bob, ann]), db.list_group('A'))
+
+  def test_is_group_member_cache(self):
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    group = model.AuthGroup(
+        id='G', globs=[model.IdentityGlob(model.IDENTITY_USER, '*')])
+    db = api.AuthDB(groups=[group])
+
+    self.assertTrue(db.is_group_member('G', joe))
+    self.assertFalse(db.is_group_member('G', model.Anonymous))
+    self.assertEqual({
+      ('G', joe.to_bytes()): True,
+      ('G', model.Anonymous.to_bytes()): False,
+    }, db._membership_cache)
+
+    # Cached results are used as is.
+    db._membership_cache[('G', joe.to_bytes())] = False
+    self.assertFalse(db.is_group_member('G', joe))
+
+    # The cache is dropped once full.
+    self.mock(api, '_MEMBERSHIP_CACHE_MAX_SIZE', 2)
+    self.assertTrue(db.is_group_member(
+        'G', model.Identity(model.IDENTITY_USER, 'max@example.com')))
+    self.assertEqual(1, len(db._membership_cache))
+
   def test_list_group(self):
     list_group = (lambda groups, group, recursive:
         api.AuthDB(groups=groups).list_group(group, recursive))
@@ -267,6 +342,72 @@ class AuthDBTest(test_case.TestCase):
         {'bots': bots_ip_whitelist, 'some ip whitelist': some_ip_whitelist},
         auth_db.ip_whitelists)
 
+  def test_fetch_auth_db_snapshot_cache(self):
+    # The cache is disabled when entity group version is unknown (dev server).
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+
+    model.AuthGroup(
+        key=model.group_key('Group A'),
+        members=[model.Identity(model.IDENTITY_USER, 'a@example.com')],
+        created_ts=datetime.datetime(2014, 1, 2, 3, 4, 5),
+        created_by=model.Identity.from_bytes('user:x@example.com'),
+        modified_ts=datetime.datetime(2015, 1, 2, 3, 4, 5),
+        modified_by=model.Identity.from_bytes('user:y@example.com')).put()
+    model.AuthSecret.bootstrap('local', 'local')
+    model.AuthSecret.bootstrap('global', 'global')
+    auth_db_rev = model.get_auth_db_revision()
+    self.assertTrue(auth_db_rev)
+
+    # The first fetch stores the snapshot.
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(['Group A'], auth_db.groups.keys())
+    key = api._auth_db_snapshot_memcache_key(auth_db_rev)
+    self.assertEqual(1, memcache.get(key)[0])
+
+    # The next one uses it. To prove it, modify datastore behind its back.
+    model.group_key('Group A').delete()
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(['Group A'], auth_db.groups.keys())
+    self.assertTrue(auth_db.is_group_member(
+        'Group A', model.Identity(model.IDENTITY_USER, 'a@example.com')))
+    self.assertEqual(['local'], auth_db.secrets['local'].keys())
+    self.assertEqual(['global'], auth_db.secrets['global'].keys())
+    self.assertEqual(auth_db_rev, auth_db.auth_db_rev)
+    self.assertEqual(123, auth_db.entity_group_version)
+
+    # A corrupted snapshot is ignored.
+    memcache.set(key + '/0', 'garbage')
+    auth_db = api.fetch_auth_db()
+    self.assertEqual({}, auth_db.groups)
+
+  def test_fetch_auth_db_snapshot_cache_chunks(self):
+    self.mock(api, '_SNAPSHOT_CHUNK_SIZE', 10)
+    api._cache_auth_db_snapshot(
+        1,
+        global_config=model.AuthGlobalConfig(
+            key=model.root_key(), oauth_client_id='client-id'),
+        groups=[
+          model.AuthGroup(
+              key=model.group_key('Group A'),
+              created_ts=datetime.datetime(2014, 1, 2, 3, 4, 5),
+              created_by=model.Identity.from_bytes('user:x@example.com'),
+              modified_ts=datetime.datetime(2015, 1, 2, 3, 4, 5),
+              modified_by=model.Identity.from_bytes('user:y@example.com')),
+        ],
+        secrets=[],
+        ip_whitelists=[],
+        ip_whitelist_assignments=model.AuthIPWhitelistAssignments(
+            key=model.ip_whitelist_assignments_key()))
+    self.assertTrue(memcache.get(api._auth_db_snapshot_memcache_key(1))[0] > 1)
+    snapshot = api._get_cached_auth_db_snapshot(1)
+    self.assertEqual('client-id', snapshot.global_config.oauth_client_id)
+    self.assertEqual(
+        [model.group_key('Group A')], [g.key for g in snapshot.groups])
+
+    # Evicted chunk.
+    memcache.delete(api._auth_db_snapshot_memcache_key(1) + '/1')
+    self.assertIsNone(api._get_cached_auth_db_snapshot(1))
+
   def test_get_secret(self):
     # Make AuthDB with two secrets.
     local_secret = model.AuthSecret.bootstrap('local_secret', 'local')
@@ -358,6 +499,37 @@ class AuthDBTest(test_case.TestCase):
           model.Identity(model.IDENTITY_USER, 'a@example.com'),
           ipaddr.ip_from_string('127.0.0.1'))
 
+  def test_is_in_ip_whitelist(self):
+    auth_db = self.make_auth_db_with_ip_whitelist()
+    call = lambda name, ip: auth_db.is_in_ip_whitelist(
+        name, ipaddr.ip_from_string(ip))
+    self.assertTrue(call('bots', '192.168.1.1'))
+    self.assertTrue(call('bots', '0:0:ffff::1'))
+    self.assertFalse(call('bots', '192.168.1.2'))
+    self.assertFalse(call('bots', '127.0.0.1'))
+    self.assertTrue(call('some ip whitelist', '127.0.0.1'))
+    self.assertFalse(call('missing ip whitelist', '127.0.0.1'))
+
+  def test_verify_ip_whitelisted_first_assignment_wins(self):
+    ident = model.Identity(model.IDENTITY_USER, 'a@example.com')
+    auth_db = api.AuthDB(
+      ip_whitelists=[
+        model.AuthIPWhitelist(
+          key=model.ip_whitelist_key('some ip whitelist'),
+          subnets=['127.0.0.1/32'],
+        ),
+      ],
+      ip_whitelist_assignments=model.AuthIPWhitelistAssignments(
+        assignments=[
+          model.AuthIPWhitelistAssignments.Assignment(
+            identity=ident, ip_whitelist='some ip whitelist'),
+          model.AuthIPWhitelistAssignments.Assignment(
+            identity=ident, ip_whitelist='missing ip whitelist'),
+        ],
+      ),
+    )
+    auth_db.verify_ip_whitelisted(ident, ipaddr.ip_from_string('127.0.0.1'))
+
 
 class TestAuthDBCache(test_case.TestCase):
   """Tests for process-global and request-local AuthDB cache."""
@@ -778,6 +950,175 @@ class OAuthAccountsTest(test_case.TestCase):
     with self.assertRaises(api.AuthorizationError):
       api.extract_oauth_caller_identity()
 
+  def test_token_validation_is_cached(self):
+    api.reset_local_state()
+    calls = []
+    self.mock_all('email@email.com', 'some-client-id', ['some-client-id'])
+    self.mock(
+        api.oauth, 'get_client_id',
+        lambda _: calls.append(1) or 'some-client-id')
+    for _ in xrange(3):
+      self.assertEqual(
+          self.user('email@email.com'),
+          api.extract_oauth_caller_identity('Bearer token'))
+    self.assertEqual(1, len(calls))
+
+    # client_id whitelist is still checked for cached tokens.
+    class FakeAuthDB(object):
+      is_allowed_oauth_client_id = lambda _, cid: False
+    self.mock(api, 'get_request_auth_db', FakeAuthDB)
+    with self.assertRaises(api.AuthorizationError):
+      api.extract_oauth_caller_identity('Bearer token')
+    self.assertEqual(1, len(calls))
+
+  def check_invalid_token(self, initialized, expected_calls):
+    api.reset_local_state()
+    calls = []
+    def get_client_id(_):
+      calls.append(1)
+      raise api.oauth.OAuthRequestError()
+    self.mock(api, 'attempt_oauth_initialization', lambda _: initialized)
+    self.mock(api.oauth, 'get_client_id', get_client_id)
+    for _ in xrange(3):
+      with self.assertRaises(api.AuthenticationError):
+        api.extract_oauth_caller_identity('Bearer token')
+    self.assertEqual(expected_calls, len(calls))
+
+  def test_invalid_token_is_cached(self):
+    self.check_invalid_token(True, 1)
+
+  def test_invalid_token_not_cached_if_oauth_api_failed(self):
+    self.check_invalid_token(False, 3)
+
+
+class VerifiedTokenCacheTest(test_case.TestCase):
+  """Tests for VerifiedTokenCache class."""
+
+  def setUp(self):
+    super(VerifiedTokenCacheTest, self).setUp()
+    self.now = 1000.0
+    self.mock(utils, 'time_time', lambda: self.now)
+    self.cache = api.VerifiedTokenCache(
+        max_size=3, max_negative_size=2, max_ttl_sec=300, negative_ttl_sec=10)
+    self.calls = []
+
+  def verify(self, result, expiration):
+    def verify():
+      self.calls.append(result)
+      return result, expiration
+    return lambda: self.cache.get_or_verify('kind', 'tok', verify, ())
+
+  def test_positive_capped_by_token_expiration(self):
+    call = self.verify('result', self.now + 60)
+    self.assertEqual('result', call())
+    self.now += 59
+    self.assertEqual('result', call())
+    self.assertEqual(1, len(self.calls))
+    self.now += 1
+    self.assertEqual('result', call())
+    self.assertEqual(2, len(self.calls))
+
+  def test_positive_capped_by_max_ttl(self):
+    call = self.verify('result', self.now + 3600)
+    call()
+    self.now += 299
+    call()
+    self.assertEqual(1, len(self.calls))
+    self.now += 1
+    call()
+    self.assertEqual(2, len(self.calls))
+
+  def test_unknown_expiration(self):
+    call = self.verify('result', None)
+    call()
+    self.now += 299
+    call()
+    self.assertEqual(1, len(self.calls))
+
+  def test_expired_not_cached(self):
+    call = self.verify('result', self.now - 1)
+    call()
+    call()
+    self.assertEqual(2, len(self.calls))
+
+  def test_kinds_do_not_collide(self):
+    self.cache.get_or_verify('a', 'tok', lambda: ('a', None), ())
+    self.assertEqual(
+        'b', self.cache.get_or_verify('b', 'tok', lambda: ('b', None), ()))
+
+  def test_negative(self):
+    calls = []
+    def verify():
+      calls.append(1)
+      raise api.AuthenticationError('bad')
+    call = lambda: self.cache.get_or_verify(
+        'kind', 'tok', verify, (api.AuthenticationError,))
+    for _ in xrange(2):
+      with self.assertRaises(api.AuthenticationError):
+        call()
+    self.assertEqual(1, len(calls))
+    self.now += 10
+    with self.assertRaises(api.AuthenticationError):
+      call()
+    self.assertEqual(2, len(calls))
+
+  def test_unlisted_errors_not_cached(self):
+    calls = []
+    def verify():
+      calls.append(1)
+      raise ValueError('transient')
+    for _ in xrange(2):
+      with self.assertRaises(ValueError):
+        self.cache.get_or_verify(
+            'kind', 'tok', verify, (api.AuthenticationError,))
+    self.assertEqual(2, len(calls))
+
+  def put(self, token, expiration):
+    self.cache.get_or_verify(
+        'kind', token, lambda: (token, self.now + expiration), ())
+
+  def put_negative(self, token):
+    def verify():
+      raise api.AuthenticationError(token)
+    with self.assertRaises(api.AuthenticationError):
+      self.cache.get_or_verify(
+          'kind', token, verify, (api.AuthenticationError,))
+
+  def test_max_size_evicts_expired(self):
+    self.put('a', 10)
+    self.put('b', 100)
+    self.put('c', 100)
+    self.now += 10
+    self.put('d', 100)
+    self.assertEqual(3, len(self.cache._entries))
+    self.assertEqual(
+        ['b', 'c', 'd'],
+        sorted(v[1] for v in self.cache._entries.itervalues()))
+
+  def test_max_size_evicts_first_to_expire(self):
+    self.put('a', 100)
+    self.put('b', 50)
+    self.put('c', 200)
+    self.put('d', 100)
+    self.assertEqual(
+        ['a', 'c', 'd'],
+        sorted(v[1] for v in self.cache._entries.itervalues()))
+
+  def test_negative_entries_do_not_evict_positive(self):
+    for token in ('a', 'b', 'c'):
+      self.put(token, 100)
+    for i in xrange(10):
+      self.put_negative('bad%d' % i)
+    self.assertEqual(3, len(self.cache._entries))
+    self.assertEqual(2, len(self.cache._negative_entries))
+
+  def test_positive_replaces_negative(self):
+    self.put_negative('tok')
+    self.now += 10
+    self.put('tok', 100)
+    self.assertEqual(1, len(self.cache._entries))
+    self.assertEqual(0, len(self.cache._negative_entries))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
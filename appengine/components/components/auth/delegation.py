@@ -570,7 +570,11 @@ def check_bearer_delegation_token(token, peer_identity):
     BadTokenError if token is invalid.
     TransientError if token can't be verified due to transient errors.
   """
-  subtoken = unseal_token(deserialize_token(token))
+  # Signature checks are expensive, cache their results. Only checks that
+  # depend solely on the token itself are cached.
+  subtoken = api.get_verified_token_cache().get_or_verify(
+      'delegation', token, lambda: _unseal_bearer_token(token),
+      (BadTokenError,))
   if subtoken.kind not in _ACCEPTABLE_DELEGATION_TOKEN_KINDS:
     raise BadTokenError('Not a valid delegation token kind: %s' % subtoken.kind)
   ident = check_subtoken(subtoken, peer_identity)
@@ -578,3 +582,13 @@ def check_bearer_delegation_token(token, peer_identity):
       'Using delegation token: subtoken_id=%s, delegated_identity=%s',
       subtoken.subtoken_id, ident.to_bytes())
   return ident
+
+
+def _unseal_bearer_token(token):
+  """Deserializes the token and checks its signature.
+
+  Returns:
+    Tuple (delegation_pb2.Subtoken, its expiration as unix timestamp).
+  """
+  subtoken = unseal_token(deserialize_token(token))
+  return subtoken, subtoken.creation_time + subtoken.validity_duration
@@ -205,6 +205,44 @@ class FullRoundtripTest(test_case.TestCase):
         blob, make_id('user:final@a.com'))
     self.assertEqual(make_id('user:initial@a.com'), ident)
 
+  def test_signature_check_is_cached(self):
+    api.reset_local_state()
+    calls = []
+    def unseal_token(tok):
+      calls.append(tok)
+      return original_unseal_token(tok)
+    original_unseal_token = self.mock(delegation, 'unseal_token', unseal_token)
+
+    tok = fake_subtoken_proto(
+        'user:initial@a.com', audience=['user:final@a.com'])
+    blob = delegation.serialize_token(delegation.seal_token(tok))
+    make_id = model.Identity.from_bytes
+    for _ in xrange(3):
+      ident = delegation.check_bearer_delegation_token(
+          blob, make_id('user:final@a.com'))
+      self.assertEqual(make_id('user:initial@a.com'), ident)
+    self.assertEqual(1, len(calls))
+
+    # Audience is still checked for cached tokens.
+    with self.assertRaises(delegation.BadTokenError):
+      delegation.check_bearer_delegation_token(
+          blob, make_id('user:another@a.com'))
+    self.assertEqual(1, len(calls))
+
+  def test_bad_token_is_cached(self):
+    api.reset_local_state()
+    calls = []
+    def unseal_token(tok):
+      calls.append(tok)
+      raise delegation.BadTokenError('bad')
+    self.mock(delegation, 'unseal_token', unseal_token)
+
+    blob = delegation.serialize_token(fake_token_proto())
+    for _ in xrange(2):
+      with self.assertRaises(delegation.BadTokenError):
+        delegation.check_bearer_delegation_token(blob, FAKE_IDENT)
+    self.assertEqual(1, len(calls))
+
 
 class CreateTokenTest(test_case.TestCase):
 
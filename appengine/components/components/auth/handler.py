@@ -7,6 +7,7 @@
 # Disable 'Method could be a function.'
 # pylint: disable=R0201
 
+import collections
 import functools
 import json
 import logging
@@ -18,6 +19,7 @@ from . import api
 from . import config
 from . import delegation
 from . import ipaddr
+from . import machine_auth
 from . import model
 from . import openid
 from . import tokens
@@ -26,15 +28,30 @@ from . import tokens
 __all__ = [
   'ApiHandler',
   'AuthenticatingHandler',
+  'AuthProfile',
+  'BOT_AUTH_PROFILE',
   'gae_cookie_authentication',
   'get_authenticated_routes',
+  'IP_WHITELIST_AUTH_PROFILE',
   'oauth_authentication',
   'openid_cookie_authentication',
   'require_xsrf_token_request',
+  'SERVICE_ACCOUNT_AUTH_PROFILE',
   'service_to_service_authentication',
 ]
 
 
+# Describes what AuthenticatingHandler does to authenticate a request. Handlers
+# that need only some kinds of callers (e.g. only bots) can set 'auth_profile'
+# to skip all other stages.
+AuthProfile = collections.namedtuple('AuthProfile', [
+  'methods',  # auth methods to try, None to use get_auth_methods()
+  'use_bots_ip_whitelist',  # True to authenticate anonymous calls as bots
+  'use_delegation',  # True to accept delegation tokens, False to reject them
+  'use_xsrf',  # True to check XSRF tokens, see xsrf_token_enforce_on
+])
+
+
 def require_xsrf_token_request(f):
   """Use for handshaking APIs."""
   @functools.wraps(f)
@@ -92,12 +109,15 @@ class AuthenticatingHandler(webapp2.RequestHandler):
   auth_method = None
   # If True, allow to use 'bots' IP whitelist to authenticate anonymous calls.
   use_bots_ip_whitelist = True
+  # If not None, AuthProfile to use instead of the attributes above.
+  auth_profile = None
 
   def dispatch(self):
     """Extracts and verifies Identity, sets up request auth context."""
     # Ensure auth component is configured before executing any code.
     conf = config.ensure_configured()
     ctx = api.reinitialize_request_cache()
+    profile = self.get_auth_profile()
 
     # http://www.html5rocks.com/en/tutorials/security/content-security-policy/
     # https://www.owasp.org/index.php/Content_Security_Policy
@@ -120,7 +140,7 @@ class AuthenticatingHandler(webapp2.RequestHandler):
       self.response.headers['X-Frame-Options'] = self.frame_options
 
     identity = None
-    for method_func in self.get_auth_methods(conf):
+    for method_func in self._get_profile_auth_methods(profile, conf):
       try:
         identity = method_func(self.request)
         if identity:
@@ -149,14 +169,17 @@ class AuthenticatingHandler(webapp2.RequestHandler):
     ip = ipaddr.ip_from_string(self.request.remote_addr)
     ctx.peer_ip = ip
 
+    # Request-scoped AuthDB used by all checks below.
+    auth_db = ctx.auth_db
+
     # Hack to allow pure IP-whitelist based authentication for bots, until they
     # are switched to use something better.
     #
     # TODO(vadimsh): Get rid of this. Blocked on Swarming and Isolate switching
     # to service accounts.
-    if self.use_bots_ip_whitelist:
+    if profile.use_bots_ip_whitelist:
       if (identity.is_anonymous and
-          api.is_in_ip_whitelist(model.BOTS_IP_WHITELIST, ip)):
+          auth_db.is_in_ip_whitelist(model.BOTS_IP_WHITELIST, ip)):
         identity = model.IP_WHITELISTED_BOT_ID
 
     ctx.peer_identity = identity
@@ -164,13 +187,17 @@ class AuthenticatingHandler(webapp2.RequestHandler):
     # Verify the caller is allowed to make calls from the given IP. It raises
     # AuthorizationError if IP is not allowed.
     try:
-      api.verify_ip_whitelisted(identity, ip)
+      auth_db.verify_ip_whitelisted(identity, ip)
     except api.AuthorizationError as err:
       self.authorization_error(err)
       return
 
     # Parse delegation token, if given, to deduce end-user identity.
     delegation_tok = self.request.headers.get(delegation.HTTP_HEADER)
+    if delegation_tok and not profile.use_delegation:
+      self.authorization_error(
+          api.AuthorizationError('Delegation tokens are not accepted here'))
+      return
     if delegation_tok:
       try:
         ctx.current_identity = delegation.check_bearer_delegation_token(
@@ -188,16 +215,18 @@ class AuthenticatingHandler(webapp2.RequestHandler):
     try:
       # Fail if XSRF token is required, but not provided.
       need_xsrf_token = (
+          profile.use_xsrf and
           not using_headers_auth and
           self.request.method in self.xsrf_token_enforce_on)
-      if need_xsrf_token and self.xsrf_token is None:
+      xsrf_token = self.xsrf_token if profile.use_xsrf else None
+      if need_xsrf_token and xsrf_token is None:
         raise api.AuthorizationError('XSRF token is missing')
 
       # If XSRF token is present, verify it is valid and extract its payload.
       # Do it even if XSRF token is not strictly required, since some handlers
       # use it to store session state (it is similar to a signed cookie).
       self.xsrf_token_data = {}
-      if self.xsrf_token is not None:
+      if xsrf_token is not None:
         # This raises AuthorizationError if token is invalid.
         try:
           self.xsrf_token_data = self.verify_xsrf_token()
@@ -214,6 +243,28 @@ class AuthenticatingHandler(webapp2.RequestHandler):
     except api.AuthorizationError as err:
       self.authorization_error(err)
 
+  @classmethod
+  def get_auth_profile(cls):
+    """Returns AuthProfile that describes how to authenticate requests.
+
+    It is 'auth_profile' if set, or a profile built from get_auth_methods()
+    and use_bots_ip_whitelist otherwise.
+    """
+    if cls.auth_profile:
+      return cls.auth_profile
+    return AuthProfile(
+        methods=None,
+        use_bots_ip_whitelist=cls.use_bots_ip_whitelist,
+        use_delegation=True,
+        use_xsrf=True)
+
+  @classmethod
+  def _get_profile_auth_methods(cls, profile, conf):
+    """Returns auth methods from |profile| or get_auth_methods()."""
+    if profile.methods is not None:
+      return profile.methods
+    return cls.get_auth_methods(conf)
+
   @classmethod
   def get_auth_methods(cls, conf):
     """Returns an enumerable of functions to use to authenticate request.
@@ -350,7 +401,9 @@ class AuthenticatingHandler(webapp2.RequestHandler):
     method = self.auth_method
     if not method:
       # Anonymous request -> pick first method that supports API.
-      for method in self.get_auth_methods(config.ensure_configured()):
+      methods = self._get_profile_auth_methods(
+          self.get_auth_profile(), config.ensure_configured())
+      for method in methods:
         if method in _METHOD_TO_USERS_API:
           break
       else:
@@ -470,6 +523,34 @@ def service_to_service_authentication(request):
     raise api.AuthenticationError('Unsupported application ID: %s' % app_id)
 
 
+################################################################################
+## Predefined auth profiles, see AuthProfile.
+
+
+# Bots authenticating with machine tokens, OAuth or via 'bots' IP whitelist.
+# They pass credentials in headers, so XSRF tokens are not needed.
+BOT_AUTH_PROFILE = AuthProfile(
+    methods=(machine_auth.machine_authentication, oauth_authentication),
+    use_bots_ip_whitelist=True,
+    use_delegation=False,
+    use_xsrf=False)
+
+# Only callers in 'bots' IP whitelist, e.g. for health checks from bots.
+IP_WHITELIST_AUTH_PROFILE = AuthProfile(
+    methods=(),
+    use_bots_ip_whitelist=True,
+    use_delegation=False,
+    use_xsrf=False)
+
+# Service accounts using OAuth, possibly acting on behalf of someone else via
+# delegation tokens.
+SERVICE_ACCOUNT_AUTH_PROFILE = AuthProfile(
+    methods=(oauth_authentication,),
+    use_bots_ip_whitelist=False,
+    use_delegation=True,
+    use_xsrf=False)
+
+
 ################################################################################
 ## API wrapper on top of Users API and OpenID API to make them similar.
 
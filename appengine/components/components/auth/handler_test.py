@@ -452,6 +452,103 @@ class AuthenticatingHandlerTest(test_case.TestCase):
         expect_errors=True)
     self.assertEqual(500, r.status_int)
 
+  def test_auth_profile_methods(self):
+    """Only methods from auth_profile are tried."""
+    ident = model.Identity(model.IDENTITY_USER, 'a@example.com')
+    calls = []
+
+    def method(name, result):
+      def call(_request):
+        calls.append(name)
+        return result
+      return call
+
+    class Handler(handler.AuthenticatingHandler):
+      auth_profile = handler.AuthProfile(
+          methods=(method('first', None), method('second', ident)),
+          use_bots_ip_whitelist=False,
+          use_delegation=False,
+          use_xsrf=False)
+
+      @classmethod
+      def get_auth_methods(cls, conf):
+        return [method('default', None)]
+
+      @api.public
+      def get(self):
+        self.response.write(api.get_current_identity().to_bytes())
+
+    app = self.make_test_app('/request', Handler)
+    self.assertEqual('user:a@example.com', app.get('/request').body)
+    self.assertEqual(['first', 'second'], calls)
+
+  def test_auth_profile_ip_whitelist_only(self):
+    """IP_WHITELIST_AUTH_PROFILE accepts only whitelisted bots."""
+    model.bootstrap_ip_whitelist('bots', ['192.168.1.100/32'])
+
+    class Handler(handler.AuthenticatingHandler):
+      auth_profile = handler.IP_WHITELIST_AUTH_PROFILE
+
+      @classmethod
+      def get_auth_methods(cls, conf):
+        self.fail('Must not be called')
+
+      @api.public
+      def get(self):
+        self.response.write(api.get_current_identity().to_bytes())
+
+    app = self.make_test_app('/request', Handler)
+    def call(ip):
+      api.reset_local_state()
+      return app.get('/request', extra_environ={'REMOTE_ADDR': ip}).body
+
+    self.assertEqual('bot:whitelisted-ip', call('192.168.1.100'))
+    self.assertEqual('anonymous:anonymous', call('127.0.0.1'))
+
+  def test_auth_profile_no_xsrf(self):
+    """XSRF tokens are not looked at if the profile disables them."""
+    calls = []
+
+    class Handler(handler.AuthenticatingHandler):
+      auth_profile = handler.IP_WHITELIST_AUTH_PROFILE
+
+      @api.public
+      def post(self):
+        calls.append(self.xsrf_token_data)
+
+    app = self.make_test_app('/request', Handler)
+    # Neither missing nor broken tokens matter.
+    app.post('/request')
+    app.post('/request', headers={'X-XSRF-Token': 'garbage'})
+    self.assertEqual([{}, {}], calls)
+
+  def test_auth_profile_no_delegation(self):
+    """Delegation tokens are rejected if the profile disables them."""
+    peer_ident = model.Identity.from_bytes('user:peer@a.com')
+
+    class Handler(handler.AuthenticatingHandler):
+      auth_profile = handler.AuthProfile(
+          methods=(lambda _request: peer_ident,),
+          use_bots_ip_whitelist=False,
+          use_delegation=False,
+          use_xsrf=False)
+
+      @api.public
+      def get(self):
+        self.response.write(api.get_current_identity().to_bytes())
+
+    def mocked_check(*_args):
+      self.fail('Must not be called')
+    self.mock(delegation, 'check_bearer_delegation_token', mocked_check)
+
+    app = self.make_test_app('/request', Handler)
+    self.assertEqual('user:peer@a.com', app.get('/request').body)
+    r = app.get(
+        '/request',
+        headers={'X-Delegation-Token-V1': 'tok'},
+        expect_errors=True)
+    self.assertEqual(403, r.status_int)
+
 
 class GaeCookieAuthenticationTest(test_case.TestCase):
   """Tests for gae_cookie_authentication function."""
@@ -4,6 +4,7 @@
 
 """Utilities for working with IPv4 and IPv6 addresses."""
 
+import bisect
 import collections
 
 
@@ -16,6 +17,7 @@ __all__ = [
   'normalize_ip',
   'normalize_subnet',
   'Subnet',
+  'SubnetSet',
   'subnet_from_string',
   'subnet_to_string',
 ]
@@ -165,3 +167,45 @@ def normalize_subnet(subnet_str):
 def is_in_subnet(ip, subnet):
   """True if given IP instance belongs to Subnet."""
   return ip.bits == subnet.bits and (ip.value & subnet.mask) == subnet.base
+
+
+class SubnetSet(object):
+  """Immutable set of IPv4 and IPv6 subnets with fast membership checks.
+
+  Subnets are merged into a sorted table of disjoint [first, last] address
+  intervals per IP version, so a check is a binary search over integers instead
+  of a linear scan over all subnets.
+  """
+
+  def __init__(self, subnets):
+    """
+    Args:
+      subnets: iterable of Subnet instances.
+    """
+    intervals = collections.defaultdict(list)
+    for subnet in subnets:
+      full = (1 << subnet.bits) - 1
+      intervals[subnet.bits].append(
+          (subnet.base, subnet.base | (full & ~subnet.mask)))
+    # bits => (sorted list of interval starts, list of interval ends).
+    self._tables = {}
+    for bits, items in intervals.iteritems():
+      items.sort()
+      starts = []
+      ends = []
+      for first, last in items:
+        if ends and first <= ends[-1] + 1:
+          ends[-1] = max(ends[-1], last)
+        else:
+          starts.append(first)
+          ends.append(last)
+      self._tables[bits] = (starts, ends)
+
+  def __contains__(self, ip):
+    """True if given IP instance belongs to any of the subnets."""
+    table = self._tables.get(ip.bits)
+    if not table:
+      return False
+    starts, ends = table
+    i = bisect.bisect_right(starts, ip.value) - 1
+    return i >= 0 and ip.value <= ends[i]
@@ -173,6 +173,62 @@ class IdentityGlobTest(test_case.TestCase):
         glob.match(model.Identity(model.IDENTITY_USER, 'a@test.com')))
 
 
+class IdentityGlobMatcherTest(test_case.TestCase):
+  """Tests for IdentityGlobMatcher class."""
+
+  def test_empty(self):
+    matcher = model.IdentityGlobMatcher([])
+    self.assertFalse(matcher)
+    self.assertFalse(
+        matcher.match(model.Identity(model.IDENTITY_USER, 'a@example.com')))
+
+  def test_same_as_fnmatch(self):
+    globs = [
+      model.IdentityGlob.from_bytes(g) for g in (
+        'user:*@example.com',
+        'user:a?c@test.com',
+        'user:[ab]*@[!x]*.com',
+        'user:a|b@test.com',
+        'user:x.y+z@test.com',
+        'bot:*-m*',
+        'bot:vm[0-9]-*',
+        'bot:[]',
+        'service:*',
+      )
+    ]
+    identities = [
+      model.Identity.from_bytes(i) for i in (
+        'user:a@example.com',
+        'user:a@example.comx',
+        'user:abc@test.com',
+        'user:abbc@test.com',
+        'user:b1@y.com',
+        'user:b1@x.com',
+        'user:a@test.com',
+        'user:x.y+z@test.com',
+        'user:xxy+z@test.com',
+        'user:x.yyz@test.com',
+        'bot:vm1-m1',
+        'bot:vm1-a',
+        'bot:vmx-a',
+        'bot:vm12',
+        'service:blah',
+        'anonymous:anonymous',
+      )
+    ]
+    matcher = model.IdentityGlobMatcher(globs)
+    self.assertTrue(matcher)
+    for identity in identities:
+      expected = any(glob.match(identity) for glob in globs)
+      self.assertEqual(expected, matcher.match(identity), identity)
+
+    # A subset of kinds.
+    matcher = model.IdentityGlobMatcher(globs[:1])
+    self.assertTrue(
+        matcher.match(model.Identity.from_bytes('user:a@example.com')))
+    self.assertFalse(matcher.match(model.Identity.from_bytes('bot:vm1-m1')))
+
+
 class AuthSecretTest(test_case.TestCase):
   """Tests for AuthSecret class."""
 
@@ -9,6 +9,7 @@ Also includes common code used by both Replica and Primary.
 
 import collections
 import hashlib
+import zlib
 
 from google.appengine.api import app_identity
 from google.appengine.api import urlfetch
@@ -30,6 +31,13 @@ LINKING_ERRORS = {
 }
 
 
+# Value of X-AuthDB-Compression-v1 header for deflated push request bodies.
+PUSH_COMPRESSION_DEFLATE = 'deflate'
+
+# How many AuthGroup entities to fetch per datastore RPC when diffing groups.
+GROUPS_BATCH_SIZE = 500
+
+
 # Returned by new_auth_db_snapshot.
 AuthDBSnapshot = collections.namedtuple(
     'AuthDBSnapshot',
@@ -117,16 +125,25 @@ def become_replica(ticket, initiated_by):
 
 
 @ndb.transactional
-def new_auth_db_snapshot():
+def new_auth_db_snapshot(skip_groups=False):
   """Makes a consistent snapshot of replicated subset of AuthDB entities.
 
+  Args:
+    skip_groups: if True, do not fetch groups, leave AuthDBSnapshot.groups
+        empty.
+
   Returns:
     Tuple (AuthReplicationState, AuthDBSnapshot).
   """
   # Start fetching stuff in parallel.
   state_future = model.replication_state_key().get_async()
   config_future = model.root_key().get_async()
-  groups_future = model.AuthGroup.query(ancestor=model.root_key()).fetch_async()
+  if skip_groups:
+    groups_future = ndb.Future()
+    groups_future.set_result([])
+  else:
+    groups_future = model.AuthGroup.query(
+        ancestor=model.root_key()).fetch_async()
   secrets_future = model.AuthSecret.query(
       ancestor=model.secret_scope_key('global')).fetch_async()
 
@@ -205,8 +222,28 @@ def auth_db_snapshot_to_proto(snapshot, auth_db_proto=None):
   return auth_db_proto
 
 
-def proto_to_auth_db_snapshot(auth_db_proto):
-  """Given replication_pb2.AuthDB message returns AuthDBSnapshot."""
+def proto_to_group(msg):
+  """Given replication_pb2.AuthGroup message returns AuthGroup entity."""
+  # Explicit conversion to 'list' is needed here since protobuf magic doesn't
+  # stack with NDB magic.
+  return model.AuthGroup(
+      key=model.group_key(msg.name),
+      members=[model.Identity.from_bytes(x) for x in msg.members],
+      globs=[model.IdentityGlob.from_bytes(x) for x in msg.globs],
+      nested=list(msg.nested),
+      description=msg.description,
+      owners=msg.owners or model.ADMIN_GROUP,
+      created_ts=utils.timestamp_to_datetime(msg.created_ts),
+      created_by=model.Identity.from_bytes(msg.created_by),
+      modified_ts=utils.timestamp_to_datetime(msg.modified_ts),
+      modified_by=model.Identity.from_bytes(msg.modified_by))
+
+
+def proto_to_auth_db_snapshot(auth_db_proto, skip_groups=False):
+  """Given replication_pb2.AuthDB message returns AuthDBSnapshot.
+
+  If |skip_groups| is True, AuthDBSnapshot.groups is left empty.
+  """
   # Explicit conversion to 'list' is needed here since protobuf magic doesn't
   # stack with NDB magic.
   global_config = model.AuthGlobalConfig(
@@ -217,20 +254,9 @@ def proto_to_auth_db_snapshot(auth_db_proto):
           auth_db_proto.oauth_additional_client_ids),
       token_server_url=auth_db_proto.token_server_url)
 
-  groups = [
-    model.AuthGroup(
-        key=model.group_key(msg.name),
-        members=[model.Identity.from_bytes(x) for x in msg.members],
-        globs=[model.IdentityGlob.from_bytes(x) for x in msg.globs],
-        nested=list(msg.nested),
-        description=msg.description,
-        owners=msg.owners or model.ADMIN_GROUP,
-        created_ts=utils.timestamp_to_datetime(msg.created_ts),
-        created_by=model.Identity.from_bytes(msg.created_by),
-        modified_ts=utils.timestamp_to_datetime(msg.modified_ts),
-        modified_by=model.Identity.from_bytes(msg.modified_by))
-    for msg in auth_db_proto.groups
-  ]
+  groups = []
+  if not skip_groups:
+    groups = [proto_to_group(msg) for msg in auth_db_proto.groups]
 
   secrets = [
     model.AuthSecret(
@@ -292,7 +318,38 @@ def get_deleted_keys(new_entity_list, old_entity_list):
   return [old.key for old in old_entity_list if old.key not in new_by_key]
 
 
-def replace_auth_db(auth_db_rev, modified_ts, snapshot):
+def diff_groups(new_groups, to_entity):
+  """Compares groups with ones in datastore.
+
+  Existing groups are fetched in batches and new groups are converted to
+  entities one by one, so only changed groups are kept in memory.
+
+  Args:
+    new_groups: dict {group name -> object that describes the group}.
+    to_entity: function that converts such object to AuthGroup entity.
+
+  Returns:
+    Tuple (list of changed or added AuthGroup entities, list of keys to delete).
+  """
+  pending = dict(new_groups)
+  entites_to_put = []
+  keys_to_delete = []
+  q = model.AuthGroup.query(ancestor=model.root_key())
+  # Keep fetched batches out of the context cache, regardless of the context
+  # cache policy, so they can be garbage collected.
+  for current in q.iter(batch_size=GROUPS_BATCH_SIZE, use_cache=False):
+    obj = pending.pop(current.key.id(), None)
+    if obj is None:
+      keys_to_delete.append(current.key)
+      continue
+    new_entity = to_entity(obj)
+    if new_entity.to_dict() != current.to_dict():
+      entites_to_put.append(new_entity)
+  entites_to_put.extend(to_entity(obj) for obj in pending.itervalues())
+  return entites_to_put, keys_to_delete
+
+
+def replace_auth_db(auth_db_rev, modified_ts, snapshot, group_msgs=None):
   """Replaces AuthDB in datastore if it's older than |auth_db_rev|.
 
   May return False in case of race conditions (i.e. if some other concurrent
@@ -302,6 +359,9 @@ def replace_auth_db(auth_db_rev, modified_ts, snapshot):
     auth_db_rev: revision number of |snapshot|.
     modified_ts: datetime timestamp of when |auth_db_rev| was created.
     snapshot: AuthDBSnapshot with entity to store.
+    group_msgs: if not None, a list of replication_pb2.AuthGroup messages to
+        store instead of snapshot.groups. They are converted to entities
+        lazily, to avoid having all groups in memory twice.
 
   Returns:
     Tuple (True if update was applied, current AuthReplicationState value).
@@ -317,13 +377,22 @@ def replace_auth_db(auth_db_rev, modified_ts, snapshot):
     return False, current_state
 
   # Make a snapshot of existing state of AuthDB to figure out what to change.
-  current_state, current = new_auth_db_snapshot()
+  # Groups are diffed separately, without loading all of them at once. If they
+  # are changed after the snapshot is made, auth_db_rev changes too and the
+  # transaction below backs off.
+  current_state, current = new_auth_db_snapshot(skip_groups=True)
+  if group_msgs is None:
+    groups_to_put, groups_to_delete = diff_groups(
+        {g.key.id(): g for g in snapshot.groups}, lambda g: g)
+  else:
+    groups_to_put, groups_to_delete = diff_groups(
+        {msg.name: msg for msg in group_msgs}, proto_to_group)
 
   # Entities that needs to be updated or created.
   entites_to_put = []
   if snapshot.global_config.to_dict() != current.global_config.to_dict():
     entites_to_put.append(snapshot.global_config)
-  entites_to_put.extend(get_changed_entities(snapshot.groups, current.groups))
+  entites_to_put.extend(groups_to_put)
   entites_to_put.extend(get_changed_entities(snapshot.secrets, current.secrets))
   entites_to_put.extend(
       get_changed_entities(snapshot.ip_whitelists, current.ip_whitelists))
@@ -334,7 +403,7 @@ def replace_auth_db(auth_db_rev, modified_ts, snapshot):
 
   # Keys of entities that needs to be removed.
   keys_to_delete = []
-  keys_to_delete.extend(get_deleted_keys(snapshot.groups, current.groups))
+  keys_to_delete.extend(groups_to_delete)
   keys_to_delete.extend(get_deleted_keys(snapshot.secrets, current.secrets))
   keys_to_delete.extend(
       get_deleted_keys(snapshot.ip_whitelists, current.ip_whitelists))
@@ -370,6 +439,117 @@ def replace_auth_db(auth_db_rev, modified_ts, snapshot):
   return update_auth_db()
 
 
+@ndb.transactional
+def apply_auth_db_delta(
+    auth_db_rev, modified_ts, base_auth_db_rev, snapshot,
+    deleted_groups, deleted_ip_whitelists):
+  """Applies a difference between two revisions of AuthDB to datastore.
+
+  Unlike replace_auth_db it doesn't look at all groups and IP whitelists, only
+  at ones mentioned in the delta, so it is much cheaper for large AuthDBs.
+
+  Args:
+    auth_db_rev: revision number AuthDB will have after the delta is applied.
+    modified_ts: datetime timestamp of when |auth_db_rev| was created.
+    base_auth_db_rev: revision the delta was calculated against.
+    snapshot: AuthDBSnapshot with global config, all global secrets, all IP
+        whitelist assignments and only added or modified groups and IP
+        whitelists.
+    deleted_groups: names of groups to remove.
+    deleted_ip_whitelists: names of IP whitelists to remove.
+
+  Returns:
+    Tuple (True if update was applied, current AuthReplicationState value).
+    The update is not applied if current revision is not |base_auth_db_rev|.
+  """
+  assert model.is_replica()
+  assert all(
+      secret.key.parent() == model.secret_scope_key('global')
+      for secret in snapshot.secrets), 'Only global secrets can be replaced'
+
+  state = model.get_replication_state()
+  if state.auth_db_rev != base_auth_db_rev:
+    return False, state
+
+  # Global config, IP whitelist assignments and global secrets are always sent
+  # in full, since they are small. Compare them to existing values to avoid
+  # useless writes.
+  secrets_future = model.AuthSecret.query(
+      ancestor=model.secret_scope_key('global')).fetch_async()
+  global_config, ip_whitelist_assignments = ndb.get_multi([
+    model.root_key(),
+    model.ip_whitelist_assignments_key(),
+  ])
+  current_secrets = secrets_future.get_result()
+
+  # Entities that needs to be updated or created.
+  entites_to_put = []
+  if (not global_config or
+      snapshot.global_config.to_dict() != global_config.to_dict()):
+    entites_to_put.append(snapshot.global_config)
+  entites_to_put.extend(snapshot.groups)
+  entites_to_put.extend(get_changed_entities(snapshot.secrets, current_secrets))
+  entites_to_put.extend(snapshot.ip_whitelists)
+  new_ips = snapshot.ip_whitelist_assignments
+  if (not ip_whitelist_assignments or
+      new_ips.to_dict() != ip_whitelist_assignments.to_dict()):
+    entites_to_put.append(new_ips)
+
+  # Keys of entities that needs to be removed.
+  keys_to_delete = []
+  keys_to_delete.extend(model.group_key(name) for name in deleted_groups)
+  keys_to_delete.extend(get_deleted_keys(snapshot.secrets, current_secrets))
+  keys_to_delete.extend(
+      model.ip_whitelist_key(name) for name in deleted_ip_whitelists)
+
+  # Update auth_db_rev in AuthReplicationState.
+  state.auth_db_rev = auth_db_rev
+  state.modified_ts = modified_ts
+
+  # Apply changes, raising an exception (and thus aborting the transaction), if
+  # any of them fail.
+  futures = []
+  futures.extend(ndb.put_multi_async([state] + entites_to_put))
+  futures.extend(ndb.delete_multi_async(keys_to_delete))
+  ndb.Future.wait_all(futures)
+  for future in futures:
+    future.check_success()
+  return True, state
+
+
+def compress_push_body(body, compression):
+  """Compresses serialized ReplicationPushRequest before sending it.
+
+  Args:
+    body: serialized ReplicationPushRequest.
+    compression: None or PUSH_COMPRESSION_DEFLATE.
+
+  Returns:
+    Compressed body.
+  """
+  if not compression:
+    return body
+  if compression == PUSH_COMPRESSION_DEFLATE:
+    return zlib.compress(body)
+  raise ValueError('Unsupported compression: %r' % compression)
+
+
+def decompress_push_body(body, compression):
+  """Reverses compress_push_body.
+
+  Raises:
+    ValueError if |compression| is not supported or |body| is broken.
+  """
+  if not compression:
+    return body
+  if compression == PUSH_COMPRESSION_DEFLATE:
+    try:
+      return zlib.decompress(body)
+    except zlib.error as exc:
+      raise ValueError('Failed to inflate the body: %s' % exc)
+  raise ValueError('Unsupported compression: %r' % compression)
+
+
 def is_signed_by_primary(blob, key_name, sig):
   """Verifies that |blob| was signed by Primary."""
   # Assert that running on Replica.
@@ -399,13 +579,15 @@ def push_auth_db(revision, auth_db):
     return False, state
 
   # Try to apply it, retry until success (or until some other task applies
-  # an even newer version of auth_db).
-  snapshot = proto_to_auth_db_snapshot(auth_db)
+  # an even newer version of auth_db). Groups are converted to entities only
+  # when diffing, see replace_auth_db.
+  snapshot = proto_to_auth_db_snapshot(auth_db, skip_groups=True)
   while True:
     applied, current_state = replace_auth_db(
         revision.auth_db_rev,
         utils.timestamp_to_datetime(revision.modified_ts),
-        snapshot)
+        snapshot,
+        auth_db.groups)
 
     # Update was successfully applied.
     if applied:
@@ -417,3 +599,35 @@ def push_auth_db(revision, auth_db):
 
     # Need to retry. Try until success or deadline.
     assert current_state.auth_db_rev < revision.auth_db_rev
+
+
+def push_auth_db_delta(revision, auth_db_delta):
+  """Accepts AuthDB delta push from Primary and applies it to replica.
+
+  Args:
+    revision: replication_pb2.AuthDBRevision describing revision of pushed DB.
+    auth_db_delta: replication_pb2.AuthDBDelta with changes since some older
+        revision.
+
+  Returns:
+    Tuple (True if update was applied, stored or updated AuthReplicationState).
+    If the update wasn't applied and the returned state is still older than
+    |revision|, the replica is not at the base revision of the delta, and
+    Primary should push an entire AuthDB instead.
+  """
+  # Already up-to-date? Check it first before doing heavy calls.
+  state = model.get_replication_state()
+  if state.primary_id != revision.primary_id:
+    return False, state
+  if state.auth_db_rev >= revision.auth_db_rev:
+    return False, state
+  if state.auth_db_rev != auth_db_delta.base_auth_db_rev:
+    return False, state
+
+  return apply_auth_db_delta(
+      revision.auth_db_rev,
+      utils.timestamp_to_datetime(revision.modified_ts),
+      auth_db_delta.base_auth_db_rev,
+      proto_to_auth_db_snapshot(auth_db_delta.changed),
+      list(auth_db_delta.deleted_groups),
+      list(auth_db_delta.deleted_ip_whitelists))
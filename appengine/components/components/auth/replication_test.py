@@ -15,6 +15,7 @@ from google.appengine.ext import ndb
 from components import utils
 from components.auth import model
 from components.auth import replication
+from components.auth.proto import replication_pb2
 from test_support import test_case
 
 
@@ -674,6 +675,189 @@ class ReplaceAuthDbTest(test_case.TestCase):
     self.assertEqual(expected_state, state.to_dict())
 
 
+
+class PushAuthDBTest(test_case.TestCase):
+  """Tests for push_auth_db function."""
+
+  def setUp(self):
+    super(PushAuthDBTest, self).setUp()
+    self.mock_now(datetime.datetime(2014, 1, 1, 1, 1, 1))
+    model.AuthReplicationState(
+        key=model.replication_state_key(),
+        primary_id='primary',
+        primary_url='https://primary',
+        auth_db_rev=1,
+        modified_ts=utils.utcnow()).put()
+
+  def test_many_groups(self):
+    # Diff groups in multiple batches.
+    self.mock(replication, 'GROUPS_BATCH_SIZE', 3)
+
+    def group(name, description=''):
+      return model.AuthGroup(
+          key=model.group_key(name),
+          description=description,
+          created_ts=utils.utcnow(),
+          created_by=model.Identity.from_bytes('user:a@example.com'),
+          modified_ts=utils.utcnow(),
+          modified_by=model.Identity.from_bytes('user:a@example.com'))
+    ndb.put_multi([group('group-%02d' % i) for i in xrange(20)])
+
+    # Odd groups are removed, every fourth group is modified, some are added.
+    new_groups = [
+      group('group-%02d' % i, 'modified' if i % 4 == 0 else '')
+      for i in xrange(0, 30, 2)
+    ]
+    auth_db = replication.auth_db_snapshot_to_proto(
+        make_snapshot_obj(groups=new_groups))
+    revision = replication_pb2.AuthDBRevision(
+        primary_id='primary',
+        auth_db_rev=2,
+        modified_ts=utils.datetime_to_timestamp(utils.utcnow()))
+
+    applied, state = replication.push_auth_db(revision, auth_db)
+    self.assertTrue(applied)
+    self.assertEqual(2, state.auth_db_rev)
+
+    _, snapshot = replication.new_auth_db_snapshot()
+    self.assertEqual(
+        [entity_to_dict(g) for g in new_groups],
+        [entity_to_dict(g) for g in snapshot.groups])
+
+
+class PushBodyCompressionTest(test_case.TestCase):
+  """Tests for compress_push_body and decompress_push_body."""
+
+  def test_roundtrip(self):
+    body = 'blah' * 1000
+    for compression in (None, replication.PUSH_COMPRESSION_DEFLATE):
+      compressed = replication.compress_push_body(body, compression)
+      self.assertEqual(
+          body, replication.decompress_push_body(compressed, compression))
+    self.assertLess(
+        len(replication.compress_push_body(
+            body, replication.PUSH_COMPRESSION_DEFLATE)),
+        len(body))
+
+  def test_bad_body(self):
+    with self.assertRaises(ValueError):
+      replication.decompress_push_body(
+          'not deflated', replication.PUSH_COMPRESSION_DEFLATE)
+
+  def test_unknown_compression(self):
+    with self.assertRaises(ValueError):
+      replication.decompress_push_body('blah', 'lzma')
+
+
+class PushAuthDBDeltaTest(test_case.TestCase):
+  """Tests for push_auth_db_delta function."""
+
+  def setUp(self):
+    super(PushAuthDBDeltaTest, self).setUp()
+    self.mock_now(datetime.datetime(2014, 1, 1, 1, 1, 1))
+    model.AuthReplicationState(
+        key=model.replication_state_key(),
+        primary_id='primary',
+        primary_url='https://primary',
+        auth_db_rev=10,
+        modified_ts=utils.utcnow()).put()
+    for name in ('Modify', 'Delete', 'Keep'):
+      self.group(name).put()
+    for name in ('modify', 'delete', 'keep'):
+      self.ip_whitelist(name).put()
+    self.secret('keep').put()
+    self.secret('delete').put()
+
+  @staticmethod
+  def group(name, **kwargs):
+    return model.AuthGroup(
+        key=model.group_key(name),
+        created_ts=utils.utcnow(),
+        created_by=model.Identity.from_bytes('user:a@example.com'),
+        modified_ts=utils.utcnow(),
+        modified_by=model.Identity.from_bytes('user:a@example.com'),
+        **kwargs)
+
+  @staticmethod
+  def ip_whitelist(name, **kwargs):
+    return model.AuthIPWhitelist(
+        key=model.ip_whitelist_key(name),
+        created_ts=utils.utcnow(),
+        created_by=model.Identity.from_bytes('user:a@example.com'),
+        modified_ts=utils.utcnow(),
+        modified_by=model.Identity.from_bytes('user:a@example.com'),
+        **kwargs)
+
+  @staticmethod
+  def secret(name, **kwargs):
+    return model.AuthSecret(
+        id=name,
+        parent=model.secret_scope_key('global'),
+        modified_ts=utils.utcnow(),
+        modified_by=model.Identity.from_bytes('user:a@example.com'),
+        **kwargs)
+
+  def make_delta(self, base_auth_db_rev):
+    changed = make_snapshot_obj(
+        global_config=model.AuthGlobalConfig(
+            key=model.root_key(), oauth_client_id='new_client_id'),
+        groups=[
+          self.group('New'),
+          self.group('Modify', description='modified'),
+        ],
+        secrets=[self.secret('keep'), self.secret('new', values=['1'])],
+        ip_whitelists=[self.ip_whitelist('modify', subnets=['1.1.1.1/32'])])
+    delta = replication_pb2.AuthDBDelta()
+    delta.base_auth_db_rev = base_auth_db_rev
+    replication.auth_db_snapshot_to_proto(changed, delta.changed)
+    delta.deleted_groups.append('Delete')
+    delta.deleted_ip_whitelists.append('delete')
+    return delta
+
+  @staticmethod
+  def make_revision(auth_db_rev, primary_id='primary'):
+    return replication_pb2.AuthDBRevision(
+        primary_id=primary_id,
+        auth_db_rev=auth_db_rev,
+        modified_ts=utils.datetime_to_timestamp(utils.utcnow()))
+
+  def test_works(self):
+    applied, state = replication.push_auth_db_delta(
+        self.make_revision(12), self.make_delta(10))
+    self.assertTrue(applied)
+    self.assertEqual(12, state.auth_db_rev)
+
+    _, snapshot = replication.new_auth_db_snapshot()
+    self.assertEqual('new_client_id', snapshot.global_config.oauth_client_id)
+    self.assertEqual(
+        ['Keep', 'Modify', 'New'], [g.key.id() for g in snapshot.groups])
+    self.assertEqual('modified', snapshot.groups[1].description)
+    self.assertEqual(
+        ['keep', 'new'], [s.key.id() for s in snapshot.secrets])
+    self.assertEqual(
+        ['keep', 'modify'], [l.key.id() for l in snapshot.ip_whitelists])
+    self.assertEqual(['1.1.1.1/32'], snapshot.ip_whitelists[1].subnets)
+
+  def test_wrong_base_revision(self):
+    applied, state = replication.push_auth_db_delta(
+        self.make_revision(12), self.make_delta(9))
+    self.assertFalse(applied)
+    self.assertEqual(10, state.auth_db_rev)
+    self.assertTrue(model.group_key('Delete').get())
+
+  def test_already_up_to_date(self):
+    applied, state = replication.push_auth_db_delta(
+        self.make_revision(10), self.make_delta(9))
+    self.assertFalse(applied)
+    self.assertEqual(10, state.auth_db_rev)
+
+  def test_another_primary(self):
+    applied, state = replication.push_auth_db_delta(
+        self.make_revision(12, primary_id='another'), self.make_delta(10))
+    self.assertFalse(applied)
+    self.assertEqual(10, state.auth_db_rev)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -11,7 +11,6 @@ functions, and thus private keys are managed by GAE.
 import base64
 import json
 import logging
-import random
 import threading
 import urllib
 
@@ -34,12 +33,23 @@ __all__ = [
 ]
 
 
-# For how long to cache the certificates. Due to the way how local memory cache
-# and memcache are used, the actual expiration time can be up to 2 times larger.
-# This is fine, since certs lifetime are usually 12h or more.
+# For how long to cache the certificates. This is fine, since certs lifetime
+# are usually 12h or more.
 _CERTS_CACHE_EXP_SEC = 3600
-
-_certs_cache = {} # cache key => (CertificateBundle, cache expiration time)
+# Cached certificates are refreshed that long before they expire. Only one
+# thread does the refresh, others keep using the cached copy meanwhile.
+_CERTS_REFRESH_AHEAD_SEC = 360
+# If a refresh fails with a transient error, how long to wait before trying
+# again. The cached copy is used meanwhile.
+_CERTS_REFRESH_RETRY_SEC = 60
+# For how long expired certificates can be used if they can't be refreshed.
+_CERTS_MAX_STALENESS_SEC = 12 * 3600
+
+# Cache key => (CertificateBundle, cache expiration time, next refresh time).
+_certs_cache = {}
+# Cache keys being refreshed by some thread right now.
+_certs_refreshing = set()
+# Protects _certs_cache and _certs_refreshing.
 _certs_cache_lock = threading.Lock()
 
 
@@ -72,7 +82,9 @@ class CertificateBundle(object):
     'timestamp': 123354545
   }
 
-  This object caches parsed public keys internally.
+  This object caches parsed public keys internally. Bundles returned by
+  get_service_public_certificates and get_service_account_certificates have
+  them parsed in advance.
   """
 
   def __init__(self, jsonish):
@@ -136,6 +148,32 @@ class CertificateBundle(object):
     """
     # Lazy import Crypto, since not all service that use 'auth' may need it.
     from Crypto.Hash import SHA256
+    verifier = self._get_verifier(key_name)
+    return verifier.verify(SHA256.new(blob), signature)
+
+  def preparse(self):
+    """Parses public keys of all certificates, to make check_signature faster.
+
+    Certificates that can't be parsed are skipped, check_signature reports
+    errors about them.
+    """
+    try:
+      import Crypto # pylint: disable=unused-variable
+    except ImportError:
+      return
+    for cert in self._jsonish['certificates']:
+      try:
+        self._get_verifier(cert['key_name'])
+      except Exception as exc:
+        logging.warning(
+            'Failed to parse certificate %r: %s', cert['key_name'], exc)
+
+  def _get_verifier(self, key_name):
+    """Returns PKCS1_v1_5 verifier for the given key, parsing it if necessary.
+
+    Raises:
+      CertificateError if no such key or the certificate is invalid.
+    """
     from Crypto.PublicKey import RSA
     from Crypto.Signature import PKCS1_v1_5
     from Crypto.Util import asn1
@@ -181,7 +219,7 @@ class CertificateBundle(object):
         verifier = PKCS1_v1_5.new(RSA.importKey(subjectPublicKeyInfo))
         self._verifiers[key_name] = verifier
 
-    return verifier.verify(SHA256.new(blob), signature)
+    return verifier
 
 
 def sign_blob(blob, deadline=None):
@@ -346,37 +384,65 @@ def _fetch_robot_certs(service_account_name):
 def _use_cached_or_fetch(cache_key, fetch_cb):
   """Implements caching layer for the public certificates.
 
-  Caches certificate in both memcache and local instance memory. Uses
-  probabilistic early expiration to avoid hitting the backend from multiple
-  request handlers simultaneously when cache expires.
+  Caches certificate in both memcache and local instance memory. Certificates
+  in local memory are refreshed a bit before they expire by a single thread,
+  other threads keep using the cached copy meanwhile. If the refresh fails with
+  a transient error, the cached copy is used (even if it has expired, but for
+  no longer than _CERTS_MAX_STALENESS_SEC).
 
   'fetch_cb' is expected to return a dict to be passed to CertificateBundle
   constructor.
   """
-  # Try local memory first.
   now = utils.time_time()
+  usable = False
   with _certs_cache_lock:
-    if cache_key in _certs_cache:
-      certs, exp = _certs_cache[cache_key]
-      if exp > now + 0.1 * _CERTS_CACHE_EXP_SEC * random.random():
+    certs, exp, refresh = _certs_cache.get(cache_key, (None, None, None))
+    if certs:
+      usable = now < exp + _CERTS_MAX_STALENESS_SEC
+      if usable and (now < refresh or cache_key in _certs_refreshing):
         return certs
+      _certs_refreshing.add(cache_key)
+
+  # Multiple concurrent fetches are possible if there's nothing cached yet, but
+  # it's not a big deal. The last one wins.
+  try:
+    return _fetch_and_cache_certs(cache_key, fetch_cb, now)
+  except CertificateError as exc:
+    if not certs or not usable or not exc.transient:
+      raise
+    logging.warning(
+        'Failed to refresh certificates (%s), using cached ones: %s',
+        cache_key, exc)
+    with _certs_cache_lock:
+      _certs_cache[cache_key] = (certs, exp, now + _CERTS_REFRESH_RETRY_SEC)
+    return certs
+  finally:
+    if certs:
+      with _certs_cache_lock:
+        _certs_refreshing.discard(cache_key)
+
 
-  # Try memcache now. Use same trick with random early expiration.
+def _fetch_and_cache_certs(cache_key, fetch_cb, now):
+  """Grabs certificates from memcache or via 'fetch_cb', caches them locally.
+
+  Returns:
+    CertificateBundle with public keys already parsed.
+  """
+  # Try memcache first, unless the entry there is due for refresh too.
+  certs_dict = None
   entry = memcache.get(cache_key)
   if entry:
     certs_dict, exp = entry
-    if exp > now + 0.1 * _CERTS_CACHE_EXP_SEC * random.random():
-      certs = CertificateBundle(certs_dict)
-      with _certs_cache_lock:
-        _certs_cache[cache_key] = (certs, now + _CERTS_CACHE_EXP_SEC)
-      return certs
-
-  # Multiple concurrent fetches are possible, but it's not a big deal. The last
-  # one wins.
-  certs_dict = fetch_cb()
-  exp = now + _CERTS_CACHE_EXP_SEC
-  memcache.set(cache_key, (certs_dict, exp), time=exp)
+    if exp <= now + _CERTS_REFRESH_AHEAD_SEC:
+      certs_dict = None
+  if certs_dict is None:
+    certs_dict = fetch_cb()
+    exp = now + _CERTS_CACHE_EXP_SEC
+    memcache.set(cache_key, (certs_dict, exp), time=exp)
+
+  # Parse the keys now, outside of the lock and before any request needs them.
   certs = CertificateBundle(certs_dict)
+  certs.preparse()
   with _certs_cache_lock:
-    _certs_cache[cache_key] = (certs, exp)
+    _certs_cache[cache_key] = (certs, exp, exp - _CERTS_REFRESH_AHEAD_SEC)
   return certs
@@ -5,7 +5,6 @@
 
 import collections
 import datetime
-import random
 import sys
 import unittest
 
@@ -35,6 +34,11 @@ FAKE_SERVICE_ACCOUNT_CERTS = """
 """
 
 class SignatureTest(test_case.TestCase):
+  def setUp(self):
+    super(SignatureTest, self).setUp()
+    self.mock(signature, '_certs_cache', {})
+    self.mock(signature, '_certs_refreshing', set())
+
   def test_get_service_account_certificates(self):
     def do_fetch(url, **_kwargs):
       self.assertEqual(
@@ -61,22 +65,79 @@ class SignatureTest(test_case.TestCase):
 
   def test_caching(self):
     now = datetime.datetime(2014, 2, 2, 3, 4, 5)
-
-    self.mock(random, 'random', lambda: 1.0)
     self.mock_now(now)
 
     def fetch():
-      return signature._use_cached_or_fetch('cache_key', lambda: {})
+      return signature._use_cached_or_fetch(
+          'cache_key', lambda: {'certificates': []})
 
     # Fetch one. It gets put into cache. On the second fetch get exact same one.
     certs = fetch()
     self.assertTrue(fetch() is certs)
 
-    # Some time later cache expires. This happens slightly earlier than
-    # _CERTS_CACHE_EXP_SEC due to randomized early expiration.
+    # Some time later cache is refreshed. This happens _CERTS_REFRESH_AHEAD_SEC
+    # earlier than _CERTS_CACHE_EXP_SEC.
     self.mock_now(now, 3600 - 360 + 1)
     self.assertFalse(fetch() is certs)
 
+  def test_refresh_by_another_thread(self):
+    now = datetime.datetime(2014, 2, 2, 3, 4, 5)
+    self.mock_now(now)
+    certs = signature._use_cached_or_fetch(
+        'cache_key', lambda: {'certificates': []})
+
+    # While some other thread refreshes the certs, the cached copy is used.
+    self.mock_now(now, 3600 - 360 + 1)
+    signature._certs_refreshing.add('cache_key')
+    self.assertTrue(
+        signature._use_cached_or_fetch('cache_key', self.fail) is certs)
+
+  def test_stale_on_transient_error(self):
+    now = datetime.datetime(2014, 2, 2, 3, 4, 5)
+    self.mock_now(now)
+    certs = signature._use_cached_or_fetch(
+        'cache_key', lambda: {'certificates': []})
+
+    calls = []
+    def fetch_cb():
+      calls.append(1)
+      raise signature.CertificateError('boom', transient=True)
+    fetch = lambda: signature._use_cached_or_fetch('cache_key', fetch_cb)
+
+    # The refresh fails, the cached copy is used, even after it expires.
+    self.mock_now(now, 3600 - 360 + 1)
+    self.assertTrue(fetch() is certs)
+    self.assertEqual(1, len(calls))
+    # No retries for a while.
+    self.assertTrue(fetch() is certs)
+    self.assertEqual(1, len(calls))
+    self.mock_now(now, 3600 + 1)
+    self.assertTrue(fetch() is certs)
+    self.assertEqual(2, len(calls))
+    self.assertFalse(signature._certs_refreshing)
+
+    # Too stale to be used.
+    self.mock_now(now, 3600 + 12 * 3600)
+    with self.assertRaises(signature.CertificateError):
+      fetch()
+
+  def test_fatal_error_not_masked(self):
+    now = datetime.datetime(2014, 2, 2, 3, 4, 5)
+    self.mock_now(now)
+    signature._use_cached_or_fetch('cache_key', lambda: {'certificates': []})
+
+    def fetch_cb():
+      raise signature.CertificateError('boom', transient=False)
+    self.mock_now(now, 3600 - 360 + 1)
+    with self.assertRaises(signature.CertificateError):
+      signature._use_cached_or_fetch('cache_key', fetch_cb)
+
+  def test_transient_error_without_cache(self):
+    def fetch_cb():
+      raise signature.CertificateError('boom', transient=True)
+    with self.assertRaises(signature.CertificateError):
+      signature._use_cached_or_fetch('cache_key', fetch_cb)
+
   if has_pycrypto:
     def test_check_signature_correct(self):
       blob = '123456789'
@@ -98,6 +159,21 @@ class SignatureTest(test_case.TestCase):
       with self.assertRaises(signature.CertificateError):
         certs.check_signature('blob', 'wrong-key', 'sig')
 
+    def test_preparse(self):
+      blob = '123456789'
+      key_name, sig = signature.sign_blob(blob)
+      jsonish = signature.get_own_public_certificates().to_jsonish()
+      jsonish = dict(jsonish, certificates=jsonish['certificates'] + [
+        {'key_name': 'broken', 'x509_certificate_pem': 'zzz'},
+      ])
+      certs = signature.CertificateBundle(jsonish)
+      certs.preparse()
+      self.assertIn(key_name, certs._verifiers)
+      self.assertNotIn('broken', certs._verifiers)
+      self.assertTrue(certs.check_signature(blob, key_name, sig))
+      with self.assertRaises(signature.CertificateError):
+        certs.check_signature(blob, 'broken', sig)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -740,10 +740,12 @@ class ReplicationHandler(handler.AuthenticatingHandler):
     self.response.headers['Content-Type'] = 'application/octet-stream'
     self.response.write(response.SerializeToString())
 
-  def send_error(self, error_code):
-    """Sends ReplicationPushResponse with fatal error as a response."""
+  def send_error(
+      self, error_code,
+      status=replication_pb2.ReplicationPushResponse.FATAL_ERROR):
+    """Sends ReplicationPushResponse with an error as a response."""
     response = replication_pb2.ReplicationPushResponse()
-    response.status = replication_pb2.ReplicationPushResponse.FATAL_ERROR
+    response.status = status
     response.error_code = error_code
     response.auth_code_version = version.__version__
     self.send_response(response)
@@ -777,9 +779,20 @@ class ReplicationHandler(handler.AuthenticatingHandler):
       self.send_error(replication_pb2.ReplicationPushResponse.BAD_SIGNATURE)
       return
 
+    # The signature covers the body as it was sent, i.e. possibly compressed.
+    try:
+      body = replication.decompress_push_body(
+          body, self.request.headers.get('X-AuthDB-Compression-v1'))
+    except ValueError as exc:
+      logging.error('Bad push body: %s', exc)
+      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+      return
+
     # Deserialize the request, check it is valid.
     request = replication_pb2.ReplicationPushRequest.FromString(body)
-    if not request.HasField('revision') or not request.HasField('auth_db'):
+    has_auth_db = request.HasField('auth_db')
+    has_delta = request.HasField('auth_db_delta')
+    if not request.HasField('revision') or has_auth_db == has_delta:
       self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
       return
 
@@ -788,7 +801,23 @@ class ReplicationHandler(handler.AuthenticatingHandler):
     if request.HasField('auth_code_version'):
       logging.info(
           'Primary\'s auth component version: %s', request.auth_code_version)
-    applied, state = replication.push_auth_db(request.revision, request.auth_db)
+    if has_delta:
+      logging.info(
+          'The push is a delta since rev %d',
+          request.auth_db_delta.base_auth_db_rev)
+      applied, state = replication.push_auth_db_delta(
+          request.revision, request.auth_db_delta)
+      # Replica is not at the base revision, ask Primary for an entire AuthDB.
+      if not applied and state.auth_db_rev < request.revision.auth_db_rev:
+        logging.warning(
+            'Can\'t apply the delta, current rev is %d', state.auth_db_rev)
+        self.send_error(
+            replication_pb2.ReplicationPushResponse.BAD_BASE_REVISION,
+            replication_pb2.ReplicationPushResponse.TRANSIENT_ERROR)
+        return
+    else:
+      applied, state = replication.push_auth_db(
+          request.revision, request.auth_db)
     logging.info(
         'AuthDB push %s: rev is %d',
         'applied' if applied else 'skipped', state.auth_db_rev)
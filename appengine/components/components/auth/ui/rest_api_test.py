@@ -6,10 +6,12 @@
 # Disable 'Method could be a function.'
 # pylint: disable=R0201
 
+import base64
 import json
 import logging
 import sys
 import unittest
+import zlib
 
 from test_support import test_env
 test_env.setup_test_env()
@@ -23,7 +25,9 @@ from components import utils
 from components.auth import api
 from components.auth import handler
 from components.auth import model
+from components.auth import replication
 from components.auth import version
+from components.auth.proto import replication_pb2
 from components.auth.ui import acl
 from components.auth.ui import rest_api
 from components.auth.ui import ui
@@ -1941,6 +1945,201 @@ class ServerStateHandlerTest(RestAPITestCase):
     self.assertEqual(expected, body)
 
 
+class ReplicationHandlerTest(test_case.TestCase):
+  """Tests for ReplicationHandler, i.e. AuthDB pushes from Primary."""
+
+  def setUp(self):
+    super(ReplicationHandlerTest, self).setUp()
+    api.reset_local_state()
+    mock_replication_state('https://primary')
+    # Blobs the signature was checked against.
+    self.signed_blobs = []
+    def is_signed_by_primary(blob, key_name, sig):
+      self.signed_blobs.append(blob)
+      return key_name == 'key' and sig == 'sig'
+    self.mock(replication, 'is_signed_by_primary', is_signed_by_primary)
+
+  @staticmethod
+  def make_auth_db(*groups):
+    """Returns replication_pb2.AuthDB with given (empty) groups."""
+    auth_db = replication_pb2.AuthDB(
+        oauth_client_id='client_id',
+        oauth_client_secret='client_secret')
+    for name in groups:
+      auth_db.groups.add(
+          name=name,
+          description='',
+          created_ts=1,
+          created_by='user:someone@example.com',
+          modified_ts=1,
+          modified_by='user:someone@example.com')
+    return auth_db
+
+  @staticmethod
+  def make_request(auth_db_rev, auth_db=None, auth_db_delta=None):
+    """Returns replication_pb2.ReplicationPushRequest for given revision."""
+    request = replication_pb2.ReplicationPushRequest()
+    request.revision.primary_id = 'mocked-primary'
+    request.revision.auth_db_rev = auth_db_rev
+    request.revision.modified_ts = 1483326245000000
+    request.auth_code_version = version.__version__
+    if auth_db:
+      request.auth_db.CopyFrom(auth_db)
+    if auth_db_delta:
+      request.auth_db_delta.CopyFrom(auth_db_delta)
+    return request
+
+  def push(self, body, sig='sig', headers=None):
+    """Sends a push to the handler, returns ReplicationPushResponse."""
+    all_headers = {
+      'Content-Type': 'application/octet-stream',
+      'X-Appengine-Inbound-Appid': 'mocked-primary',
+      'X-AuthDB-SigKey-v1': 'key',
+      'X-AuthDB-SigVal-v1': base64.b64encode(sig),
+    }
+    all_headers.update(headers or {})
+    response = call_post(
+        rest_api.ReplicationHandler, body,
+        uri='/auth/api/v1/internal/replication', headers=all_headers)
+    return replication_pb2.ReplicationPushResponse.FromString(response.body)
+
+  def assert_response(self, response, status, error_code=None, rev=None):
+    self.assertEqual(status, response.status)
+    if error_code is None:
+      self.assertFalse(response.HasField('error_code'))
+    else:
+      self.assertEqual(error_code, response.error_code)
+    if rev is not None:
+      self.assertEqual(rev, response.current_revision.auth_db_rev)
+    self.assertEqual(version.__version__, response.auth_code_version)
+
+  def group_names(self):
+    return sorted(
+        k.id() for k in model.AuthGroup.query(ancestor=model.root_key()).fetch(
+            keys_only=True))
+
+  def push_full(self, rev, *groups):
+    request = self.make_request(rev, auth_db=self.make_auth_db(*groups))
+    return self.push(request.SerializeToString())
+
+  def test_full_push(self):
+    response = self.push_full(1, 'A', 'B')
+    self.assert_response(
+        response, replication_pb2.ReplicationPushResponse.APPLIED, rev=1)
+    self.assertEqual(['A', 'B'], self.group_names())
+    self.assertEqual(1, get_auth_db_rev())
+
+  def test_delta_push(self):
+    self.push_full(1, 'A', 'B')
+    delta = replication_pb2.AuthDBDelta(
+        base_auth_db_rev=1,
+        changed=self.make_auth_db('C'),
+        deleted_groups=['B'])
+    request = self.make_request(3, auth_db_delta=delta)
+    response = self.push(request.SerializeToString())
+    self.assert_response(
+        response, replication_pb2.ReplicationPushResponse.APPLIED, rev=3)
+    self.assertEqual(['A', 'C'], self.group_names())
+    self.assertEqual(3, get_auth_db_rev())
+
+  def test_delta_push_bad_base_revision(self):
+    self.push_full(1, 'A', 'B')
+    delta = replication_pb2.AuthDBDelta(
+        base_auth_db_rev=2, changed=self.make_auth_db('C'))
+    request = self.make_request(3, auth_db_delta=delta)
+    response = self.push(request.SerializeToString())
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.TRANSIENT_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_BASE_REVISION)
+    self.assertEqual(['A', 'B'], self.group_names())
+    self.assertEqual(1, get_auth_db_rev())
+
+  def test_delta_push_already_applied(self):
+    self.push_full(3, 'A')
+    delta = replication_pb2.AuthDBDelta(
+        base_auth_db_rev=1, changed=self.make_auth_db('C'))
+    request = self.make_request(3, auth_db_delta=delta)
+    response = self.push(request.SerializeToString())
+    self.assert_response(
+        response, replication_pb2.ReplicationPushResponse.SKIPPED, rev=3)
+    self.assertEqual(['A'], self.group_names())
+
+  def test_both_auth_db_and_delta(self):
+    delta = replication_pb2.AuthDBDelta(
+        base_auth_db_rev=0, changed=self.make_auth_db('C'))
+    request = self.make_request(
+        1, auth_db=self.make_auth_db('A'), auth_db_delta=delta)
+    response = self.push(request.SerializeToString())
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+    self.assertEqual([], self.group_names())
+    self.assertEqual(0, get_auth_db_rev())
+
+  def test_bad_signature(self):
+    request = self.make_request(1, auth_db=self.make_auth_db('A'))
+    response = self.push(request.SerializeToString(), sig='bad')
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_SIGNATURE)
+    self.assertEqual(0, get_auth_db_rev())
+
+
+  def test_compressed_push(self):
+    request = self.make_request(1, auth_db=self.make_auth_db('A'))
+    blob = request.SerializeToString()
+    body = zlib.compress(blob)
+    response = self.push(
+        body,
+        headers={
+          'X-AuthDB-Compression-v1': replication.PUSH_COMPRESSION_DEFLATE,
+        })
+    self.assert_response(
+        response, replication_pb2.ReplicationPushResponse.APPLIED, rev=1)
+    self.assertEqual(['A'], self.group_names())
+    # The signature is checked over the body as it was sent.
+    self.assertEqual([body], self.signed_blobs)
+
+  def test_compressed_push_bad_signature(self):
+    # The signature is checked before the body is inflated.
+    response = self.push(
+        'garbage',
+        sig='bad',
+        headers={
+          'X-AuthDB-Compression-v1': replication.PUSH_COMPRESSION_DEFLATE,
+        })
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_SIGNATURE)
+    self.assertEqual(['garbage'], self.signed_blobs)
+
+  def test_bad_compressed_body(self):
+    response = self.push(
+        'garbage',
+        headers={
+          'X-AuthDB-Compression-v1': replication.PUSH_COMPRESSION_DEFLATE,
+        })
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+    self.assertEqual(0, get_auth_db_rev())
+
+  def test_unknown_compression(self):
+    request = self.make_request(1, auth_db=self.make_auth_db('A'))
+    blob = request.SerializeToString()
+    response = self.push(blob, headers={'X-AuthDB-Compression-v1': 'gzip'})
+    self.assert_response(
+        response,
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR,
+        replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+    self.assertEqual([blob], self.signed_blobs)
+    self.assertEqual(0, get_auth_db_rev())
+
 class ForbidApiOnReplicaTest(test_case.TestCase):
   """Tests for rest_api.forbid_api_on_replica decorator."""
 
@@ -8,16 +8,20 @@ Uses remote.Provider or fs.Provider to load configs, depending on whether config
 service hostname is configured in common.ConfigSettings.
 See _get_config_provider_async().
 
-Provider do not do type conversion, api.py does.
+Provider do not do type conversion, api.py does. Parsed configs are cached in
+process memory by content hash, see _convert_config_cached().
 """
 
 import collections
+import hashlib
 import logging
 import sys
+import threading
 
 from google.appengine.ext import ndb
 
 from components import auth
+from components import utils
 
 from . import common
 from . import fs
@@ -33,6 +37,93 @@ Project = collections.namedtuple('Project', [
 ])
 
 
+# How often configs requested with store_last_good=True are re-read from the
+# datastore, sec. The datastore copy itself is updated by a cron job.
+_LAST_GOOD_REVALIDATE_SEC = 60
+# Max number of parsed configs kept in process memory.
+_PARSED_CACHE_MAX_SIZE = 500
+
+# Guards the caches below.
+_cache_lock = threading.Lock()
+# (config_set, path) -> (revision, content, fetch time as unix timestamp).
+_last_good_cache = {}
+# Set of (config_set, path) being re-read by some thread right now.
+_last_good_refreshing = set()
+# (config_set, path, content hash, dest_type) -> parsed message. Messages here
+# are never returned to callers directly, only their copies.
+_parsed_cache = {}
+
+
+def _reset_caches():
+  """Clears in-process config caches. Used in tests."""
+  with _cache_lock:
+    _last_good_cache.clear()
+    _last_good_refreshing.clear()
+    _parsed_cache.clear()
+
+
+def _content_hash(content):
+  """Returns a digest of config content, to be used as a cache key."""
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  return hashlib.sha1(content).hexdigest()
+
+
+def _convert_config_cached(config_set, path, content, dest_type):
+  """Like common._convert_config, but reuses previously parsed messages.
+
+  Returns a copy of the cached message, so callers are free to modify it.
+
+  Raises:
+    ConfigFormatError if config could not be converted to |dest_type|.
+  """
+  if dest_type is None or content is None or isinstance(content, dest_type):
+    return common._convert_config(content, dest_type)
+  key = (config_set, path, _content_hash(content), dest_type)
+  with _cache_lock:
+    msg = _parsed_cache.get(key)
+  if msg is None:
+    msg = common._convert_config(content, dest_type)
+    with _cache_lock:
+      if len(_parsed_cache) >= _PARSED_CACHE_MAX_SIZE:
+        _parsed_cache.clear()
+      _parsed_cache[key] = msg
+  copy = dest_type()
+  copy.CopyFrom(msg)
+  return copy
+
+
+@ndb.tasklet
+def _get_last_good_cached_async(provider, config_set, path):
+  """Returns (revision, content) of a config stored with store_last_good=True.
+
+  Keeps the result in process memory. It is re-read from the provider at most
+  once per _LAST_GOOD_REVALIDATE_SEC by a single caller, other callers keep
+  using the cached copy meanwhile.
+  """
+  key = (config_set, path)
+  now = utils.time_time()
+  with _cache_lock:
+    cached = _last_good_cache.get(key)
+    use_cached = cached and (
+        now < cached[2] + _LAST_GOOD_REVALIDATE_SEC or
+        key in _last_good_refreshing)
+    if not use_cached:
+      _last_good_refreshing.add(key)
+  if use_cached:
+    raise ndb.Return(cached[:2])
+
+  try:
+    revision, content = yield provider.get_async(
+        config_set, path, store_last_good=True)
+    with _cache_lock:
+      _last_good_cache[key] = (revision, content, now)
+  finally:
+    with _cache_lock:
+      _last_good_refreshing.discard(key)
+  raise ndb.Return((revision, content))
+
+
 @ndb.tasklet
 def _get_config_provider_async():  # pragma: no cover
   """Returns a config provider to load configs.
@@ -58,7 +149,10 @@ def get_async(
   ignored, so get_async with store_last_good=True is guaranteed to always return
   valid configs as long as validation code is not changed in a non-backward
   compatible way. If a config was requested with store_last_good=True for the
-  first time, (None, None) is returned.
+  first time, (None, None) is returned. Such configs are also cached in process
+  memory for up to _LAST_GOOD_REVALIDATE_SEC.
+
+  Returned messages are copies, callers may modify them.
 
   Args:
     config_set (str): config set to read a config from.
@@ -92,9 +186,14 @@ def get_async(
           'specified')
 
   provider = yield _get_config_provider_async()
-  revision, config = yield provider.get_async(
-      config_set, path, revision=revision, store_last_good=store_last_good)
-  raise ndb.Return((revision, common._convert_config(config, dest_type)))
+  if store_last_good:
+    revision, config = yield _get_last_good_cached_async(
+        provider, config_set, path)
+  else:
+    revision, config = yield provider.get_async(
+        config_set, path, revision=revision, store_last_good=store_last_good)
+  raise ndb.Return((
+      revision, _convert_config_cached(config_set, path, config, dest_type)))
 
 
 def get(*args, **kwargs):
@@ -173,7 +272,7 @@ def get_project_configs_async(path, dest_type=None):
     project_id = config_set[len('projects/'):]
     assert project_id
     try:
-      config = common._convert_config(content, dest_type)
+      config = _convert_config_cached(config_set, path, content, dest_type)
     except common.ConfigFormatError:
       logging.exception(
           'Could not parse config at %s in config set %s: %r',
@@ -214,7 +313,7 @@ def get_ref_configs_async(path, dest_type=None):
     assert project_id
     assert ref
     try:
-      config = common._convert_config(content, dest_type)
+      config = _convert_config_cached(config_set, path, content, dest_type)
     except common.ConfigFormatError:
       logging.exception(
           'Could not parse config at %s in config set %s: %r',
@@ -4,6 +4,7 @@
 # that can be found in the LICENSE file.
 
 import base64
+import datetime
 import logging
 import sys
 import unittest
@@ -18,6 +19,7 @@ from google.appengine.ext import ndb
 from components import auth
 from components import config
 from components.config import api
+from components.config import common
 from components.config import remote
 from components.config import test_config_pb2
 from components.config.proto import project_config_pb2
@@ -34,6 +36,8 @@ class ApiTestCase(test_case.TestCase):
     self.provider.get_async.return_value = ndb.Future()
     self.provider.get_async.return_value.set_result(
         ('deadbeef', 'param: "value"'))
+    api._reset_caches()
+    self.addCleanup(api._reset_caches)
 
   def test_get(self):
     revision, cfg = config.get(
@@ -57,6 +61,56 @@ class ApiTestCase(test_case.TestCase):
     self.assertEqual(revision, 'deadbeef')
     self.assertEqual(cfg, 'param: "value"')
 
+  def test_get_parsed_config_is_cached(self):
+    calls = []
+    def convert_config(content, dest_type):
+      calls.append(content)
+      return orig_convert_config(content, dest_type)
+    orig_convert_config = self.mock(common, '_convert_config', convert_config)
+
+    _, cfg1 = config.get('services/foo', 'bar.cfg', test_config_pb2.Config)
+    _, cfg2 = config.get('services/foo', 'bar.cfg', test_config_pb2.Config)
+    self.assertEqual(['param: "value"'], calls)
+    self.assertEqual(cfg1, cfg2)
+
+    # Callers get copies.
+    cfg1.param = 'modified'
+    _, cfg3 = config.get('services/foo', 'bar.cfg', test_config_pb2.Config)
+    self.assertEqual('value', cfg2.param)
+    self.assertEqual('value', cfg3.param)
+
+    # New content is parsed again.
+    self.provider.get_async.return_value = ndb.Future()
+    self.provider.get_async.return_value.set_result(
+        ('beefdead', 'param: "new"'))
+    _, cfg4 = config.get('services/foo', 'bar.cfg', test_config_pb2.Config)
+    self.assertEqual('new', cfg4.param)
+    self.assertEqual(['param: "value"', 'param: "new"'], calls)
+
+  def test_get_last_good_is_cached(self):
+    now = datetime.datetime(2017, 1, 1)
+    self.mock_now(now)
+
+    def get():
+      return config.get(
+          'services/foo', 'bar.cfg', test_config_pb2.Config,
+          store_last_good=True)
+
+    self.assertEqual('deadbeef', get()[0])
+    self.assertEqual('deadbeef', get()[0])
+    self.assertEqual(1, self.provider.get_async.call_count)
+
+    # Re-read once cached copy is too old.
+    self.mock_now(now, api._LAST_GOOD_REVALIDATE_SEC + 1)
+    self.assertEqual('deadbeef', get()[0])
+    self.assertEqual(2, self.provider.get_async.call_count)
+
+    # Other callers use stale copy while someone else is re-reading it.
+    self.mock_now(now, 2 * api._LAST_GOOD_REVALIDATE_SEC + 2)
+    api._last_good_refreshing.add(('services/foo', 'bar.cfg'))
+    self.assertEqual('deadbeef', get()[0])
+    self.assertEqual(2, self.provider.get_async.call_count)
+
   def test_cannot_load_config(self):
     self.provider.get_async.side_effect = ValueError
     with self.assertRaises(config.CannotLoadConfigError):
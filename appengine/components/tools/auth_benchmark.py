@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Microbenchmarks of the auth component hot path.
+
+Compares matching identities against a group's globs with a loop over
+IdentityGlob.match and with the precompiled IdentityGlobMatcher.
+
+Measures the size of a replication push of a synthetic AuthDB with and without
+compression, and the cost of converting pushed groups to entities all at once
+and one by one.
+
+Measures per-request overhead of AuthenticatingHandler for a Swarming bot API
+style handler with and without BOT_AUTH_PROFILE.
+
+Builds synthetic AuthDBs of growing size and reports latency percentiles of
+is_group_member, verify_ip_whitelisted, fetch_auth_db and delegation token
+checks, along with the memory used by AuthDB.
+"""
+
+import contextlib
+import datetime
+import json
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+import timeit
+
+# /appengine/components/
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import webapp2
+
+from components import utils
+from components.auth import api
+from components.auth import delegation
+from components.auth import handler
+from components.auth import ipaddr
+from components.auth import machine_auth
+from components.auth import model
+from components.auth import replication
+from components.auth.proto import delegation_pb2
+from components.auth.proto import replication_pb2
+
+
+# Identity assigned to the IP whitelist of the synthetic AuthDB.
+WHITELISTED_ID = model.Identity(model.IDENTITY_USER, 'whitelisted@example.com')
+# Number of members in each group of the synthetic AuthDB.
+GROUP_MEMBERS = 10
+
+
+def make_globs(count):
+  """Returns a list of bot globs in the style of 'bot:*-m<N>*'."""
+  return [
+    model.IdentityGlob(model.IDENTITY_BOT, '*-m%d*' % i) for i in xrange(count)
+  ]
+
+
+def make_identities(count):
+  """Returns a list of bot identities, some of which match make_globs()."""
+  random.seed(0)
+  return [
+    model.Identity(
+        model.IDENTITY_BOT,
+        'vm%d-%s%d' % (i, random.choice('mnx'), random.randint(0, 1000)))
+    for i in xrange(count)
+  ]
+
+
+def bench_globs(globs_count, identities, repeat):
+  """Prints the time per check of both matching methods."""
+  globs = make_globs(globs_count)
+  matcher = model.IdentityGlobMatcher(globs)
+  for identity in identities:
+    assert (
+        any(g.match(identity) for g in globs) == matcher.match(identity))
+
+  def loop():
+    for identity in identities:
+      any(g.match(identity) for g in globs)
+
+  def compiled():
+    for identity in identities:
+      matcher.match(identity)
+
+  checks = len(identities) * repeat
+  loop_sec = min(timeit.repeat(loop, repeat=3, number=repeat)) / checks
+  compiled_sec = min(timeit.repeat(compiled, repeat=3, number=repeat)) / checks
+  print('%5d globs: loop %8.2fus, compiled %8.2fus, x%.1f' % (
+      globs_count, loop_sec * 1e6, compiled_sec * 1e6,
+      loop_sec / compiled_sec))
+
+
+def make_auth_db_proto(groups_count):
+  """Returns replication_pb2.AuthDB with |groups_count| synthetic groups."""
+  now = datetime.datetime(2017, 1, 1)
+  creator = model.Identity(model.IDENTITY_USER, 'creator@example.com')
+  groups = [
+    model.AuthGroup(
+        key=model.group_key('group-%d' % i),
+        members=[
+          model.Identity(model.IDENTITY_USER, 'user%d@example.com' % j)
+          for j in xrange(i % 10)
+        ],
+        globs=make_globs(i % 3),
+        nested=['group-%d' % (i / 2)] if i else [],
+        description='Synthetic group number %d' % i,
+        created_ts=now,
+        created_by=creator,
+        modified_ts=now,
+        modified_by=creator)
+    for i in xrange(groups_count)
+  ]
+  snapshot = replication.AuthDBSnapshot(
+      global_config=model.AuthGlobalConfig(key=model.root_key()),
+      groups=groups,
+      secrets=[],
+      ip_whitelists=[],
+      ip_whitelist_assignments=model.AuthIPWhitelistAssignments(
+          key=model.ip_whitelist_assignments_key()))
+  return replication.auth_db_snapshot_to_proto(snapshot)
+
+
+def max_rss_kb():
+  """Returns peak resident set size of the process so far, in KB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_replication(groups_count):
+  """Prints push body sizes and the cost of decoding the pushed groups."""
+  req = replication_pb2.ReplicationPushRequest()
+  req.auth_db.CopyFrom(make_auth_db_proto(groups_count))
+  blob = req.SerializeToString()
+  del req
+
+  start = time.time()
+  deflated = replication.compress_push_body(
+      blob, replication.PUSH_COMPRESSION_DEFLATE)
+  compress_sec = time.time() - start
+  start = time.time()
+  inflated = replication.decompress_push_body(
+      deflated, replication.PUSH_COMPRESSION_DEFLATE)
+  inflate_sec = time.time() - start
+  assert inflated == blob
+  del inflated
+
+  print('%d groups: push body %.1f MB, deflated %.1f MB (x%.1f)' % (
+      groups_count, len(blob) / 1e6, len(deflated) / 1e6,
+      float(len(blob)) / len(deflated)))
+  print('  deflate %.2fs, inflate %.2fs' % (compress_sec, inflate_sec))
+
+  auth_db = replication_pb2.ReplicationPushRequest.FromString(blob).auth_db
+
+  # Peak RSS only grows, so measure the conversion that needs less memory
+  # first.
+  rss_before = max_rss_kb()
+  start = time.time()
+  for msg in auth_db.groups:
+    replication.proto_to_group(msg)
+  one_by_one_sec = time.time() - start
+  one_by_one_kb = max_rss_kb() - rss_before
+
+  rss_before = max_rss_kb()
+  start = time.time()
+  groups = [replication.proto_to_group(msg) for msg in auth_db.groups]
+  all_at_once_sec = time.time() - start
+  all_at_once_kb = max_rss_kb() - rss_before
+  del groups
+
+  print('  to entities one by one: %.2fs, +%d KB peak RSS' % (
+      one_by_one_sec, one_by_one_kb))
+  print('  to entities all at once: %.2fs, +%d KB peak RSS' % (
+      all_at_once_sec, all_at_once_kb))
+
+
+@contextlib.contextmanager
+def activated_testbed():
+  """Activates GAE testbed with stubs used by the auth component."""
+  tb = testbed.Testbed()
+  tb.activate()
+  try:
+    tb.init_app_identity_stub()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_user_stub()
+    api.reset_local_state()
+    yield
+  finally:
+    tb.deactivate()
+
+
+def percentiles(samples):
+  """Returns (p50, p90, p99, max) of a list of numbers."""
+  samples = sorted(samples)
+  def at(p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+  return at(0.5), at(0.9), at(0.99), samples[-1]
+
+
+def measure(func, args_list, before=None):
+  """Calls func(*args) for each item of |args_list|, returns latencies in sec.
+
+  If |before| is given, it is called (untimed) before each call.
+  """
+  latencies = []
+  for args in args_list:
+    if before:
+      before()
+    start = timeit.default_timer()
+    func(*args)
+    latencies.append(timeit.default_timer() - start)
+  return latencies
+
+
+def print_latencies(name, latencies):
+  """Prints percentiles of |latencies| in microseconds."""
+  print('  %-30s p50 %9.1fus, p90 %9.1fus, p99 %9.1fus, max %9.1fus' % (
+      (name,) + tuple(x * 1e6 for x in percentiles(latencies))))
+
+
+def member_identity(group_index, member_index):
+  """Returns an identity that is a member of group 'group-<group_index>'."""
+  return model.Identity(
+      model.IDENTITY_USER,
+      'user%d-%d@example.com' % (group_index, member_index))
+
+
+def make_auth_db_entities(
+    groups_count, nesting_depth, globs_count, whitelist_size):
+  """Returns entities of a synthetic AuthDB.
+
+  Groups form chains of |nesting_depth| groups, each group including the next
+  one in the chain, so members of the last group in a chain are members of all
+  groups in it.
+
+  Returns:
+    Tuple (list of AuthGroup, list of AuthIPWhitelist,
+    AuthIPWhitelistAssignments).
+  """
+  now = datetime.datetime(2017, 1, 1)
+  creator = model.Identity(model.IDENTITY_USER, 'creator@example.com')
+  groups = []
+  for i in xrange(groups_count):
+    last_in_chain = (i + 1) % nesting_depth == 0 or i + 1 == groups_count
+    groups.append(model.AuthGroup(
+        key=model.group_key('group-%d' % i),
+        members=[member_identity(i, j) for j in xrange(GROUP_MEMBERS)],
+        globs=make_globs(globs_count),
+        nested=[] if last_in_chain else ['group-%d' % (i + 1)],
+        description='Synthetic group number %d' % i,
+        created_ts=now,
+        created_by=creator,
+        modified_ts=now,
+        modified_by=creator))
+  whitelist = model.AuthIPWhitelist(
+      key=model.ip_whitelist_key('whitelist'),
+      subnets=[
+        '10.%d.%d.0/24' % (i / 256 % 256, i % 256)
+        for i in xrange(whitelist_size)
+      ],
+      created_ts=now,
+      created_by=creator,
+      modified_ts=now,
+      modified_by=creator)
+  assignments = model.AuthIPWhitelistAssignments(
+      key=model.ip_whitelist_assignments_key(),
+      assignments=[
+        model.AuthIPWhitelistAssignments.Assignment(
+            identity=WHITELISTED_ID,
+            ip_whitelist='whitelist',
+            created_ts=now,
+            created_by=creator),
+      ])
+  return groups, [whitelist], assignments
+
+
+def make_membership_checks(groups_count, nesting_depth, count):
+  """Returns |count| distinct (group name, Identity) pairs to check.
+
+  Half of them are members of the group via the deepest nested group, the rest
+  are not members at all and have to be matched against all globs.
+  """
+  random.seed(0)
+  checks = set()
+  while len(checks) < count:
+    group = random.randrange(groups_count)
+    if random.random() < 0.5:
+      chain_end = min(
+          groups_count, (group / nesting_depth + 1) * nesting_depth) - 1
+      ident = member_identity(chain_end, random.randrange(GROUP_MEMBERS))
+    else:
+      ident = model.Identity(
+          model.IDENTITY_USER, 'stranger%d@example.com' % len(checks))
+    checks.add(('group-%d' % group, ident))
+  return sorted(checks)
+
+
+def bench_auth_db(
+    groups_count, nesting_depth, globs_count, whitelist_size, samples,
+    fetch_samples):
+  """Prints latencies of the auth hot path for a synthetic AuthDB."""
+  print(
+      '%d groups, nesting depth %d, %d globs per group, %d whitelisted subnets'
+      % (groups_count, nesting_depth, globs_count, whitelist_size))
+  groups, whitelists, assignments = make_auth_db_entities(
+      groups_count, nesting_depth, globs_count, whitelist_size)
+
+  # Peak RSS only grows, so this is meaningful only when AuthDBs are built in
+  # increasing size order.
+  rss_before = max_rss_kb()
+  start = time.time()
+  auth_db = api.AuthDB(
+      groups=groups,
+      ip_whitelists=whitelists,
+      ip_whitelist_assignments=assignments)
+  print('  AuthDB built in %.2fs, +%d KB peak RSS' % (
+      time.time() - start, max_rss_kb() - rss_before))
+
+  # Each pair is checked once with empty membership cache and once with it
+  # populated.
+  checks = make_membership_checks(groups_count, nesting_depth, samples)
+  print_latencies(
+      'is_group_member (cold)', measure(auth_db.is_group_member, checks))
+  print_latencies(
+      'is_group_member (warm)', measure(auth_db.is_group_member, checks))
+
+  random.seed(0)
+  ips = [
+    (WHITELISTED_ID, ipaddr.ip_from_string('10.%d.%d.%d' % (
+        i / 256 % 256, i % 256, random.randrange(256))))
+    for i in (random.randrange(whitelist_size) for _ in xrange(samples))
+  ]
+  print_latencies(
+      'verify_ip_whitelisted', measure(auth_db.verify_ip_whitelisted, ips))
+  del auth_db
+
+  # fetch_auth_db reads entities from the datastore, or the AuthDB snapshot
+  # from memcache if the datastore reports entity group versions. The testbed
+  # doesn't, so pretend it does, as api_test does.
+  state = model.AuthReplicationState(
+      key=model.replication_state_key(), auth_db_rev=1)
+  ndb.put_multi(groups + whitelists + [
+    assignments, model.AuthGlobalConfig(key=model.root_key()), state,
+  ])
+  del groups
+  fetches = [()] * fetch_samples
+  get_entity_group_version = api.metadata.get_entity_group_version
+  api.metadata.get_entity_group_version = lambda _: 123
+  try:
+    print_latencies(
+        'fetch_auth_db (no memcache)',
+        measure(api.fetch_auth_db, fetches, before=memcache.flush_all))
+    api.fetch_auth_db()
+    print_latencies('fetch_auth_db', measure(api.fetch_auth_db, fetches))
+  finally:
+    api.metadata.get_entity_group_version = get_entity_group_version
+
+  # The token is usable by members of the first group and |peer| is a member
+  # through the deepest nested group.
+  api.reset_local_state()
+  subtoken = delegation_pb2.Subtoken(
+      delegated_identity='user:delegated@example.com',
+      audience=['group:group-0'],
+      services=['*'],
+      creation_time=int(utils.time_time()),
+      validity_duration=3600)
+  tok = delegation.serialize_token(delegation.seal_token(subtoken))
+  peer = member_identity(min(groups_count, nesting_depth) - 1, 0)
+  token_checks = [(tok, peer)] * samples
+  print_latencies(
+      'check delegation token (cold)',
+      measure(
+          delegation.check_bearer_delegation_token, token_checks,
+          before=api.get_verified_token_cache().clear))
+  print_latencies(
+      'check delegation token (warm)',
+      measure(delegation.check_bearer_delegation_token, token_checks))
+
+
+def make_dispatch_apps():
+  """Returns dict with webapp2 apps serving a bot-like POST handler.
+
+  'baseline' does no authentication at all, 'default' authenticates the way
+  Swarming bot handlers did before auth profiles, 'profile' uses
+  BOT_AUTH_PROFILE.
+  """
+  class Baseline(webapp2.RequestHandler):
+    def post(self):
+      self.response.write(json.loads(self.request.body)['id'])
+
+  class Default(handler.ApiHandler):
+    xsrf_token_enforce_on = ()
+
+    @classmethod
+    def get_auth_methods(cls, conf):
+      return [machine_auth.machine_authentication, handler.oauth_authentication]
+
+    @api.public
+    def post(self):
+      self.response.write(self.parse_body()['id'])
+
+  class Profile(handler.ApiHandler):
+    auth_profile = handler.BOT_AUTH_PROFILE
+
+    @api.public
+    def post(self):
+      self.response.write(self.parse_body()['id'])
+
+  return {
+    name: webapp2.WSGIApplication([webapp2.Route('/request', cls)])
+    for name, cls in (
+        ('baseline', Baseline), ('default', Default), ('profile', Profile))
+  }
+
+
+def bench_dispatch(requests):
+  """Prints time per request from a bot in 'bots' IP whitelist."""
+  with activated_testbed():
+    model.bootstrap_ip_whitelist(model.BOTS_IP_WHITELIST, ['192.168.1.0/24'])
+    api.reset_local_state()
+
+    # Size is similar to what bots send to /swarming/api/v1/bot/poll.
+    body = json.dumps({
+      'id': 'bot-1',
+      'dimensions': {'key%d' % i: ['value%d' % i] for i in xrange(20)},
+      'state': {'key%d' % i: 'value%d' % i for i in xrange(50)},
+      'version': 'a' * 64,
+    })
+
+    def run(app):
+      def call():
+        for _ in xrange(requests):
+          req = webapp2.Request.blank(
+              '/request',
+              POST=body,
+              headers={'Content-Type': 'application/json; charset=utf-8'},
+              environ={'REMOTE_ADDR': '192.168.1.100'})
+          res = req.get_response(app)
+          assert res.status_int == 200, res.body
+      # Warm up AuthDB and config caches.
+      call()
+      return min(timeit.repeat(call, repeat=3, number=1)) / requests
+
+    timings = {name: run(app) for name, app in make_dispatch_apps().items()}
+    baseline = timings['baseline']
+    print('Request dispatch: baseline %.1fus' % (baseline * 1e6))
+    for name in ('default', 'profile'):
+      print('  %-8s %8.1fus, auth overhead %8.1fus' % (
+          name, timings[name] * 1e6, (timings[name] - baseline) * 1e6))
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--globs', default='1,10,100,1000',
+      help='Comma separated numbers of globs per group, default: %default')
+  parser.add_option(
+      '--identities', type='int', default=100,
+      help='Number of identities to check, default: %default')
+  parser.add_option(
+      '--repeat', type='int', default=10,
+      help='Number of times to check each identity, default: %default')
+  parser.add_option(
+      '--replication-groups', type='int', default=50000,
+      help='Number of groups in a replicated AuthDB, 0 to skip, '
+           'default: %default')
+  parser.add_option(
+      '--auth-db-groups', default='100,1000,10000',
+      help='Comma separated numbers of groups in synthetic AuthDBs, empty to '
+           'skip, default: %default')
+  parser.add_option(
+      '--nesting-depth', type='int', default=5,
+      help='Length of chains of nested groups, default: %default')
+  parser.add_option(
+      '--globs-per-group', type='int', default=10,
+      help='Number of globs in each group, default: %default')
+  parser.add_option(
+      '--whitelist-size', type='int', default=100,
+      help='Number of subnets in the IP whitelist, default: %default')
+  parser.add_option(
+      '--samples', type='int', default=1000,
+      help='Number of calls to measure per operation, default: %default')
+  parser.add_option(
+      '--fetch-samples', type='int', default=10,
+      help='Number of fetch_auth_db calls to measure, default: %default')
+  parser.add_option(
+      '--dispatch-requests', type='int', default=1000,
+      help='Number of requests to dispatch to bot API handlers, 0 to skip, '
+           'default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args: %s' % args)
+  if options.nesting_depth < 1:
+    parser.error('--nesting-depth must be positive')
+  if options.whitelist_size < 1:
+    parser.error('--whitelist-size must be positive')
+
+  identities = make_identities(options.identities)
+  for count in options.globs.split(','):
+    bench_globs(int(count), identities, options.repeat)
+  if options.replication_groups:
+    bench_replication(options.replication_groups)
+  if options.dispatch_requests:
+    bench_dispatch(options.dispatch_requests)
+  if options.auth_db_groups:
+    counts = sorted(int(c) for c in options.auth_db_groups.split(','))
+    for count in counts:
+      with activated_testbed():
+        bench_auth_db(
+            count, options.nesting_depth, options.globs_per_group,
+            options.whitelist_size, options.samples, options.fetch_samples)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
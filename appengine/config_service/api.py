@@ -4,7 +4,6 @@
 
 import logging
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from protorpc import messages
 from protorpc import message_types
@@ -439,26 +438,21 @@ def get_config_multi(scope, path, hashes_only):
   scope can be 'projects' or 'refs'.
 
   Returns empty config list if requester does not have project access.
+
+  Reads storage.LatestConfigIndex of |path|, so the cost does not depend on
+  the number of config sets much.
   """
   assert scope in ('projects', 'refs'), scope
-  cache_key = (
-    'v2/%s%s:%s' % (scope, ',hashes_only' if hashes_only else '', path))
-  configs = memcache.get(cache_key)
-  if configs is None:
-    configs = storage.get_latest_multi_async(
-        get_config_sets_from_scope(scope), path, hashes_only).get_result()
-    for config in configs:
-      if not hashes_only and config.get('content') is None:
-        logging.error(
-            'Blob %s referenced from %s:%s:%s was not found',
-            config['content_hash'],
-            config['config_set'],
-            config['revision'],
-            path)
-    try:
-      memcache.add(cache_key, configs, time=60)
-    except ValueError:
-      logging.exception('%s:%s configs are too big for memcache', scope, path)
+  configs = storage.get_latest_multi_async(
+      get_config_sets_from_scope(scope), path, hashes_only).get_result()
+  for config in configs:
+    if not hashes_only and config.get('content') is None:
+      logging.error(
+          'Blob %s referenced from %s:%s:%s was not found',
+          config['content_hash'],
+          config['config_set'],
+          config['revision'],
+          path)
 
   res = GetConfigMultiResponseMessage()
   for config in configs:
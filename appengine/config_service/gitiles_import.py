@@ -18,7 +18,9 @@ import os
 import re
 import StringIO
 import tarfile
+import time
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import urlfetch_errors
 from google.appengine.ext import ndb
 from google.protobuf import text_format
@@ -45,6 +47,8 @@ DEFAULT_GITILES_IMPORT_CONFIG = service_config_pb2.ImportCfg.Gitiles(
     project_config_default_path='/',
     ref_config_default_path='luci',
 )
+# How many times to try the transaction that stores an imported revision.
+IMPORT_TXN_ATTEMPTS = 5
 
 
 class Error(Exception):
@@ -159,13 +163,28 @@ def _import_revision(config_set, base_location, commit):
     attempt.success = True
     attempt.message = 'Imported'
 
-  @ndb.transactional
+  # Cross-group because of LatestConfigIndex entities.
+  @ndb.transactional(xg=True)
   def txn():
     if not rev_key.get():
+      files = [e for e in rev_entities if isinstance(e, storage.File)]
+      storage.update_latest_indexes_async(rev_entities[0], files).get_result()
       ndb.put_multi(rev_entities)
     attempt.put()
 
-  txn()
+  # All imports update LatestConfigIndexRoot entity group, so concurrent
+  # imports contend. ndb retries right away, keep trying with a backoff. The
+  # transaction is idempotent, so it is fine if a failed one actually committed.
+  for i in xrange(IMPORT_TXN_ATTEMPTS):
+    try:
+      txn()
+      break
+    except datastore_errors.TransactionFailedError:
+      if i == IMPORT_TXN_ATTEMPTS - 1:
+        raise
+      logging.warning(
+          'Contention while importing %s@%s, retrying', config_set, revision)
+      time.sleep(0.1 * 2**i)
   logging.info('Imported revision %s/%s', config_set, location.treeish)
 
 
@@ -5,6 +5,7 @@
 
 import datetime
 import os
+import threading
 
 from test_env import future
 import test_env
@@ -126,6 +127,68 @@ class GitilesImportTestCase(test_case.TestCase):
     self.assertFalse(gitiles.get_archive.called)
     self.assert_attempt(True, 'Up-to-date')
 
+  def test_import_revision_updates_latest_index(self):
+    self.mock_get_archive()
+    # Build an empty index first.
+    self.assertEqual(
+        [],
+        storage.get_latest_multi_async(
+            ['config_set'], 'test_archive/x').get_result())
+
+    gitiles_import._import_revision(
+        'config_set',
+        gitiles.Location(
+            hostname='localhost',
+            project='project',
+            treeish='luci/config',
+            path='/',
+        ),
+        self.test_commit)
+
+    configs = storage.get_latest_multi_async(
+        ['config_set'], 'test_archive/x').get_result()
+    self.assertEqual(1, len(configs))
+    self.assertEqual(self.test_commit.sha, configs[0]['revision'])
+    self.assertEqual('x\n', configs[0]['content'])
+
+  def test_import_revision_concurrent(self):
+    self.mock_get_archive()
+    self.mock(gitiles_import.time, 'sleep', lambda _: None)
+    location = gitiles.Location(
+        hostname='localhost',
+        project='project',
+        treeish='luci/config',
+        path='/',
+    )
+    # Build an index first, so that all imports update it.
+    storage.get_latest_multi_async(
+        ['config_set'], 'test_archive/x').get_result()
+
+    # Other config sets are imported while 'config_set' is being imported,
+    # for more attempts than ndb retries the transaction.
+    others = ['other%d' % i for i in xrange(5)]
+    pending = list(others)
+    def update_latest_indexes_async(config_set_entity, files):
+      result = orig_update_latest_indexes_async(config_set_entity, files)
+      if config_set_entity.key.id() == 'config_set' and pending:
+        result.get_result()
+        thread = threading.Thread(
+            target=gitiles_import._import_revision,
+            args=(pending.pop(0), location, self.test_commit))
+        thread.start()
+        thread.join()
+      return result
+    orig_update_latest_indexes_async = self.mock(
+        storage, 'update_latest_indexes_async', update_latest_indexes_async)
+
+    gitiles_import._import_revision('config_set', location, self.test_commit)
+    self.assertFalse(pending)
+    self.assert_attempt(True, 'Imported')
+    configs = storage.get_latest_multi_async(
+        ['config_set'] + others, 'test_archive/x').get_result()
+    self.assertEqual(
+        ['config_set'] + others, [c['config_set'] for c in configs])
+
   def test_import_revision_no_acrhive(self):
     self.mock_get_log()
     self.mock(gitiles, 'get_archive', mock.Mock(return_value=None))
@@ -16,6 +16,15 @@ from google.protobuf import text_format
 from components import config
 from components import utils
 
+
+# Max number of entries in a LatestConfigIndexChunk.
+LATEST_INDEX_CHUNK_SIZE = 1000
+# How many times to try to build a LatestConfigIndex before giving up.
+LATEST_INDEX_BUILD_ATTEMPTS = 3
+# How many times to try to read a consistent LatestConfigIndex before giving up.
+LATEST_INDEX_READ_ATTEMPTS = 3
+
+
 class Blob(ndb.Model):
   """Content-addressed blob. Immutable.
 
@@ -103,10 +112,81 @@ class File(ndb.Model):
     assert not self.key.id().startswith('/')
 
 
+class LatestConfigIndexRoot(ndb.Model):
+  """Root of all LatestConfigIndex entities.
+
+  All indexes are in one entity group, so an import of a config set can update
+  indexes of all its files in one transaction. It also means that imports are
+  serialized, at about one per second. Sharding the group by path is not an
+  option: a cross-group transaction spans at most 25 entity groups.
+
+  Entity key:
+    Id is "root". Has no parent.
+  """
+  # Incremented each time a config set gets a new revision.
+  generation = ndb.IntegerProperty(default=0, indexed=False)
+  # Names of all config sets imported since the root was created. Unlike a
+  # ConfigSet query, it is strongly consistent.
+  config_sets = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class LatestConfigIndexEntry(ndb.Model):
+  """Latest revision of a file in a config set.
+
+  Used with LocalStructuredProperty.
+  """
+  config_set = ndb.StringProperty(indexed=False)
+  revision = ndb.StringProperty(indexed=False)
+  content_hash = ndb.StringProperty(indexed=False)
+  url = ndb.StringProperty(indexed=False)
+
+
+class LatestConfigIndex(ndb.Model):
+  """Lists latest revisions of a file in all config sets that have it.
+
+  Created the first time the path is requested by get_latest_multi_async and
+  updated by update_latest_indexes_async on each import after that. Entries
+  are stored in LatestConfigIndexChunk entities.
+
+  Entity key:
+    Id is a path of the file. Parent is LatestConfigIndexRoot.
+  """
+  chunk_count = ndb.IntegerProperty(required=True, indexed=False)
+  # Incremented each time the index is stored. Chunks are stored with it too.
+  version = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class LatestConfigIndexChunk(ndb.Model):
+  """A chunk of LatestConfigIndex entries, sorted by config set.
+
+  Entity key:
+    Id is a chunk number, starting from 1. Parent is LatestConfigIndex.
+  """
+  entries = ndb.LocalStructuredProperty(LatestConfigIndexEntry, repeated=True)
+  # LatestConfigIndex.version of the index this chunk belongs to.
+  version = ndb.IntegerProperty(default=0, indexed=False)
+
+
 def last_import_attempt_key(config_set):
   return ndb.Key(ConfigSet, config_set, ImportAttempt, 'last')
 
 
+def latest_index_root_key():
+  return ndb.Key(LatestConfigIndexRoot, 'root')
+
+
+def latest_index_key(path):
+  return ndb.Key(LatestConfigIndex, path, parent=latest_index_root_key())
+
+
+def _latest_index_chunk_keys(path, chunk_count):
+  index_key = latest_index_key(path)
+  return [
+    ndb.Key(LatestConfigIndexChunk, i, parent=index_key)
+    for i in xrange(1, chunk_count + 1)
+  ]
+
+
 @ndb.tasklet
 def get_config_sets_async(config_set=None):
   if config_set:
@@ -172,17 +252,21 @@ def get_latest_async(config_set, path):
   raise ndb.Return(content)
 
 
+def _config_url(revision_url, path):
+  """Returns URL of a file at |path| in a revision, or None."""
+  if not revision_url:
+    return None
+  if not revision_url.endswith('/'):
+    revision_url += '/'
+  return urlparse.urljoin(revision_url, path)
+
+
 @ndb.tasklet
-def get_latest_multi_async(config_sets, path, hashes_only=False):
-  """Returns latest contents of all <config_set>:<path> config files.
+def _resolve_latest_multi_async(config_sets, path):
+  """Returns LatestConfigIndexEntry for each config set that has |path|.
 
-  Returns:
-    A a list of dicts with keys 'config_set', 'revision', 'content_hash' and
-    'content', 'url'. Content is not available if |hashes_only| is True.
+  Makes three dependent round trips. Used to build LatestConfigIndex.
   """
-  assert path
-  assert not path.startswith('/')
-
   config_set_keys = [ndb.Key(ConfigSet, cs) for cs in config_sets]
   config_set_entities = yield ndb.get_multi_async(config_set_keys)
   config_set_entities = filter(None, config_set_entities)
@@ -193,32 +277,209 @@ def get_latest_multi_async(config_sets, path, hashes_only=False):
   ]
   file_entities = yield ndb.get_multi_async(file_keys)
 
+  raise ndb.Return([
+    LatestConfigIndexEntry(
+        config_set=cs.key.id(),
+        revision=cs.latest_revision,
+        content_hash=f.content_hash,
+        url=_config_url(cs.latest_revision_url, path))
+    for cs, f in zip(config_set_entities, file_entities)
+    if f
+  ])
+
+
+@ndb.tasklet
+def _get_latest_index_chunks_async(index):
+  """Returns entries of a LatestConfigIndex entity.
+
+  Returns None if the index was updated after |index| was read, i.e. chunks
+  belong to another version of the index.
+  """
+  chunks = yield ndb.get_multi_async(
+      _latest_index_chunk_keys(index.key.id(), index.chunk_count))
+  if any(not c or c.version != index.version for c in chunks):
+    raise ndb.Return(None)
+  raise ndb.Return([e for c in chunks for e in c.entries])
+
+
+@ndb.tasklet
+def _get_latest_index_async(path):
+  """Returns entries of LatestConfigIndex of |path| or None if not built yet.
+
+  The index and its chunks are read outside of a transaction, so the read is
+  retried if an import updated the index in between. Returns None if the index
+  keeps changing too.
+  """
+  for _ in xrange(LATEST_INDEX_READ_ATTEMPTS):
+    index = yield latest_index_key(path).get_async()
+    if not index:
+      raise ndb.Return(None)
+    entries = yield _get_latest_index_chunks_async(index)
+    if entries is not None:
+      raise ndb.Return(entries)
+  logging.warning('Index of %s keeps changing, not using it', path)
+  raise ndb.Return(None)
+
+
+@ndb.tasklet
+def _put_latest_index_async(path, entries, old_index):
+  """Stores LatestConfigIndex of |path|, deletes chunks that are not needed.
+
+  Args:
+    path: path of the file.
+    entries: list of LatestConfigIndexEntry.
+    old_index: existing LatestConfigIndex entity or None.
+  """
+  entries = sorted(entries, key=lambda e: e.config_set)
+  chunks = [
+    entries[i:i + LATEST_INDEX_CHUNK_SIZE]
+    for i in xrange(0, len(entries), LATEST_INDEX_CHUNK_SIZE)
+  ]
+  old_chunk_count = old_index.chunk_count if old_index else 0
+  version = old_index.version + 1 if old_index else 1
+  chunk_keys = _latest_index_chunk_keys(path, max(len(chunks), old_chunk_count))
+  to_put = [
+    LatestConfigIndex(
+        key=latest_index_key(path), chunk_count=len(chunks), version=version),
+  ]
+  to_put.extend(
+      LatestConfigIndexChunk(key=key, entries=chunk, version=version)
+      for key, chunk in zip(chunk_keys, chunks))
+  yield (
+      ndb.put_multi_async(to_put),
+      ndb.delete_multi_async(chunk_keys[len(chunks):]))
+
+
+@ndb.tasklet
+def _build_latest_index_async(path):
+  """Creates LatestConfigIndex of |path| from all config sets.
+
+  Returns:
+    List of LatestConfigIndexEntry.
+  """
+  root_key = latest_index_root_key()
+  for _ in xrange(LATEST_INDEX_BUILD_ATTEMPTS):
+    root = yield root_key.get_async()
+    generation = root.generation if root else 0
+    # The query is eventually consistent, it may miss config sets that were
+    # just imported, but those are listed in the root. It's still needed for
+    # config sets imported before the root existed.
+    config_set_keys = yield ConfigSet.query().fetch_async(keys_only=True)
+    config_sets = set(root.config_sets if root else [])
+    config_sets.update(k.id() for k in config_set_keys)
+    entries = yield _resolve_latest_multi_async(sorted(config_sets), path)
+
+    # Store the index only if no config set was imported while it was being
+    # built, otherwise it may be stale.
+    @ndb.transactional_tasklet
+    def txn():
+      root = yield root_key.get_async()
+      if (root.generation if root else 0) != generation:
+        raise ndb.Return(False)
+      existing = yield latest_index_key(path).get_async()
+      if not existing:
+        yield _put_latest_index_async(path, entries, None)
+      raise ndb.Return(True)
+
+    if (yield txn()):
+      raise ndb.Return(entries)
+    logging.warning(
+        'Config sets were imported while building index of %s', path)
+
+  logging.error('Could not build index of %s, not using it', path)
+  raise ndb.Return(entries)
+
+
+@ndb.tasklet
+def update_latest_indexes_async(config_set_entity, files):
+  """Updates existing LatestConfigIndex entities after an import.
+
+  Must be called in a cross-group transaction that stores a new revision of a
+  config set, before the new ConfigSet entity is stored.
+
+  Args:
+    config_set_entity: ConfigSet entity with the new latest revision.
+    files: list of File entities in the new latest revision.
+  """
+  assert ndb.in_transaction()
+  config_set = config_set_entity.key.id()
+  root_key = latest_index_root_key()
+  root, old = yield root_key.get_async(), ConfigSet.get_by_id_async(config_set)
+  root = root or LatestConfigIndexRoot(key=root_key)
+  root.generation += 1
+  if config_set not in root.config_sets:
+    root.config_sets.append(config_set)
+
+  # Files of the previous revision need to be removed from indexes.
+  old_paths = set()
+  if old:
+    old_file_keys = yield File.query(
+        ancestor=ndb.Key(ConfigSet, config_set, Revision, old.latest_revision)
+    ).fetch_async(keys_only=True)
+    old_paths = {k.id() for k in old_file_keys}
+  new_files = {f.key.id(): f for f in files}
+
+  # Only indexes of paths that were requested at least once exist.
+  paths = sorted(old_paths | set(new_files))
+  indexes = yield ndb.get_multi_async([latest_index_key(p) for p in paths])
+  indexes = [(p, i) for p, i in zip(paths, indexes) if i]
+  all_entries = yield [_get_latest_index_chunks_async(i) for _, i in indexes]
+  futures = [root.put_async()]
+  for (path, index), entries in zip(indexes, all_entries):
+    # Reads in a transaction are consistent.
+    assert entries is not None, path
+    entries = [e for e in entries if e.config_set != config_set]
+    if path in new_files:
+      entries.append(LatestConfigIndexEntry(
+          config_set=config_set,
+          revision=config_set_entity.latest_revision,
+          content_hash=new_files[path].content_hash,
+          url=_config_url(config_set_entity.latest_revision_url, path)))
+    futures.append(_put_latest_index_async(path, entries, index))
+  yield futures
+
+
+@ndb.tasklet
+def get_latest_multi_async(config_sets, path, hashes_only=False):
+  """Returns latest contents of all <config_set>:<path> config files.
+
+  Uses LatestConfigIndex of |path|, building it on first call.
+
+  Returns:
+    A a list of dicts with keys 'config_set', 'revision', 'content_hash' and
+    'content', 'url'. Content is not available if |hashes_only| is True.
+  """
+  assert path
+  assert not path.startswith('/')
+
+  entries = yield _get_latest_index_async(path)
+  if entries is None:
+    entries = yield _build_latest_index_async(path)
+  entries_by_config_set = {e.config_set: e for e in entries}
+  entries = [
+    entries_by_config_set[cs]
+    for cs in config_sets
+    if cs in entries_by_config_set
+  ]
+
   blob_futures = {}
   if not hashes_only:
     blob_futures = {
-      f.content_hash: ndb.Key(Blob, f.content_hash).get_async()
-      for f in file_entities
-      if f
+      e.content_hash: ndb.Key(Blob, e.content_hash).get_async()
+      for e in entries
     }
     yield blob_futures.values()
 
   results = []
-  for cs, f in zip(config_set_entities, file_entities):
-    if not f:
-      continue
-    url = None
-    if cs.latest_revision_url:
-      base = cs.latest_revision_url
-      if not base.endswith('/'):
-        base += '/'
-      url = urlparse.urljoin(base, path)
-    blob_fut = blob_futures.get(f.content_hash)
+  for e in entries:
+    blob_fut = blob_futures.get(e.content_hash)
+    blob = blob_fut.get_result() if blob_fut else None
     results.append({
-      'config_set': f.key.parent().parent().id(),
-      'content': blob_fut.get_result().content if blob_fut else None,
-      'content_hash': f.content_hash,
-      'revision': f.key.parent().id(),
-      'url': url,
+      'config_set': e.config_set,
+      'content': blob.content if blob else None,
+      'content_hash': e.content_hash,
+      'revision': e.revision,
+      'url': e.url,
     })
   raise ndb.Return(results)
 
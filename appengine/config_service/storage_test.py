@@ -12,6 +12,8 @@ test_env.setup_test_env()
 from test_support import test_case
 import mock
 
+from google.appengine.ext import ndb
+
 from components.config.proto import service_config_pb2
 
 import storage
@@ -35,6 +37,35 @@ class StorageTestCase(test_case.TestCase):
     storage.File(id=path, parent=rev_key, content_hash=content_hash).put()
     storage.Blob(id=content_hash, content=content).put()
 
+  def import_revision(self, config_set, revision, files):
+    """Stores a new revision of a config set the way gitiles_import does."""
+    config_set_entity = storage.ConfigSet(
+        id=config_set,
+        location='https://x.com',
+        latest_revision=revision,
+        latest_revision_url='https://x.com/+/%s' % revision,
+    )
+    rev_key = ndb.Key(storage.ConfigSet, config_set, storage.Revision, revision)
+    file_entities = [
+      storage.File(
+          id=path, parent=rev_key, content_hash=storage.import_blob(content))
+      for path, content in sorted(files.iteritems())
+    ]
+
+    @ndb.transactional(xg=True)
+    def txn():
+      storage.update_latest_indexes_async(
+          config_set_entity, file_entities).get_result()
+      ndb.put_multi(
+          [config_set_entity, storage.Revision(key=rev_key)] + file_entities)
+    txn()
+
+  def get_latest_revisions(self, config_sets, path):
+    """Returns [(config_set, revision)] from get_latest_multi_async."""
+    configs = storage.get_latest_multi_async(
+        config_sets, path, hashes_only=True).get_result()
+    return [(c['config_set'], c['revision']) for c in configs]
+
   def test_get_config(self):
     self.put_file('foo', 'deadbeef', 'config.cfg', 'content')
     revision, content_hash = storage.get_config_hash_async(
@@ -122,6 +153,124 @@ class StorageTestCase(test_case.TestCase):
         ['foo', 'bar'], 'b.cfg').get_result()
     self.assertEqual(expected, actual)
 
+  def test_latest_index_built_on_first_request(self):
+    self.put_file('foo', 'deadbeef', 'a.cfg', 'fooo')
+    self.put_file('bar', 'beefdead', 'a.cfg', 'barr')
+    self.assertEqual(
+        [('foo', 'deadbeef'), ('bar', 'beefdead')],
+        self.get_latest_revisions(['foo', 'bar'], 'a.cfg'))
+    self.assertIsNotNone(storage.latest_index_key('a.cfg').get())
+
+    # Changes made not via import are not visible.
+    self.put_file('foo', 'deadbeef2', 'a.cfg', 'fooo2')
+    self.assertEqual(
+        [('foo', 'deadbeef')], self.get_latest_revisions(['foo'], 'a.cfg'))
+
+  def test_latest_index_updated_on_import(self):
+    self.import_revision('foo', 'rev1', {'a.cfg': 'a1', 'b.cfg': 'b1'})
+    self.import_revision('bar', 'rev1', {'a.cfg': 'a2'})
+    self.assertEqual(
+        [('foo', 'rev1'), ('bar', 'rev1')],
+        self.get_latest_revisions(['foo', 'bar', 'baz'], 'a.cfg'))
+
+    self.import_revision('foo', 'rev2', {'b.cfg': 'b2'})
+    self.import_revision('bar', 'rev2', {'a.cfg': 'a3'})
+    self.import_revision('baz', 'rev1', {'a.cfg': 'a4'})
+    self.assertEqual(
+        [('bar', 'rev2'), ('baz', 'rev1')],
+        self.get_latest_revisions(['foo', 'bar', 'baz'], 'a.cfg'))
+    configs = storage.get_latest_multi_async(['baz'], 'a.cfg').get_result()
+    self.assertEqual('a4', configs[0]['content'])
+    self.assertEqual('https://x.com/+/rev1/a.cfg', configs[0]['url'])
+
+    # Paths that were never requested are not indexed.
+    self.assertIsNone(storage.latest_index_key('b.cfg').get())
+
+  def test_latest_index_chunks(self):
+    self.mock(storage, 'LATEST_INDEX_CHUNK_SIZE', 2)
+    config_sets = ['cs%d' % i for i in xrange(5)]
+    for cs in config_sets:
+      self.import_revision(cs, 'rev1', {'a.cfg': cs})
+    self.assertEqual(
+        [(cs, 'rev1') for cs in config_sets],
+        self.get_latest_revisions(config_sets, 'a.cfg'))
+    self.assertEqual(3, storage.latest_index_key('a.cfg').get().chunk_count)
+
+    # Chunks that are no longer needed are deleted.
+    for cs in config_sets[:4]:
+      self.import_revision(cs, 'rev2', {'b.cfg': cs})
+    self.assertEqual(
+        [('cs4', 'rev1')], self.get_latest_revisions(config_sets, 'a.cfg'))
+    self.assertEqual(1, storage.latest_index_key('a.cfg').get().chunk_count)
+    self.assertEqual(
+        1,
+        storage.LatestConfigIndexChunk.query(
+            ancestor=storage.latest_index_key('a.cfg')).count())
+
+  def test_latest_index_rebuilt_on_concurrent_import(self):
+    self.import_revision('foo', 'rev1', {'a.cfg': 'a1'})
+
+    calls = []
+    def resolve(config_sets, path):
+      if not calls:
+        self.import_revision('bar', 'rev1', {'a.cfg': 'a2'})
+      calls.append(sorted(config_sets))
+      return orig_resolve(config_sets, path)
+    orig_resolve = self.mock(storage, '_resolve_latest_multi_async', resolve)
+
+    self.assertEqual(
+        [('foo', 'rev1'), ('bar', 'rev1')],
+        self.get_latest_revisions(['foo', 'bar'], 'a.cfg'))
+    self.assertEqual([['foo'], ['bar', 'foo']], calls)
+
+  def mock_import_between_index_and_chunks_reads(self):
+    """Imports 'bar' once, after the index is read but before its chunks are."""
+    imported = []
+    def chunk_keys(path, chunk_count):
+      if not imported:
+        imported.append(1)
+        self.import_revision('bar', 'rev1', {'a.cfg': 'a2'})
+      return orig_chunk_keys(path, chunk_count)
+    orig_chunk_keys = self.mock(
+        storage, '_latest_index_chunk_keys', chunk_keys)
+
+  def test_latest_index_read_retried_on_concurrent_import(self):
+    self.mock(storage, 'LATEST_INDEX_CHUNK_SIZE', 1)
+    self.import_revision('foo', 'rev1', {'a.cfg': 'a1'})
+    self.assertEqual(
+        [('foo', 'rev1')], self.get_latest_revisions(['foo', 'bar'], 'a.cfg'))
+
+    # The import moves 'foo' to the second chunk.
+    self.mock_import_between_index_and_chunks_reads()
+    self.assertEqual(
+        [('foo', 'rev1'), ('bar', 'rev1')],
+        self.get_latest_revisions(['foo', 'bar'], 'a.cfg'))
+    self.assertEqual(2, storage.latest_index_key('a.cfg').get().version)
+
+  def test_latest_index_read_gives_up(self):
+    self.mock(storage, 'LATEST_INDEX_CHUNK_SIZE', 1)
+    self.mock(storage, 'LATEST_INDEX_READ_ATTEMPTS', 1)
+    self.import_revision('foo', 'rev1', {'a.cfg': 'a1'})
+    self.get_latest_revisions(['foo'], 'a.cfg')
+
+    # Configs are resolved without the index.
+    self.mock_import_between_index_and_chunks_reads()
+    resolve = mock.Mock(wraps=storage._resolve_latest_multi_async)
+    self.mock(storage, '_resolve_latest_multi_async', resolve)
+    self.assertEqual(
+        [('foo', 'rev1'), ('bar', 'rev1')],
+        self.get_latest_revisions(['foo', 'bar'], 'a.cfg'))
+    self.assertTrue(resolve.called)
+
+  def test_latest_index_build_sees_recent_imports(self):
+    self.import_revision('foo', 'rev1', {'a.cfg': 'a1'})
+    # The ConfigSet query is eventually consistent and may miss 'foo'.
+    query = mock.Mock()
+    query.fetch_async.return_value = future([])
+    self.mock(storage.ConfigSet, 'query', mock.Mock(return_value=query))
+    self.assertEqual(
+        [('foo', 'rev1')], self.get_latest_revisions(['foo'], 'a.cfg'))
+
   def test_get_latest_non_existing_config_set(self):
     revision, content_hash = storage.get_config_hash_async(
         'foo', 'config.yaml').get_result()
@@ -51,14 +51,17 @@ CHUNK_SIZE = 512 * 1024
 FileInfo = collections.namedtuple('FileInfo', ['size'])
 
 
-def list_files(bucket, subdir=None, batch_size=100):
+def list_files(bucket, subdir=None, batch_size=100, marker=None):
   """Yields filenames and stats of files inside subdirectory of a bucket.
 
   It always lists directories recursively.
 
   Arguments:
     bucket: a bucket to list.
-    subdir: subdirectory to list files from or None for an entire bucket.
+    subdir: subdirectory or filename prefix to list files from or None for an
+        entire bucket.
+    marker: if set, only files listed after this filename are yielded. Used to
+        resume a listing.
 
   Yields:
     Tuples of (filename, stats), where filename is relative to the bucket root
@@ -67,7 +70,7 @@ def list_files(bucket, subdir=None, batch_size=100):
   # When listing an entire bucket, gcs expects /<bucket> without ending '/'.
   path_prefix = '/%s/%s' % (bucket, subdir) if subdir else '/%s' % bucket
   bucket_prefix = '/%s/' % bucket
-  marker = None
+  marker = bucket_prefix + marker if marker else None
   retry_params = _make_retry_params()
   while True:
     files_stats = cloudstorage.listbucket(
@@ -94,6 +97,18 @@ def list_files(bucket, subdir=None, batch_size=100):
       break
 
 
+def list_dirs(bucket):
+  """Yields the top level directories of a bucket, with a trailing '/'."""
+  bucket_prefix = '/%s/' % bucket
+  for stat in cloudstorage.listbucket(
+      path_prefix='/%s' % bucket,
+      delimiter='/',
+      retry_params=_make_retry_params()):
+    if stat.is_dir:
+      assert stat.filename.startswith(bucket_prefix)
+      yield stat.filename[len(bucket_prefix):]
+
+
 def delete_file(bucket, filename, ignore_missing=False):
   """Deletes one file stored in GS.
 
@@ -7,6 +7,8 @@
 import binascii
 import hashlib
 import logging
+import Queue
+import threading
 import time
 import zlib
 
@@ -14,6 +16,7 @@ import webapp2
 from google.appengine import runtime
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 import config
@@ -22,6 +25,7 @@ import mapreduce_jobs
 import model
 import stats
 import template
+import ts_mon_metrics
 from components import decorators
 from components import utils
 
@@ -30,6 +34,40 @@ from components import utils
 ITEMS_TO_DELETE_ASYNC = 100
 
 
+# Number of expiration_ts ranges the cleanup of expired ContentEntry is split
+# into, each one processed by its own task.
+CLEANUP_OLD_SHARDS = 16
+
+
+# Number of entries or files processed at once by the cleanup tasks.
+CLEANUP_PAGE_SIZE = 500
+
+
+# Time, in seconds, a cleanup task works before it checkpoints its progress in
+# a continuation task. It must be well below the task queue request deadline.
+CLEANUP_TASK_DURATION = 5*60
+
+
+# Maximum number of tasks leased at once from a pull queue.
+PULL_LEASE_MAX_TASKS = 1000
+
+
+# Duration, in seconds, of the lease of pull tasks. They are processed again if
+# the cron job dies before deleting them.
+PULL_LEASE_DURATION = 5*60
+
+
+# Maximum duration, in seconds, of a single run of a cron job draining a pull
+# queue.
+PULL_CRON_DURATION = 50
+
+
+# Maximum number of GS entries verified by a single 'verify' task, and number
+# of entries verified concurrently by this task.
+VERIFY_BATCH_SIZE = 50
+VERIFY_THREADS = 8
+
+
 ### Utility
 
 
@@ -81,6 +119,141 @@ def payload_to_hashes(request):
       model.MAX_KEYS_PER_DB_OPS)
 
 
+def drain_pull_queue(queue_name, lease, process):
+  """Leases tasks from a pull queue and processes them until it's empty.
+
+  Arguments:
+  - queue_name: name of the pull queue.
+  - lease: callback that accepts a taskqueue.Queue and returns leased tasks.
+  - process: callback that accepts a list of leased tasks and returns the
+             number of push tasks enqueued for them. It raises if they must be
+             processed again.
+
+  Returns a tuple(number of pull tasks processed, number of push tasks).
+  """
+  queue = taskqueue.Queue(queue_name)
+  deadline = time.time() + PULL_CRON_DURATION
+  leased = 0
+  enqueued = 0
+  while time.time() < deadline:
+    tasks = lease(queue)
+    if not tasks:
+      break
+    enqueued += process(tasks)
+    queue.delete_tasks(tasks)
+    leased += len(tasks)
+  return leased, enqueued
+
+
+def map_in_threads(fn, items, num_threads):
+  """Returns [fn(i) for i in items], calling up to |num_threads| at once.
+
+  Exceptions raised by |fn| are returned instead of its result.
+  """
+  results = [None] * len(items)
+  pending = Queue.Queue()
+  for i in enumerate(items):
+    pending.put(i)
+
+  def worker():
+    while True:
+      try:
+        index, item = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[index] = fn(item)
+      except Exception as e:
+        results[index] = e
+
+  threads = [
+    threading.Thread(target=worker)
+    for _ in xrange(min(num_threads, len(items)))
+  ]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results
+
+
+def verify_gs_entry(gs_bucket, entry):
+  """Reads the GS file of |entry| and checks it matches its digest.
+
+  Returns:
+    tuple(error, expanded size, content). |error| is None when the file is
+    valid, otherwise it describes why the entry must be purged. |content| is
+    set only if the file should be saved in memcache.
+
+  Raises:
+    gcs.ForbiddenError, gcs.AuthorizationError on misconfiguration of the
+    Google Storage ACLs and gcs.TransientError, in which case the verification
+    must be retried.
+  """
+  namespace, hash_key = entry.key.id().split('/', 1)
+  # Get GS file size.
+  gs_file_info = gcs.get_file_info(gs_bucket, entry.key.id())
+
+  # It's None if file is missing.
+  if not gs_file_info:
+    # According to the docs, GS is read-after-write consistent, so a file is
+    # missing only if it wasn't stored at all or it was deleted, in any case
+    # it's not a valid ContentEntry.
+    return 'No such GS file', None, None
+
+  # Expected stored length and actual length should match.
+  if gs_file_info.size != entry.compressed_size:
+    return (
+        'Bad GS file: expected size is %d, actual size is %d' % (
+            entry.compressed_size, gs_file_info.size),
+        None, None)
+
+  save_to_memcache = (
+      entry.compressed_size <= model.MAX_MEMCACHE_ISOLATED and
+      entry.is_isolated)
+  expanded_size = 0
+  digest = hashlib.sha1()
+  data = None
+
+  try:
+    # Start a loop where it reads the data in block.
+    stream = gcs.read_file(gs_bucket, entry.key.id())
+    if save_to_memcache:
+      # Wraps stream with a generator that accumulates the data.
+      stream = Accumulator(stream)
+
+    for data in model.expand_content(namespace, stream):
+      expanded_size += len(data)
+      digest.update(data)
+      # Make sure the data is GC'ed.
+      del data
+  except gcs.NotFoundError:
+    # Somebody deleted a file between get_file_info and read_file calls.
+    return 'File was unexpectedly deleted', None, None
+  except (gcs.ForbiddenError, gcs.AuthorizationError):
+    # Misconfiguration in Google Storage ACLs. Don't delete an entry, it may
+    # be fine. Maybe ACL problems would be fixed before the next retry.
+    raise
+  except (gcs.FatalError, zlib.error, IOError) as e:
+    # ForbiddenError and AuthorizationError inherit FatalError, so this except
+    # block should be last.
+    # It's broken or unreadable.
+    return (
+        'Failed to read the file (%s): %s' % (e.__class__.__name__, e),
+        None, None)
+
+  # Hashes should match.
+  if digest.hexdigest() != hash_key:
+    return (
+        'SHA-1 do not match data\n'
+        '%d bytes, %d bytes expanded, expected %d bytes' % (
+            entry.compressed_size, expanded_size, entry.expanded_size),
+        None, None)
+
+  content = ''.join(stream.accumulated) if save_to_memcache else None
+  return None, expanded_size, content
+
+
 def incremental_delete(query, delete, check=None):
   """Applies |delete| to objects in a query asynchrously.
 
@@ -134,6 +307,10 @@ def incremental_delete(query, delete, check=None):
 class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
   """Removes the old data from the datastore.
 
+  The first task splits the expired range of expiration_ts into
+  CLEANUP_OLD_SHARDS shards, each deleted in parallel by its own task. A shard
+  task that runs out of time enqueues its continuation with a query cursor.
+
   Only a task queue task can use this handler.
   """
   # pylint: disable=R0201
@@ -144,11 +321,52 @@ class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
       runtime.DeadlineExceededError)
   @decorators.require_taskqueue('cleanup')
   def post(self):
+    if not self.request.get('end'):
+      self.fan_out()
+      return
+
+    start = long(self.request.get('start'))
+    end = long(self.request.get('end'))
+    cursor = ndb.Cursor(urlsafe=self.request.get('cursor') or None)
     q = model.ContentEntry.query(
-        model.ContentEntry.expiration_ts < utils.utcnow()
-        ).iter(keys_only=True)
-    total = incremental_delete(q, delete=model.delete_entry_and_gs_entry)
-    logging.info('Deleting %s expired entries', total)
+        model.ContentEntry.expiration_ts >= utils.timestamp_to_datetime(start),
+        model.ContentEntry.expiration_ts < utils.timestamp_to_datetime(end))
+    deadline = time.time() + CLEANUP_TASK_DURATION
+    total = 0
+    more = True
+    while more and time.time() < deadline:
+      keys, cursor, more = q.fetch_page(
+          CLEANUP_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+      if keys:
+        model.delete_entry_and_gs_entry(keys)
+        total += len(keys)
+    logging.info('Deleted %d expired entries', total)
+    if more and not utils.enqueue_task(
+        '/internal/taskqueue/cleanup/old', 'cleanup',
+        params={'start': start, 'end': end, 'cursor': cursor.urlsafe()}):
+      self.abort(500, 'Failed to enqueue the continuation, see logs')
+
+  def fan_out(self):
+    """Enqueues one task per shard of expired entries."""
+    now = utils.utcnow()
+    oldest = model.ContentEntry.query(
+        model.ContentEntry.expiration_ts < now).order(
+            model.ContentEntry.expiration_ts).get(
+                projection=[model.ContentEntry.expiration_ts])
+    if not oldest:
+      logging.info('No expired entry')
+      return
+    start = utils.datetime_to_timestamp(oldest.expiration_ts)
+    end = utils.datetime_to_timestamp(now)
+    bounds = [
+      start + (end - start) * i / CLEANUP_OLD_SHARDS
+      for i in xrange(CLEANUP_OLD_SHARDS + 1)
+    ]
+    for lo, hi in zip(bounds, bounds[1:]):
+      if lo < hi and not utils.enqueue_task(
+          '/internal/taskqueue/cleanup/old', 'cleanup',
+          params={'start': lo, 'end': hi}):
+        self.abort(500, 'Failed to enqueue a cleanup shard, see logs')
 
 
 class InternalObliterateWorkerHandler(webapp2.RequestHandler):
@@ -185,6 +403,10 @@ class InternalCleanupTrimLostWorkerHandler(webapp2.RequestHandler):
   It can happen for example when a ContentEntry is deleted without the file
   properly deleted.
 
+  The first task enqueues one task per namespace directory and first hex
+  letter of the digests. A shard task that runs out of time enqueues its
+  continuation with the last listed filename.
+
   Only a task queue task can use this handler.
   """
   # pylint: disable=R0201
@@ -195,48 +417,67 @@ class InternalCleanupTrimLostWorkerHandler(webapp2.RequestHandler):
       runtime.DeadlineExceededError)
   @decorators.require_taskqueue('cleanup')
   def post(self):
-    """Enumerates all GS files and delete those that do not have an associated
+    """Enumerates GS files and delete those that do not have an associated
     ContentEntry.
     """
     gs_bucket = config.settings().gs_bucket
+    prefix = self.request.get('prefix')
+    if not prefix:
+      for directory in gcs.list_dirs(gs_bucket):
+        for letter in '0123456789abcdef':
+          if not utils.enqueue_task(
+              '/internal/taskqueue/cleanup/trim_lost', 'cleanup',
+              params={'prefix': directory + letter}):
+            self.abort(500, 'Failed to enqueue a cleanup shard, see logs')
+      return
 
-    def filter_missing():
-      futures = {}
-      cutoff = time.time() - 60*60
-      for filepath, filestats in gcs.list_files(gs_bucket):
-        # If the file was uploaded in the last hour, ignore it.
-        if filestats.st_ctime >= cutoff:
-          continue
-
-        # This must match the logic in model.get_entry_key(). Since this request
-        # will in practice touch every item, do not use memcache since it'll
-        # mess it up by loading every items in it.
-        # TODO(maruel): Batch requests to use get_multi_async() similar to
-        # datastore_utils.page_queries().
-        future = model.entry_key_from_id(filepath).get_async(
-            use_cache=False, use_memcache=False)
-        futures[future] = filepath
-
-        if len(futures) > 20:
-          future = ndb.Future.wait_any(futures)
-          filepath = futures.pop(future)
-          if future.get_result():
-            continue
-          yield filepath
-      while futures:
-        future = ndb.Future.wait_any(futures)
-        filepath = futures.pop(future)
-        if future.get_result():
-          continue
-        yield filepath
-
-    gs_delete = lambda filenames: gcs.delete_files(gs_bucket, filenames)
-    total = incremental_delete(filter_missing(), gs_delete)
-    logging.info('Deleted %d lost GS files', total)
+    marker = self.request.get('marker') or None
+    cutoff = time.time() - 60*60
+    deadline = time.time() + CLEANUP_TASK_DURATION
+    total = 0
+    page = []
+    done = True
+    for filepath, filestats in gcs.list_files(
+        gs_bucket, prefix, batch_size=CLEANUP_PAGE_SIZE, marker=marker):
+      marker = filepath
+      # If the file was uploaded in the last hour, ignore it.
+      if filestats.st_ctime >= cutoff:
+        continue
+      page.append(filepath)
+      if len(page) == CLEANUP_PAGE_SIZE:
+        total += self.delete_lost(gs_bucket, page)
+        page = []
+        if time.time() >= deadline:
+          done = False
+          break
+    if page:
+      total += self.delete_lost(gs_bucket, page)
+    logging.info('Deleted %d lost GS files in %s', total, prefix)
+    if not done and not utils.enqueue_task(
+        '/internal/taskqueue/cleanup/trim_lost', 'cleanup',
+        params={'prefix': prefix, 'marker': marker}):
+      self.abort(500, 'Failed to enqueue the continuation, see logs')
     # TODO(maruel): Find all the empty directories that are old and remove them.
     # We need to safe guard against the race condition where a user would upload
     # to this directory.
 
+  @staticmethod
+  def delete_lost(gs_bucket, filepaths):
+    """Deletes the files in |filepaths| without a ContentEntry.
+
+    Returns the number of files deleted.
+    """
+    # This must match the logic in model.get_entry_key(). Since this request
+    # will in practice touch every item, do not use memcache since it'll mess
+    # it up by loading every items in it.
+    entities = ndb.get_multi(
+        [model.entry_key_from_id(f) for f in filepaths],
+        use_cache=False, use_memcache=False)
+    lost = [f for f, e in zip(filepaths, entities) if not e]
+    if lost:
+      gcs.delete_files(gs_bucket, lost)
+    return len(lost)
+
 
 class InternalCleanupTriggerHandler(webapp2.RequestHandler):
   """Triggers a taskqueue to clean up."""
@@ -261,6 +502,44 @@ class InternalCleanupTriggerHandler(webapp2.RequestHandler):
       self.abort(404, 'Unknown job')
 
 
+class InternalTagCronHandler(webapp2.RequestHandler):
+  """Drains the 'tag-pull' queue into 'tag' tasks.
+
+  Each preupload request queues the digests it found in a pull task. The digests
+  of many pull tasks of the same namespace are deduplicated and merged into
+  'tag' tasks of up to model.MAX_KEYS_PER_DB_OPS digests.
+  """
+  @decorators.require_cronjob
+  def get(self):
+    leased, enqueued = drain_pull_queue(
+        'tag-pull',
+        lambda queue: queue.lease_tasks_by_tag(
+            PULL_LEASE_DURATION, PULL_LEASE_MAX_TASKS),
+        self.merge)
+    msg = 'Merged %d pull tasks into %d tag tasks' % (leased, enqueued)
+    logging.info(msg)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write(msg)
+
+  def merge(self, tasks):
+    """Enqueues 'tag' tasks for the digests of pull |tasks|."""
+    namespace = tasks[0].tag
+    digest_size = hashlib.sha1().digest_size
+    digests = sorted(set(
+        t.payload[i:i+digest_size]
+        for t in tasks for i in xrange(0, len(t.payload), digest_size)))
+    url = '/internal/taskqueue/tag/%s/%s' % (
+        namespace, utils.datetime_to_timestamp(utils.utcnow()))
+    enqueued = 0
+    for i in xrange(0, len(digests), model.MAX_KEYS_PER_DB_OPS):
+      payload = ''.join(digests[i:i+model.MAX_KEYS_PER_DB_OPS])
+      if not utils.enqueue_task(url, 'tag', payload=payload):
+        # The leases expire and the tasks will be retried.
+        self.abort(500, 'Failed to enqueue a tag task, see logs')
+      enqueued += 1
+    return enqueued
+
+
 class InternalTagWorkerHandler(webapp2.RequestHandler):
   """Tags hot ContentEntry entities that were tested for presence.
 
@@ -285,12 +564,15 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
       futures = ndb.get_multi_async(
           model.get_entry_key(namespace, binascii.hexlify(d)) for d in digests)
 
+      found = []
       to_save = []
       while futures:
         # Return opportunistically the first entity that can be retrieved.
         future = ndb.Future.wait_any(futures)
         futures.remove(future)
         item = future.get_result()
+        if item:
+          found.append(item)
         if item and item.next_tag_ts < now:
           # Update the timestamp. Add a bit of pseudo randomness.
           item.expiration_ts, item.next_tag_ts = model.expiration_jitter(
@@ -298,6 +580,9 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
           to_save.append(item)
       if to_save:
         ndb.put_multi(to_save)
+      # Refresh the presence cache with the new expiration.
+      model.cache_presence(found)
+      model.cache_tagged(found)
       logging.info(
           'Timestamped %d entries out of %s', len(to_save), len(digests))
     except Exception as e:
@@ -336,74 +621,16 @@ class InternalVerifyWorkerHandler(webapp2.RequestHandler):
           'Should not be called with inline content\n%s', original_request)
       return
 
-    # Get GS file size.
     gs_bucket = config.settings().gs_bucket
-    gs_file_info = gcs.get_file_info(gs_bucket, entry.key.id())
-
-    # It's None if file is missing.
-    if not gs_file_info:
-      # According to the docs, GS is read-after-write consistent, so a file is
-      # missing only if it wasn't stored at all or it was deleted, in any case
-      # it's not a valid ContentEntry.
-      self.purge_entry(entry, 'No such GS file\n%s', original_request)
-      return
-
-    # Expected stored length and actual length should match.
-    if gs_file_info.size != entry.compressed_size:
-      self.purge_entry(entry,
-          'Bad GS file: expected size is %d, actual size is %d\n%s',
-          entry.compressed_size, gs_file_info.size,
-          original_request)
-      return
-
-    save_to_memcache = (
-        entry.compressed_size <= model.MAX_MEMCACHE_ISOLATED and
-        entry.is_isolated)
-    expanded_size = 0
-    digest = hashlib.sha1()
-    data = None
-
     try:
-      # Start a loop where it reads the data in block.
-      stream = gcs.read_file(gs_bucket, entry.key.id())
-      if save_to_memcache:
-        # Wraps stream with a generator that accumulates the data.
-        stream = Accumulator(stream)
-
-      for data in model.expand_content(namespace, stream):
-        expanded_size += len(data)
-        digest.update(data)
-        # Make sure the data is GC'ed.
-        del data
-
-      # Hashes should match.
-      if digest.hexdigest() != hash_key:
-        self.purge_entry(entry,
-            'SHA-1 do not match data\n'
-            '%d bytes, %d bytes expanded, expected %d bytes\n%s',
-            entry.compressed_size, expanded_size,
-            entry.expanded_size, original_request)
-        return
-
-    except gcs.NotFoundError as e:
-      # Somebody deleted a file between get_file_info and read_file calls.
-      self.purge_entry(
-          entry, 'File was unexpectedly deleted\n%s', original_request)
-      return
+      error, expanded_size, content = verify_gs_entry(gs_bucket, entry)
     except (gcs.ForbiddenError, gcs.AuthorizationError) as e:
-      # Misconfiguration in Google Storage ACLs. Don't delete an entry, it may
-      # be fine. Maybe ACL problems would be fixed before the next retry.
       logging.warning(
           'CloudStorage auth issues (%s): %s', e.__class__.__name__, e)
       # Abort so the job is retried automatically.
       return self.abort(500)
-    except (gcs.FatalError, zlib.error, IOError) as e:
-      # ForbiddenError and AuthorizationError inherit FatalError, so this except
-      # block should be last.
-      # It's broken or unreadable.
-      self.purge_entry(entry,
-          'Failed to read the file (%s): %s\n%s',
-          e.__class__.__name__, e, original_request)
+    if error:
+      self.purge_entry(entry, '%s\n%s', error, original_request)
       return
 
     # Verified. Data matches the hash.
@@ -413,9 +640,117 @@ class InternalVerifyWorkerHandler(webapp2.RequestHandler):
     logging.info(
         '%d bytes (%d bytes expanded) verified\n%s',
         entry.compressed_size, expanded_size, original_request)
-    if save_to_memcache:
-      model.save_in_memcache(namespace, hash_key, ''.join(stream.accumulated))
+    if content is not None:
+      model.save_in_memcache(namespace, hash_key, content)
     future.wait()
+    model.cache_presence([entry])
+
+
+class InternalVerifyCronHandler(webapp2.RequestHandler):
+  """Drains the 'verify-pull' queue into batched 'verify' tasks.
+
+  finalize_gs_upload queues the id of each new GS entry in a pull task,
+  transactionally with the entity. They are grouped into 'verify' tasks of up
+  to VERIFY_BATCH_SIZE entries.
+  """
+  @decorators.require_cronjob
+  def get(self):
+    backlog = taskqueue.Queue('verify-pull').fetch_statistics().tasks
+    ts_mon_metrics.verify_backlog.set(backlog)
+    leased, enqueued = drain_pull_queue(
+        'verify-pull',
+        lambda queue: queue.lease_tasks(
+            PULL_LEASE_DURATION, PULL_LEASE_MAX_TASKS),
+        self.merge)
+    msg = 'Merged %d pull tasks into %d verify tasks' % (leased, enqueued)
+    logging.info(msg)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write(msg)
+
+  def merge(self, tasks):
+    """Enqueues 'verify' tasks for the entries of pull |tasks|."""
+    key_ids = sorted(set(t.payload for t in tasks))
+    enqueued = 0
+    for i in xrange(0, len(key_ids), VERIFY_BATCH_SIZE):
+      payload = '\n'.join(key_ids[i:i+VERIFY_BATCH_SIZE])
+      if not utils.enqueue_task(
+          '/internal/taskqueue/verify_batch', 'verify', payload=payload):
+        # The leases expire and the tasks will be retried.
+        self.abort(500, 'Failed to enqueue a verify task, see logs')
+      enqueued += 1
+    return enqueued
+
+
+class InternalVerifyBatchWorkerHandler(webapp2.RequestHandler):
+  """Verifies many objects stored in Cloud Storage at once.
+
+  The GS files are read and hashed by VERIFY_THREADS threads, the results are
+  saved with a single put_multi. If any entry couldn't be verified because of a
+  transient error, the task is retried; the entries already verified are then
+  skipped.
+  """
+
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('verify')
+  def post(self):
+    start = time.time()
+    key_ids = [k for k in self.request.body.split('\n') if k]
+    entries = ndb.get_multi([model.entry_key_from_id(k) for k in key_ids])
+    to_verify = [
+      e for e in entries if e and not e.is_verified and e.content is None
+    ]
+    gs_bucket = config.settings().gs_bucket
+    results = map_in_threads(
+        lambda e: verify_gs_entry(gs_bucket, e), to_verify, VERIFY_THREADS)
+
+    verified = []
+    purged = []
+    retried = 0
+    to_memcache = {}
+    for entry, result in zip(to_verify, results):
+      if isinstance(result, Exception):
+        logging.warning(
+            'Failed to verify %s (%s): %s',
+            entry.key.id(), result.__class__.__name__, result)
+        retried += 1
+        continue
+      error, expanded_size, content = result
+      if error:
+        logging.error('Verification failed for %s: %s', entry.key.id(), error)
+        purged.append(entry.key)
+        continue
+      entry.expanded_size = expanded_size
+      entry.is_verified = True
+      verified.append(entry)
+      if content is not None:
+        namespace, hash_key = entry.key.id().split('/', 1)
+        to_memcache.setdefault(namespace, {})[hash_key] = content
+
+    futures = ndb.put_multi_async(verified)
+    for namespace, mapping in to_memcache.iteritems():
+      model.save_multi_in_memcache(namespace, mapping)
+    if purged:
+      model.delete_entry_and_gs_entry(purged)
+    ndb.Future.wait_all(futures)
+    model.cache_presence(verified)
+
+    ts_mon_metrics.verify_entries.increment_by(
+        len(verified), fields={'result': 'verified'})
+    ts_mon_metrics.verify_entries.increment_by(
+        len(purged), fields={'result': 'purged'})
+    ts_mon_metrics.verify_entries.increment_by(
+        retried, fields={'result': 'retried'})
+    ts_mon_metrics.verify_batch_durations.add(time.time() - start)
+    logging.info(
+        'Verified %d, purged %d and retrying %d out of %d entries',
+        len(verified), len(purged), retried, len(key_ids))
+    if retried:
+      # Abort so the job is retried automatically.
+      self.abort(500, 'Failed to verify %d entries' % retried)
 
 
 class InternalStatsUpdateHandler(webapp2.RequestHandler):
@@ -459,6 +794,9 @@ def get_routes():
         r'/internal/cron/cleanup/trigger/<name:[a-z_]+>',
         InternalCleanupTriggerHandler),
 
+    webapp2.Route(r'/internal/cron/tag', InternalTagCronHandler),
+    webapp2.Route(r'/internal/cron/verify', InternalVerifyCronHandler),
+
     # Cleanup tasks.
     webapp2.Route(
         r'/internal/taskqueue/cleanup/old',
@@ -477,6 +815,8 @@ def get_routes():
     webapp2.Route(
         r'/internal/taskqueue/verify%s' % namespace_key,
         InternalVerifyWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/verify_batch', InternalVerifyBatchWorkerHandler),
 
     # Stats
     webapp2.Route(
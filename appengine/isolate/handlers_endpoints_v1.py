@@ -8,7 +8,6 @@ import binascii
 import datetime
 import hashlib
 import logging
-import os
 import re
 import time
 import zlib
@@ -40,6 +39,23 @@ import stats
 MIN_SIZE_FOR_GS = 501
 
 
+# Maximum number of entries and total content size, in bytes, accepted in a
+# single store_inline_batch request.
+MAX_STORE_BATCH_ITEMS = 1000
+MAX_STORE_BATCH_SIZE = 10*1024*1024
+
+
+# Maximum number of entries that can be requested in a single retrieve_batch
+# request, and maximum total size of the inline content returned.
+MAX_RETRIEVE_BATCH_ITEMS = 1000
+MAX_RETRIEVE_BATCH_SIZE = 10*1024*1024
+
+
+# Maximum number of .isolated files that can be resolved when expanding a
+# single .isolated file and its includes.
+MAX_EXPANDED_ISOLATED = 1000
+
+
 ### Request Types
 
 
@@ -69,6 +85,11 @@ class StorageRequest(messages.Message):
   content = messages.BytesField(2)
 
 
+class StorageBatchRequest(messages.Message):
+  """ProtoRPC message representing many small entities to be added at once."""
+  items = messages.MessageField(StorageRequest, 1, repeated=True)
+
+
 class FinalizeRequest(messages.Message):
   """Request to validate upload of large Google storage entities."""
   upload_ticket = messages.StringField(1)
@@ -81,6 +102,23 @@ class RetrieveRequest(messages.Message):
   offset = messages.IntegerField(3, default=0)
 
 
+class RetrieveBatchRequest(messages.Message):
+  """Request to retrieve many entries at once."""
+  digests = messages.StringField(1, repeated=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
+class ExpandIsolatedRequest(messages.Message):
+  """Request to expand an .isolated file and all its includes.
+
+  If |cached| is set, only the files whose content is not listed in it are
+  returned.
+  """
+  digest = messages.StringField(1)
+  namespace = messages.MessageField(Namespace, 2)
+  cached = messages.StringField(3, repeated=True)
+
+
 ### Response Types
 
 
@@ -102,6 +140,47 @@ class RetrievedContent(messages.Message):
   url = messages.StringField(2)
 
 
+class RetrievedBatchItem(messages.Message):
+  """Content or GS URL of one entry retrieved in a batch."""
+  digest = messages.StringField(1)
+  content = messages.BytesField(2)
+  url = messages.StringField(3)
+
+
+class RetrievedBatch(messages.Message):
+  """Entries retrieved in a batch.
+
+  Entries that were not found, or that didn't fit in the response, are omitted
+  and must be retrieved individually.
+  """
+  items = messages.MessageField(RetrievedBatchItem, 1, repeated=True)
+
+
+class ExpandedFile(messages.Message):
+  """A file listed in an expanded .isolated file."""
+  path = messages.StringField(1)
+  digest = messages.StringField(2)
+  size = messages.IntegerField(3)
+  mode = messages.IntegerField(4)
+  link = messages.StringField(5)
+  # File type, e.g. 'ar' for a bundle of small files. Not set for basic files.
+  type = messages.StringField(6)
+
+
+class ExpandedIsolated(messages.Message):
+  """An .isolated file flattened with all its includes.
+
+  |isolated| lists the digests of the .isolated files resolved, in traversal
+  order. The other fields are set from the first .isolated file defining them,
+  like the client does.
+  """
+  files = messages.MessageField(ExpandedFile, 1, repeated=True)
+  isolated = messages.StringField(2, repeated=True)
+  command = messages.StringField(3, repeated=True)
+  read_only = messages.IntegerField(4)
+  relative_cwd = messages.StringField(5)
+
+
 class PushPing(messages.Message):
   """Indicates whether data storage executed successfully."""
   ok = messages.BooleanField(1)
@@ -130,15 +209,15 @@ class TokenSigner(auth.TokenKind):
 
 
 @ndb.transactional
-def store_and_enqueue_verify_task(entry, task_queue_host):
+def store_and_enqueue_verify_task(entry):
+  """Stores |entry| and queues it for verification in the 'verify-pull' queue.
+
+  A cron job groups the queued entries into batched 'verify' tasks.
+  """
   entry.put()
-  taskqueue.add(
-      url='/internal/taskqueue/verify/%s' % entry.key.id(),
-      params={'req': os.environ['REQUEST_LOG_ID']},
-      queue_name='verify',
-      headers={'Host': task_queue_host},
-      transactional=True,
-  )
+  taskqueue.Queue('verify-pull').add(
+      taskqueue.Task(payload=entry.key.id(), method='PULL'),
+      transactional=True)
 
 
 def entry_key_or_error(namespace, digest):
@@ -168,6 +247,50 @@ def hash_content(content, namespace):
     raise ValueError('Data is corrupted: %s' % e)
 
 
+def expand_isolated(namespace, digest):
+  """Resolves an .isolated file and its includes into an ExpandedIsolated.
+
+  The includes are walked depth first, left to right, and the first .isolated
+  file to list a path wins, which matches IsolatedBundle in the client.
+  """
+  response = ExpandedIsolated()
+  files = {}
+  seen = set()
+  stack = [digest]
+  while stack:
+    h = stack.pop()
+    if h in seen:
+      raise endpoints.BadRequestException(
+          '%s is included recursively.' % h)
+    seen.add(h)
+    if len(seen) > MAX_EXPANDED_ISOLATED:
+      raise endpoints.BadRequestException(
+          'Only up to %d .isolated files can be expanded at once.' %
+          MAX_EXPANDED_ISOLATED)
+    try:
+      data = model.get_isolated(namespace, h)
+    except LookupError:
+      raise endpoints.NotFoundException('Unable to retrieve %s.' % h)
+    except ValueError as e:
+      raise endpoints.BadRequestException(str(e))
+    response.isolated.append(h)
+    for path, props in data.get('files', {}).iteritems():
+      files.setdefault(path, props)
+    if not response.command and data.get('command'):
+      response.command = data['command']
+    if response.read_only is None and data.get('read_only') is not None:
+      response.read_only = data['read_only']
+    if response.relative_cwd is None and data.get('relative_cwd') is not None:
+      response.relative_cwd = data['relative_cwd']
+    stack.extend(reversed(data.get('includes', [])))
+  for path in sorted(files):
+    props = files[path]
+    response.files.append(ExpandedFile(
+        path=path, digest=props.get('h'), size=props.get('s'),
+        mode=props.get('m'), link=props.get('l'), type=props.get('t')))
+  return response
+
+
 ### API
 
 
@@ -259,6 +382,39 @@ class IsolateService(remote.Service):
     """Stores relatively small entities in the datastore."""
     return self.storage_helper(request, False)
 
+  @auth.endpoints_method(StorageBatchRequest, PushPing)
+  @auth.require(acl.isolate_writable)
+  def store_inline_batch(self, request):
+    """Stores many relatively small entities in the datastore at once.
+
+    All the entries are validated before anything is stored, so either all of
+    them are stored or none.
+    """
+    if len(request.items) > MAX_STORE_BATCH_ITEMS:
+      raise endpoints.BadRequestException(
+          'Only up to %d items can be stored at once' % MAX_STORE_BATCH_ITEMS)
+    total_size = sum(len(i.content or '') for i in request.items)
+    if total_size > MAX_STORE_BATCH_SIZE:
+      raise endpoints.BadRequestException(
+          'Only up to %d bytes can be stored at once' % MAX_STORE_BATCH_SIZE)
+
+    entries = []
+    # dict(namespace, dict(digest, content)) for memcache.
+    to_cache = {}
+    for item in request.items:
+      entry, namespace, digest = self.new_entry_from_ticket(
+          item.upload_ticket, item.content or '', False)
+      entries.append(entry)
+      to_cache.setdefault(namespace, {})[digest] = entry.content
+
+    ndb.put_multi(entries)
+    for namespace, mapping in to_cache.iteritems():
+      model.save_multi_in_memcache(namespace, mapping)
+    model.cache_presence(entries)
+    stats.add_entry(
+        stats.STORE, total_size, 'inline; batch of %d' % len(entries))
+    return PushPing(ok=True)
+
   @auth.endpoints_method(FinalizeRequest, PushPing)
   @auth.require(acl.isolate_writable)
   def finalize_gs_upload(self, request):
@@ -316,6 +472,101 @@ class IsolateService(remote.Service):
         filename=key.id(),
         expiration=DEFAULT_LINK_EXPIRATION))
 
+  @auth.endpoints_method(RetrieveBatchRequest, RetrievedBatch)
+  @auth.require(acl.isolate_readable)
+  def retrieve_batch(self, request):
+    """Retrieves many entries at once.
+
+    Inline content is returned up to MAX_RETRIEVE_BATCH_SIZE bytes in total,
+    entries stored in GS are returned as signed URLs.
+    """
+    if not request.namespace:
+      raise endpoints.BadRequestException('namespace is required.')
+    if len(request.digests) > MAX_RETRIEVE_BATCH_ITEMS:
+      raise endpoints.BadRequestException(
+          'Only up to %d items can be retrieved at once' %
+          MAX_RETRIEVE_BATCH_ITEMS)
+    namespace = request.namespace.namespace
+    digests = [d.encode('utf-8') for d in request.digests]
+
+    # Try memcache first, then the datastore for the misses.
+    found = memcache.get_multi(digests, namespace='table_%s' % namespace)
+    missing = [d for d in digests if d not in found]
+    entities = ndb.get_multi(
+        [entry_key_or_error(namespace, d) for d in missing])
+    stored = dict(zip(missing, entities))
+
+    response = RetrievedBatch()
+    total_size = 0
+    hits = 0
+    for digest in digests:
+      content = found.get(digest)
+      entity = stored.get(digest)
+      if content is None and entity is not None:
+        content = entity.content
+      if content is not None:
+        if total_size + len(content) > MAX_RETRIEVE_BATCH_SIZE:
+          continue
+        total_size += len(content)
+        response.items.append(
+            RetrievedBatchItem(digest=digest, content=content))
+      elif entity is not None:
+        response.items.append(RetrievedBatchItem(
+            digest=digest,
+            url=self.gs_url_signer.get_download_url(
+                filename=entity.key.id(),
+                expiration=DEFAULT_LINK_EXPIRATION)))
+      else:
+        continue
+      hits += 1
+    logging.debug('Retrieved %d out of %d', hits, len(digests))
+    stats.add_entry(stats.RETURN, total_size, 'batch of %d' % hits)
+    return response
+
+  @auth.endpoints_method(ExpandIsolatedRequest, ExpandedIsolated)
+  @auth.require(acl.isolate_readable)
+  def expand_isolated(self, request):
+    """Returns the flattened list of files of an .isolated file.
+
+    The includes are resolved server side, so the client doesn't have to fetch
+    them one level at a time.
+    """
+    if not request.digest:
+      raise endpoints.BadRequestException('digest is required.')
+    if not request.namespace:
+      raise endpoints.BadRequestException('namespace is required.')
+    response = expand_isolated(request.namespace.namespace, request.digest)
+    logging.debug(
+        '%s: %d files in %d .isolated', request.digest, len(response.files),
+        len(response.isolated))
+    return response
+
+  @auth.endpoints_method(ExpandIsolatedRequest, ExpandedIsolated)
+  @auth.require(acl.isolate_readable)
+  def missing_from_isolated(self, request):
+    """Returns the files of an .isolated file that the client doesn't have.
+
+    Same as expand_isolated, except that files whose digest is in
+    |request.cached| and files without content (symlinks) are omitted, and that
+    each missing content is listed only once.
+    """
+    if not request.digest:
+      raise endpoints.BadRequestException('digest is required.')
+    if not request.namespace:
+      raise endpoints.BadRequestException('namespace is required.')
+    response = expand_isolated(request.namespace.namespace, request.digest)
+    seen = set(request.cached)
+    files = []
+    for f in response.files:
+      if f.digest and f.digest not in seen:
+        seen.add(f.digest)
+        files.append(f)
+    logging.debug(
+        '%s: %d missing out of %d files', request.digest, len(files),
+        len(response.files))
+    response.files = files
+    return response
+
   @auth.endpoints_method(message_types.VoidMessage, ServerDetails)
   @auth.require(acl.isolate_readable)
   def server_details(self, _request):
@@ -324,70 +575,56 @@ class IsolateService(remote.Service):
   ### Utility
 
   @staticmethod
-  def storage_helper(request, uploaded_to_gs):
-    """Implement shared logic between store_inline and finalize_gs.
+  def validate_ticket(upload_ticket, uploaded_to_gs):
+    """Validates an upload ticket generated by preupload.
 
-    Arguments:
-      request: either StorageRequest or FinalizeRequest.
-      uploaded_to_gs: bool.
+    Returns:
+      tuple(digest, is_isolated, namespace, size, ContentEntry key).
+
+    Raises:
+      BadRequestException if the ticket is invalid.
     """
-    if not request.upload_ticket:
+    if not upload_ticket:
       raise endpoints.BadRequestException(
           'Upload ticket was empty or not provided.')
     try:
       embedded = TokenSigner.validate(
-          request.upload_ticket, UPLOAD_MESSAGES[uploaded_to_gs])
+          upload_ticket, UPLOAD_MESSAGES[uploaded_to_gs])
     except (auth.InvalidTokenError, ValueError) as error:
       raise endpoints.BadRequestException(
           'Ticket validation failed: %s' % error.message)
 
     digest = embedded['d'].encode('utf-8')
-    is_isolated = bool(int(embedded['i']))
     namespace = embedded['n']
-    size = int(embedded['s'])
-    key = entry_key_or_error(namespace, digest)
+    return (
+        digest, bool(int(embedded['i'])), namespace, int(embedded['s']),
+        entry_key_or_error(namespace, digest))
 
-    if uploaded_to_gs:
-      # Ensure that file info is uploaded to GS first.
-      file_info = gcs.get_file_info(config.settings().gs_bucket, key.id())
-      if not file_info:
-        logging.debug('%s', digest)
-        raise endpoints.BadRequestException(
-            'File should be in Google Storage.\nFile: \'%s\' Size: %d.' % (
-                key.id(), size))
-      content = None
-      compressed_size = file_info.size
-    else:
-      content = request.content
-      compressed_size = len(content)
+  @classmethod
+  def storage_helper(cls, request, uploaded_to_gs):
+    """Implement shared logic between store_inline and finalize_gs.
+
+    Arguments:
+      request: either StorageRequest or FinalizeRequest.
+      uploaded_to_gs: bool.
+    """
+    entry, _, digest = cls.new_entry_from_ticket(
+        request.upload_ticket,
+        None if uploaded_to_gs else request.content,
+        uploaded_to_gs)
 
     # Look if the entity was already stored. Alert in that case but ignore it.
-    if key.get():
+    if entry.key.get():
       # TODO(maruel): Handle these more gracefully.
       logging.warning('Overwritting ContentEntry\n%s', digest)
 
-    entry = model.new_content_entry(
-        key=key,
-        is_isolated=is_isolated,
-        compressed_size=compressed_size,
-        expanded_size=size,
-        is_verified=not uploaded_to_gs,
-        content=content,
-    )
-
     if not uploaded_to_gs:
-      # Assert that embedded content is the data sent by the request.
-      logging.debug('%s', digest)
-      if (digest, size) != hash_content(content, namespace):
-        raise endpoints.BadRequestException(
-            'Embedded digest does not match provided data: '
-            '(digest, size): (%r, %r); expected: %r' % (
-                digest, size, hash_content(content, namespace)))
       entry.put()
+      model.cache_presence([entry])
     else:
       # Enqueue verification task transactionally as the entity is stored.
       try:
-        store_and_enqueue_verify_task(entry, utils.get_task_queue_host())
+        store_and_enqueue_verify_task(entry)
       except (
           datastore_errors.Error,
           runtime.apiproxy_errors.CancelledError,
@@ -403,6 +640,50 @@ class IsolateService(remote.Service):
         'GS; %s' % entry.key.id() if uploaded_to_gs else 'inline')
     return PushPing(ok=True)
 
+  @classmethod
+  def new_entry_from_ticket(cls, upload_ticket, content, uploaded_to_gs):
+    """Validates an upload and returns the ContentEntry to store for it.
+
+    Arguments:
+      upload_ticket: ticket returned by preupload for the entry.
+      content: embedded content, None if |uploaded_to_gs|.
+      uploaded_to_gs: bool.
+
+    Returns:
+      Tuple (ContentEntry that is not stored yet, namespace, digest).
+    """
+    digest, is_isolated, namespace, size, key = cls.validate_ticket(
+        upload_ticket, uploaded_to_gs)
+
+    if uploaded_to_gs:
+      # Ensure that file info is uploaded to GS first.
+      file_info = gcs.get_file_info(config.settings().gs_bucket, key.id())
+      if not file_info:
+        logging.debug('%s', digest)
+        raise endpoints.BadRequestException(
+            'File should be in Google Storage.\nFile: \'%s\' Size: %d.' % (
+                key.id(), size))
+      compressed_size = file_info.size
+    else:
+      # Assert that embedded content is the data sent by the request.
+      logging.debug('%s', digest)
+      if (digest, size) != hash_content(content, namespace):
+        raise endpoints.BadRequestException(
+            'Embedded digest does not match provided data: '
+            '(digest, size): (%r, %r); expected: %r' % (
+                digest, size, hash_content(content, namespace)))
+      compressed_size = len(content)
+
+    entry = model.new_content_entry(
+        key=key,
+        is_isolated=is_isolated,
+        compressed_size=compressed_size,
+        expanded_size=size,
+        is_verified=not uploaded_to_gs,
+        content=content,
+    )
+    return entry, namespace, digest
+
   @classmethod
   def generate_ticket(cls, digest, namespace):
     """Generates an HMAC-SHA1 signature for a given set of parameters.
@@ -437,33 +718,54 @@ class IsolateService(remote.Service):
   def check_entries_exist(entries):
     """Assess which entities already exist in the datastore.
 
+    The presence cache is consulted first, the datastore is only looked up for
+    the cache misses. Verified entities found in the datastore are added to the
+    presence cache.
+
     Arguments:
       entries: a DigestCollection to be posted
 
     Yields:
-      (Digest, ContentEntry or None)
+      (Digest, expanded size of the ContentEntry or None if missing)
 
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
-    # Kick off all queries in parallel. Build mapping Future -> digest.
+    keys = [
+      (digest, entry_key_or_error(entries.namespace.namespace, digest.digest))
+      for digest in entries.items
+    ]
+    cached = model.get_cached_presence([key for _, key in keys])
+
+    # Kick off all queries for the cache misses in parallel. Build mapping
+    # Future -> digest.
     futures = {}
-    for digest in entries.items:
-      # check for error conditions
-      key = entry_key_or_error(entries.namespace.namespace, digest.digest)
-      futures[key.get_async(use_cache=False)] = digest
+    for digest, key in keys:
+      if key.id() in cached:
+        yield digest, cached[key.id()]
+      else:
+        futures[key.get_async(use_cache=False)] = digest
 
     # Pick first one that finishes and yield it, rinse, repeat.
+    found = []
     while futures:
       future = ndb.Future.wait_any(futures)
-      yield futures.pop(future), future.get_result()
+      digest = futures.pop(future)
+      obj = future.get_result()
+      if not obj:
+        yield digest, None
+        continue
+      found.append(obj)
+      yield digest, obj.expanded_size if obj.expanded_size is not None else -1
+    model.cache_presence(found)
 
   @classmethod
   def partition_collection(cls, entries):
     """Create sets of existent and new digests."""
     seen_unseen = [set(), set()]
-    for digest, obj in cls.check_entries_exist(entries):
-      if obj and obj.expanded_size != digest.size:
+    for digest, expanded_size in cls.check_entries_exist(entries):
+      exists = expanded_size is not None
+      if exists and expanded_size != digest.size:
         # It is important to note that when a file is uploaded to GCS,
         # ContentEntry is only stored in the finalize call, which is (supposed)
         # to be called only after the GCS upload completed successfully.
@@ -492,7 +794,7 @@ class IsolateService(remote.Service):
             'Upload race.\n%s is not yet fully uploaded.', digest.digest)
         # TODO(maruel): Force the client to upload.
         #obj = None
-      seen_unseen[bool(obj)].add(digest)
+      seen_unseen[exists].add(digest)
     logging.debug(
         'Hit:%s',
         ''.join(sorted('\n%s' % d.digest for d in seen_unseen[True])))
@@ -525,21 +827,30 @@ class IsolateService(remote.Service):
 
   @staticmethod
   def tag_existing(collection):
-    """Tag existing digests with new timestamp.
+    """Queues existing digests to be tagged with a new timestamp.
+
+    Digests that were tagged recently or that are already queued are skipped.
+    The others are added to the 'tag-pull' pull queue, which a cron job drains
+    in large batches.
 
     Arguments:
       collection: a DigestCollection containing existing digests
 
     Returns:
-      the enqueued task if there were existing entries; None otherwise
+      the enqueued task if there were digests to tag; None otherwise
     """
-    if collection.items:
-      url = '/internal/taskqueue/tag/%s/%s' % (
-          collection.namespace.namespace,
-          utils.datetime_to_timestamp(utils.utcnow()))
-      payload = ''.join(
-          binascii.unhexlify(digest.digest) for digest in collection.items)
-      return utils.enqueue_task(url, 'tag', payload=payload)
+    namespace = collection.namespace.namespace
+    digests = model.filter_recently_tagged(
+        namespace, [digest.digest for digest in collection.items])
+    if not digests:
+      return None
+    payload = ''.join(binascii.unhexlify(digest) for digest in digests)
+    try:
+      return taskqueue.Queue('tag-pull').add(
+          taskqueue.Task(payload=payload, method='PULL', tag=namespace))
+    except (taskqueue.Error, runtime.DeadlineExceededError) as e:
+      logging.warning('Failed to queue %d digests to tag: %s', len(digests), e)
+      return None
 
 
 def get_routes():
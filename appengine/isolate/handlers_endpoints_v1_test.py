@@ -4,6 +4,8 @@
 # that can be found in the LICENSE file.
 
 import base64
+import binascii
+import datetime
 import hashlib
 import json
 import logging
@@ -246,8 +248,57 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
         'preupload', self.message_to_dict(collection), 200)
 
     # find enqueued tasks
-    enqueued_tasks = self.execute_tasks()
-    self.assertEqual(1, enqueued_tasks)
+    tasks = taskqueue.Queue('tag-pull').lease_tasks(60, 100)
+    self.assertEqual(1, len(tasks))
+
+  def test_pre_upload_presence_cache(self):
+    """Assert that preupload consults the presence cache before datastore."""
+    content = 'Ode on Melancholy'
+    request = self.store_request(content)
+    self.call_api('store_inline', self.message_to_dict(request), 200)
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+    key = model.get_entry_key(embedded['n'], embedded['d'])
+    collection = self.message_to_dict(generate_collection([content]))
+
+    # Deleting the entity behind the cache's back is not noticed.
+    key.delete()
+    response = self.call_api('preupload', collection, 200)
+    self.assertEqual([], response.json.get('items', []))
+
+    # The presence is forgotten when deleted through the normal path.
+    self.mock(gcs, 'delete_file', lambda *_args, **_kwargs: None)
+    model.delete_entry_and_gs_entry([key])
+    response = self.call_api('preupload', collection, 200)
+    self.assertEqual(1, len(response.json['items']))
+    self.assertEqual(
+        1, len(taskqueue.Queue('tag-pull').lease_tasks(60, 100)))
+
+  def test_pre_upload_tag_coalesced(self):
+    """Assert that existing digests are queued for tagging only once."""
+    content = 'Ozymandias'
+    request = self.store_request(content)
+    self.call_api('store_inline', self.message_to_dict(request), 200)
+    collection = generate_collection([content])
+    for _ in xrange(3):
+      self.call_api('preupload', self.message_to_dict(collection), 200)
+    tasks = taskqueue.Queue('tag-pull').lease_tasks(60, 100)
+    self.assertEqual(1, len(tasks))
+    self.assertEqual('default', tasks[0].tag)
+    self.assertEqual(
+        binascii.unhexlify(hash_content(content)), tasks[0].payload)
+
+    # Once tagged, the digest isn't queued until its next_tag_ts.
+    entry = model.get_entry_key('default', hash_content(content)).get()
+    model.cache_tagged([entry])
+    second = datetime.timedelta(seconds=1)
+    self.mock(utils, 'utcnow', lambda: entry.next_tag_ts - second)
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([], taskqueue.Queue('tag-pull').lease_tasks(60, 100))
+    self.mock(utils, 'utcnow', lambda: entry.next_tag_ts + second)
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(
+        1, len(taskqueue.Queue('tag-pull').lease_tasks(60, 100)))
 
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
@@ -309,6 +360,33 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'store_inline', self.message_to_dict(request), 200)
 
+  def test_store_inline_batch_ok(self):
+    """Assert that many entities can be stored in a single call."""
+    contents = ['Hyperion', 'Lamia', '']
+    requests = [self.store_request(c) for c in contents]
+    batch = handlers_endpoints_v1.StorageBatchRequest(items=requests)
+    self.call_api('store_inline_batch', self.message_to_dict(batch), 200)
+    for request, content in zip(requests, contents):
+      embedded = validate(
+          request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+      stored = model.get_entry_key(embedded['n'], embedded['d']).get()
+      self.assertEqual(content, stored.content)
+      self.assertTrue(stored.is_verified)
+      self.assertEqual(
+          content, memcache.get(embedded['d'], namespace='table_default'))
+
+  def test_store_inline_batch_bad_digest(self):
+    """Assert that nothing is stored if any item in the batch is invalid."""
+    good = self.store_request('Endymion')
+    bad = self.store_request('Otho the Great')
+    bad.content = ':)' + bad.content[2:]
+    batch = handlers_endpoints_v1.StorageBatchRequest(items=[good, bad])
+    with self.call_should_fail('400'):
+      self.call_api('store_inline_batch', self.message_to_dict(batch), 200)
+    embedded = validate(
+        good.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+    self.assertIsNone(model.get_entry_key(embedded['n'], embedded['d']).get())
+
   def test_finalized_data_in_gs(self):
     """Assert that data are actually in GS when finalized."""
     # create content
@@ -325,7 +403,8 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     with self.call_should_fail('400'):
       self.call_api(
           'finalize_gs_upload', self.message_to_dict(request), 200)
-    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(
+        1, len(taskqueue.Queue('verify-pull').lease_tasks(60, 100)))
 
   def test_finalized_no_upload_ticket(self):
     """Assert that GS finalization fails when there is no ticket."""
@@ -357,16 +436,10 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     # ensure that verification occurs
     self.mock(gcs, 'read_file', lambda _bucket, _key: content)
 
-    # add a side effect in execute_tasks()
-    # TODO(cmassaro): there must be a better way than this
-    def set_verified():
-      stored_entry = stored.key.get()
-      if not stored_entry.is_verified:
-        stored_entry.is_verified = True
-    self.mock_side_effect(self._taskqueue_stub, 'DeleteTask', set_verified)
-
-    # assert that verification occurs in the taskqueue
+    # assert that verification occurs in the taskqueue, once the cron job
+    # batched the pending entries
     self.assertFalse(stored.key.get().is_verified)
+    self.app.get('/internal/cron/verify', headers={'X-AppEngine-Cron': 'true'})
     self.assertEqual(1, self.execute_tasks())
     self.assertTrue(stored.key.get().is_verified)
 
@@ -464,8 +537,9 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     self.assertNotEqual(retrieved.get(u'url', ''), '')
     self.assertTrue(retrieved.get(u'url', '').startswith(self.store_prefix))
 
-    # clear the taskqueue
-    self.assertEqual(1, self.execute_tasks())
+    # the entry is queued for verification
+    self.assertEqual(
+        1, len(taskqueue.Queue('verify-pull').lease_tasks(60, 100)))
 
   def test_retrieve_partial_ok(self):
     """Assert that content retrieval works when a range is specified."""
@@ -526,6 +600,122 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'retrieve', self.message_to_dict(retrieve_request), 200)
 
+  def test_retrieve_batch_ok(self):
+    """Assert that many entries can be retrieved in a single call."""
+    contents = ['Hyperion', 'Lamia']
+    digests = []
+    for content in contents:
+      request = self.store_request(content)
+      self.call_api('store_inline', self.message_to_dict(request), 200)
+      digests.append(hash_content(content))
+    # One from memcache, one from the datastore, one missing.
+    memcache.delete(digests[1], namespace='table_default')
+    memcache.set(digests[0], contents[0], namespace='table_default')
+    missing = hash_content('Isabella')
+    request = handlers_endpoints_v1.RetrieveBatchRequest(
+        digests=digests + [missing],
+        namespace=handlers_endpoints_v1.Namespace())
+    response = self.call_api(
+        'retrieve_batch', self.message_to_dict(request), 200)
+    items = response.json['items']
+    self.assertEqual(digests, [i['digest'] for i in items])
+    self.assertEqual(
+        contents, [base64.b64decode(i['content']) for i in items])
+
+  def test_retrieve_batch_size_cap(self):
+    """Assert that entries not fitting in the response are omitted."""
+    self.mock(handlers_endpoints_v1, 'MAX_RETRIEVE_BATCH_SIZE', 10)
+    contents = ['Ode to Psyche', 'Ode']
+    for content in contents:
+      request = self.store_request(content)
+      self.call_api('store_inline', self.message_to_dict(request), 200)
+    request = handlers_endpoints_v1.RetrieveBatchRequest(
+        digests=[hash_content(c) for c in contents],
+        namespace=handlers_endpoints_v1.Namespace())
+    response = self.call_api(
+        'retrieve_batch', self.message_to_dict(request), 200)
+    self.assertEqual(
+        [hash_content('Ode')], [i['digest'] for i in response.json['items']])
+
+  def store_isolated(self, data):
+    """Stores an .isolated file and returns its digest."""
+    content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    request = self.store_request(content)
+    self.call_api('store_inline', self.message_to_dict(request), 200)
+    return hash_content(content)
+
+  def test_expand_isolated_ok(self):
+    """Assert that includes are resolved, the embedding .isolated winning."""
+    leaf = self.store_isolated({
+      'files': {
+        'a': {'h': hash_content('old a'), 's': 5},
+        'c': {'h': hash_content('c'), 's': 1},
+        'd': {'h': hash_content('d'), 's': 1, 't': 'ar'},
+      },
+      'read_only': 1,
+    })
+    middle = self.store_isolated({
+      'files': {'b': {'l': 'c'}},
+      'includes': [leaf],
+      'relative_cwd': 'out',
+    })
+    root = self.store_isolated({
+      'command': ['run'],
+      'files': {'a': {'h': hash_content('a'), 'm': 0600, 's': 1}},
+      'includes': [middle],
+    })
+    request = handlers_endpoints_v1.ExpandIsolatedRequest(
+        digest=root, namespace=handlers_endpoints_v1.Namespace())
+    response = self.call_api(
+        'expand_isolated', self.message_to_dict(request), 200)
+    expected = {
+      u'command': [u'run'],
+      u'files': [
+        {u'digest': hash_content('a'), u'mode': u'384', u'path': u'a',
+         u'size': u'1'},
+        {u'link': u'c', u'path': u'b'},
+        {u'digest': hash_content('c'), u'path': u'c', u'size': u'1'},
+        {u'digest': hash_content('d'), u'path': u'd', u'size': u'1',
+         u'type': u'ar'},
+      ],
+      u'isolated': [root, middle, leaf],
+      u'read_only': u'1',
+      u'relative_cwd': u'out',
+    }
+    self.assertEqual(expected, response.json)
+
+    # The parsed files are cached.
+    self.assertTrue(memcache.get(
+        'default/%s' % leaf, namespace=model.ISOLATED_MEMCACHE_NAMESPACE))
+
+  def test_expand_isolated_recursive(self):
+    """Assert that an .isolated file included twice is rejected."""
+    leaf = self.store_isolated({'files': {}})
+    root = self.store_isolated({'includes': [leaf, leaf]})
+    request = handlers_endpoints_v1.ExpandIsolatedRequest(
+        digest=root, namespace=handlers_endpoints_v1.Namespace())
+    with self.call_should_fail('400'):
+      self.call_api('expand_isolated', self.message_to_dict(request), 200)
+
+  def test_missing_from_isolated_ok(self):
+    """Assert that only the contents the client lacks are returned."""
+    root = self.store_isolated({
+      'files': {
+        'a': {'h': hash_content('a'), 's': 1},
+        'b': {'h': hash_content('b'), 's': 1},
+        'c': {'h': hash_content('b'), 's': 1},
+        'd': {'l': 'a'},
+      },
+    })
+    request = handlers_endpoints_v1.ExpandIsolatedRequest(
+        digest=root, namespace=handlers_endpoints_v1.Namespace(),
+        cached=[hash_content('a')])
+    response = self.call_api(
+        'missing_from_isolated', self.message_to_dict(request), 200)
+    self.assertEqual(
+        [{u'digest': hash_content('b'), u'path': u'b', u'size': u'1'}],
+        response.json['files'])
+
   def test_server_details_ok(self):
     """Assert that server_details returns the correct version."""
     response = self.call_api('server_details', {}, 200).json
@@ -30,6 +30,19 @@ from components import utils
 from gviz import gviz_api
 
 
+# App Engine puts a limit of 33554432 bytes on a response, which includes
+# headers. Headers are ~150 bytes.
+MAX_RESPONSE_SIZE = 33554000
+
+
+# Content up to this size is formatted as JSON by ContentHandler, larger content
+# is streamed as-is. It matches the .isolated files kept in memcache.
+MAX_FORMATTED_SIZE = model.MAX_MEMCACHE_ISOLATED
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
 # GViz data description.
 _GVIZ_DESCRIPTION = {
   'failures': ('number', 'Failures'),
@@ -205,78 +218,177 @@ class BrowseHandler(auth.AuthenticatingHandler):
     self.response.write(template.render('isolate/browse.html', params))
 
 
+def _slice_stream(stream, first, last):
+  """Yields the bytes |first| to |last| included of |stream|.
+
+  |last| can be None to read up to the end. |stream| is not read past |last|.
+  """
+  offset = 0
+  for chunk in stream:
+    end = offset + len(chunk)
+    if end > first:
+      start = max(first - offset, 0)
+      stop = len(chunk) if last is None else min(len(chunk), last + 1 - offset)
+      if stop > start:
+        yield chunk[start:stop]
+    offset = end
+    if last is not None and offset > last:
+      break
+
+
 class ContentHandler(auth.AuthenticatingHandler):
+  """Returns the content of an entry.
+
+  The response is buffered in memory until the handler returns, so content
+  larger than MAX_RESPONSE_SIZE is refused before it's read, based on the size
+  of the entry. Only small content is formatted as JSON. A single
+  'bytes=first-last' Range is supported.
+  """
+
   @auth.autologin
   @auth.require(acl.isolate_readable)
   def get(self):
     namespace = self.request.get('namespace', 'default-gzip')
     digest = self.request.get('digest', '')
-    content = None
+    if not digest or not namespace:
+      self.abort(400, 'digest and namespace are required')
 
-    if digest and namespace:
+    try:
+      raw_data, entity = model.get_content(namespace, digest)
+    except ValueError:
+      self.abort(400, 'Invalid key')
+    except LookupError:
+      self.abort(404, 'Unable to retrieve the entry')
+
+    if not raw_data:
+      stream = gcs.read_file(config.settings().gs_bucket, entity.key.id())
+    else:
+      stream = [raw_data]
+    stream = model.expand_content(namespace, stream)
+    if not entity:
+      # The content came from memcache, which doesn't keep its size.
+      entity = model.get_entry_key(namespace, digest).get()
+    size = entity.expanded_size if entity else None
+    if size is not None and size < 0:
+      # Not verified yet, only known if the content is stored as-is.
+      size = None if entity.is_compressed else entity.compressed_size
+
+    self.response.headers['X-Frame-Options'] = 'SAMEORIGIN'
+    # We delete Content-Type before storing to it to avoid having two (yes,
+    # two) Content-Type headers.
+    del self.response.headers['Content-Type']
+
+    # Apparently, setting the content type to text/plain encourages the
+    # browser (Chrome, at least) to sniff the mime type and display
+    # things like images.  Images are autowrapped in <img> and text is
+    # wrapped in <pre>.
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+
+    byte_range = self.request.headers.get('Range')
+    if byte_range:
+      self.write_range(stream, byte_range, size, digest)
+      return
+
+    if size is not None and size > MAX_RESPONSE_SIZE:
+      self.write_too_large(size, namespace, digest)
+      return
+
+    # Buffer small content to format it, stream the rest as-is.
+    chunks = []
+    buffered = 0
+    for chunk in stream:
+      chunks.append(chunk)
+      buffered += len(chunk)
+      if buffered > MAX_FORMATTED_SIZE:
+        break
+    else:
+      self.response.headers['Content-Disposition'] = str(
+          'filename=%s' % digest)
+      self.write_formatted(''.join(chunks), namespace)
+      return
+
+    self.response.headers['Content-Disposition'] = str('filename=%s' % digest)
+    for chunk in chunks:
+      self.response.write(chunk)
+    del chunks
+    for chunk in stream:
+      buffered += len(chunk)
+      if buffered > MAX_RESPONSE_SIZE:
+        # Only possible if the size was unknown, i.e. the entry is not verified
+        # yet or was deleted meanwhile.
+        self.response.clear()
+        self.write_too_large(buffered, namespace, digest)
+        return
+      self.response.write(chunk)
+
+  def write_formatted(self, content, namespace):
+    """Writes small content, formatted as JSON if possible."""
+    if content.startswith('{'):
+      # Try to format as JSON.
       try:
-        raw_data, entity = model.get_content(namespace, digest)
+        content = json.dumps(
+            json.loads(content), sort_keys=True, indent=2,
+            separators=(',', ': '))
+        # If we don't wrap this in html, browsers will put content in a pre
+        # tag which is also styled with monospace/pre-wrap.  We can't use
+        # anchor tags in <pre>, so we force it to be a <div>, which happily
+        # accepts links.
+        content = (
+          '<div style="font-family:monospace;white-space:pre-wrap;">%s'
+          '</div>' % content)
+        # Linkify things that look like hashes
+        content = re.sub(r'([0-9a-f]{40})',
+          r'<a target="_blank" href="/browse?namespace=%s' % namespace +
+            r'&digest=\1">\1</a>',
+          content)
+        self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
       except ValueError:
-        self.abort(400, 'Invalid key')
-      except LookupError:
-        self.abort(404, 'Unable to retrieve the entry')
+        pass
+    self.response.write(content)
+
+  def write_range(self, stream, byte_range, size, digest):
+    """Writes the requested range of the content as a 206 response.
 
-      if not raw_data:
-        stream = gcs.read_file(config.settings().gs_bucket, entity.key.id())
-      else:
-        stream = [raw_data]
-      content = ''.join(model.expand_content(namespace, stream))
-
-      self.response.headers['X-Frame-Options'] = 'SAMEORIGIN'
-      # We delete Content-Type before storing to it to avoid having two (yes,
-      # two) Content-Type headers.
-      del self.response.headers['Content-Type']
-
-      # Apparently, setting the content type to text/plain encourages the
-      # browser (Chrome, at least) to sniff the mime type and display
-      # things like images.  Images are autowrapped in <img> and text is
-      # wrapped in <pre>.
-      self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-
-      # App Engine puts a limit of 33554432 bytes on a request, which includes
-      # headers. Headers are ~150 bytes.  If the content + headers might
-      # exceed that limit, we give the user an option to workround getting
-      # their file.
-      if len(content) > 33554000:
-        host = modules.get_hostname(module='default', version='default')
-        # host is something like default.default.myisolateserver.appspot.com
-        host = host.replace('default.default.','')
-        sizeInMib = len(content) / (1024.0 * 1024.0)
-        content = ('Sorry, your file is %1.1f MiB big, which exceeds the 32 MiB'
+    The range is truncated to MAX_RESPONSE_SIZE bytes, clients are expected to
+    look at Content-Range.
+    """
+    match = _RANGE_RE.match(byte_range)
+    if not match:
+      self.abort(416, 'Only a single bytes=first-last range is supported')
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else None
+    if last is not None and last < first:
+      self.abort(416, 'Invalid range')
+    if size is not None:
+      if first >= size:
+        self.abort(416, 'Range is past the end of the content')
+      last = size - 1 if last is None else min(last, size - 1)
+    if last is None or last - first + 1 > MAX_RESPONSE_SIZE:
+      last = first + MAX_RESPONSE_SIZE - 1
+
+    written = 0
+    for chunk in _slice_stream(stream, first, last):
+      written += len(chunk)
+      self.response.write(chunk)
+    if not written:
+      self.abort(416, 'Range is past the end of the content')
+    self.response.status_int = 206
+    self.response.headers['Content-Disposition'] = str('filename=%s' % digest)
+    self.response.headers['Content-Range'] = str('bytes %d-%d/%s' % (
+        first, first + written - 1, '*' if size is None else size))
+
+  def write_too_large(self, size, namespace, digest):
+    """Writes instructions to fetch content too large for a response."""
+    host = modules.get_hostname(module='default', version='default')
+    # host is something like default.default.myisolateserver.appspot.com
+    host = host.replace('default.default.','')
+    sizeInMib = size / (1024.0 * 1024.0)
+    self.response.write(
+        'Sorry, your file is %1.1f MiB big, which exceeds the 32 MiB'
         ' App Engine limit.\nTo work around this, run the following command:\n'
-        '    python isolateserver.py download -I %s --namespace %s -f %s %s'
+        '    python isolateserver.py download -I %s --namespace %s -f %s %s\n'
+        'or request it in parts with a Range header.'
         % (sizeInMib, host, namespace, digest, digest))
-      else:
-        self.response.headers['Content-Disposition'] = str('filename=%s'
-                                                            % digest)
-        if content.startswith('{'):
-          # Try to format as JSON.
-          try:
-            content = json.dumps(
-                json.loads(content), sort_keys=True, indent=2,
-                separators=(',', ': '))
-            # If we don't wrap this in html, browsers will put content in a pre
-            # tag which is also styled with monospace/pre-wrap.  We can't use
-            # anchor tags in <pre>, so we force it to be a <div>, which happily
-            # accepts links.
-            content = (
-              '<div style="font-family:monospace;white-space:pre-wrap;">%s'
-              '</div>' % content)
-            # Linkify things that look like hashes
-            content = re.sub(r'([0-9a-f]{40})',
-              r'<a target="_blank" href="/browse?namespace=%s' % namespace +
-                r'&digest=\1">\1</a>',
-              content)
-            self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
-          except ValueError:
-            pass
-
-    self.response.write(content)
 
 
 class StatsHandler(webapp2.RequestHandler):
@@ -3,6 +3,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import collections
 import datetime
 import hashlib
 import logging
@@ -13,6 +14,7 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 import webtest
@@ -25,6 +27,7 @@ from test_support import test_case
 
 import acl
 import config
+import gcs
 import handlers_backend
 import handlers_frontend
 import model
@@ -156,6 +159,128 @@ class MainTest(test_case.TestCase):
     self.app_frontend.get(
         '/browse?namespace=default&hash=%s' % hashhex, status=404)
 
+  def test_content_json(self):
+    self.set_as_reader()
+    hashhex = self.gen_content(content='{"a":"%s"}' % ('0' * 40))
+    resp = self.app_frontend.get(
+        '/content?namespace=default&digest=%s' % hashhex)
+    self.assertEqual('text/html; charset=utf-8', resp.headers['Content-Type'])
+    self.assertIn('<a target="_blank"', resp.body)
+
+  def test_content_large_not_formatted(self):
+    self.mock(handlers_frontend, 'MAX_FORMATTED_SIZE', 4)
+    self.set_as_reader()
+    content = '{"a": 1}'
+    hashhex = self.gen_content(content=content)
+    resp = self.app_frontend.get(
+        '/content?namespace=default&digest=%s' % hashhex)
+    self.assertEqual('text/plain; charset=utf-8', resp.headers['Content-Type'])
+    self.assertEqual(content, resp.body)
+
+  def test_content_too_large(self):
+    # The content is not read at all.
+    self.mock(handlers_frontend, 'MAX_RESPONSE_SIZE', 4)
+    self.mock(handlers_frontend.modules, 'get_hostname', lambda **_: 'host')
+    def expand_content(*_):
+      self.fail('Content was read')
+      yield
+    self.mock(model, 'expand_content', expand_content)
+    self.set_as_reader()
+    hashhex = self.gen_content(content='0123456789')
+    # Also when the content is in memcache.
+    model.save_in_memcache('default', hashhex, '0123456789')
+    resp = self.app_frontend.get(
+        '/content?namespace=default&digest=%s' % hashhex)
+    self.assertIn('exceeds the 32 MiB', resp.body)
+
+  def test_content_range(self):
+    self.set_as_reader()
+    hashhex = self.gen_content(content='0123456789')
+    url = '/content?namespace=default&digest=%s' % hashhex
+    resp = self.app_frontend.get(
+        url, headers={'Range': 'bytes=2-5'}, status=206)
+    self.assertEqual('2345', resp.body)
+    self.assertEqual('bytes 2-5/10', resp.headers['Content-Range'])
+    resp = self.app_frontend.get(
+        url, headers={'Range': 'bytes=7-'}, status=206)
+    self.assertEqual('789', resp.body)
+    self.assertEqual('bytes 7-9/10', resp.headers['Content-Range'])
+    self.app_frontend.get(url, headers={'Range': 'bytes=10-'}, status=416)
+
+  def test_cleanup_old(self):
+    self.mock(gcs, 'delete_file', lambda *_args, **_kwargs: None)
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now, 0)
+    hashes = [self.gen_content(content=str(i)) for i in xrange(4)]
+    keys = [model.get_entry_key('default', h) for h in hashes]
+    entities = ndb.get_multi(keys)
+    for i, e in enumerate(entities[:3]):
+      e.expiration_ts = now - datetime.timedelta(days=i + 1)
+    ndb.put_multi(entities)
+
+    self.app_backend.get(
+        '/internal/cron/cleanup/trigger/old',
+        headers={'X-AppEngine-Cron': 'true'})
+    # One fan out task and one task per shard.
+    self.assertEqual(
+        1 + handlers_backend.CLEANUP_OLD_SHARDS, self.execute_tasks())
+    self.assertEqual([None, None, None, entities[3]], ndb.get_multi(keys))
+
+  def test_cleanup_trim_lost(self):
+    self.mock(handlers_backend, 'CLEANUP_PAGE_SIZE', 2)
+    self.mock(handlers_backend, 'CLEANUP_TASK_DURATION', 0)
+    present = 'default/' + self.gen_content()
+    lost = ['default/00', 'default/01', 'default/02']
+    files = sorted(lost + [present])
+    stat = collections.namedtuple('Stat', 'st_ctime')(0)
+    def list_files(_bucket, subdir, batch_size, marker):
+      self.assertEqual(2, batch_size)
+      for f in files:
+        if f.startswith(subdir) and f > marker:
+          yield f, stat
+    self.mock(gcs, 'list_dirs', lambda _bucket: ['default/'])
+    self.mock(gcs, 'list_files', list_files)
+    deleted = []
+    self.mock(
+        gcs, 'delete_files',
+        lambda _bucket, filenames: deleted.extend(filenames))
+
+    self.app_backend.get(
+        '/internal/cron/cleanup/trigger/trim_lost',
+        headers={'X-AppEngine-Cron': 'true'})
+    # One fan out task, one task per shard and a continuation for the '0'
+    # shard.
+    self.assertEqual(18, self.execute_tasks())
+    self.assertEqual(lost, sorted(deleted))
+
+  def test_verify_batch(self):
+    self.mock(gcs, 'delete_file', lambda *_args, **_kwargs: None)
+    files = {}
+    keys = []
+    for content, stored in (('good', 'good'), ('bad', 'evil')):
+      key = model.get_entry_key('default', hashlib.sha1(content).hexdigest())
+      model.new_content_entry(
+          key,
+          compressed_size=len(stored),
+          expanded_size=len(stored),
+          is_verified=False).put()
+      files[key.id()] = stored
+      keys.append(key)
+      taskqueue.Queue('verify-pull').add(
+          taskqueue.Task(payload=key.id(), method='PULL'))
+    self.mock(
+        gcs, 'get_file_info',
+        lambda _bucket, key_id: gcs.FileInfo(size=len(files[key_id])))
+    self.mock(gcs, 'read_file', lambda _bucket, key_id: [files[key_id]])
+
+    self.app_backend.get(
+        '/internal/cron/verify', headers={'X-AppEngine-Cron': 'true'})
+    # Both entries are verified by a single task.
+    self.assertEqual(1, self.execute_tasks())
+    good, bad = ndb.get_multi(keys)
+    self.assertTrue(good.is_verified)
+    self.assertIsNone(bad)
+
   def test_config(self):
     self.set_as_admin()
     resp = self.app_frontend.get('/restricted/config')
@@ -7,6 +7,7 @@
 
 import datetime
 import hashlib
+import json
 import logging
 import random
 import zlib
@@ -33,6 +34,34 @@ MAX_MEMCACHE_ISOLATED = 500*1024
 NAMESPACE_RE = r'[a-z0-9A-Z\-._]+'
 
 
+# Memcache namespace of the cache of verified ContentEntry presence.
+PRESENCE_MEMCACHE_NAMESPACE = 'presence'
+
+
+# Maximum duration, in seconds, a ContentEntry presence is cached in memcache.
+MAX_PRESENCE_CACHE_DURATION = 24*60*60
+
+
+# Memcache namespace of the ContentEntry ids that were tagged recently or that
+# are queued to be tagged. The value is the timestamp until which they don't
+# need to be tagged again.
+TAGGED_MEMCACHE_NAMESPACE = 'tagged'
+
+
+# Time, in seconds, during which a digest queued for tagging is not queued
+# again.
+TAG_PENDING_DURATION = 30*60
+
+
+# Maximum duration, in seconds, of a 'tagged' memcache entry.
+MAX_TAGGED_CACHE_DURATION = 24*60*60
+
+
+# Memcache namespace of the parsed .isolated files, keyed by 'namespace/hash'.
+# Entries are content addressed so they never need to be invalidated.
+ISOLATED_MEMCACHE_NAMESPACE = 'isolated'
+
+
 #### Models
 
 
@@ -161,6 +190,39 @@ def get_content(namespace, hash_key):
     return (entity.content, entity)
 
 
+def get_isolated(namespace, hash_key):
+  """Returns a parsed .isolated file as a dict.
+
+  Parsed files are cached in memcache, since resolving a chain of includes reads
+  the same files over and over.
+
+  Raises LookupError if the content cannot be found.
+  Raises ValueError if the hash_key is invalid or the content is not a valid
+  .isolated file.
+  """
+  cache_key = '%s/%s' % (namespace, hash_key)
+  data = memcache.get(cache_key, namespace=ISOLATED_MEMCACHE_NAMESPACE)
+  if data is not None:
+    return data
+  raw_data, entity = get_content(namespace, hash_key)
+  if raw_data is None:
+    stream = gcs.read_file(config.settings().gs_bucket, entity.key.id())
+  else:
+    stream = [raw_data]
+  try:
+    data = json.loads(''.join(expand_content(namespace, stream)))
+  except (ValueError, zlib.error) as e:
+    raise ValueError('%s is not a valid .isolated file: %s' % (hash_key, e))
+  if not isinstance(data, dict):
+    raise ValueError('%s is not a valid .isolated file' % hash_key)
+  try:
+    memcache.set(cache_key, data, namespace=ISOLATED_MEMCACHE_NAMESPACE)
+  except ValueError as e:
+    # Too large for memcache.
+    logging.warning('Failed to cache %s: %s', cache_key, e)
+  return data
+
+
 def expiration_jitter(now, expiration):
   """Returns expiration/next_tag pair to set in a ContentEntry."""
   jittered = random.uniform(1, 1.2) * expiration
@@ -214,6 +276,131 @@ def save_in_memcache(namespace, hash_key, content, async=False):
     logging.error(e)
 
 
+def save_multi_in_memcache(namespace, mapping):
+  """Saves many contents in memcache in a single call.
+
+  Arguments:
+    namespace: isolate namespace of the contents.
+    mapping: dict(hash_key, content).
+  """
+  namespace_key = 'table_%s' % namespace
+  try:
+    failed = memcache.set_multi(mapping, namespace=namespace_key)
+    if failed:
+      logging.warning(
+          'Failed to save %d contents to memcache in %s',
+          len(failed), namespace_key)
+  except ValueError as e:
+    logging.error(e)
+
+
+def cache_presence(entries):
+  """Remembers in memcache that verified ContentEntry exist.
+
+  It permits preupload to skip a datastore lookup for content that is known to
+  be present. Each cached value holds the entry expanded size and its
+  expiration, so it's never considered present past its expiration_ts even if
+  it was tagged in the meantime; it'll be cached again then.
+
+  Only verified entries are cached, since unverified ones may still be
+  purged by the verify task.
+  """
+  now = utils.utcnow()
+  mapping = {
+    e.key.id(): (e.expanded_size, utils.datetime_to_timestamp(e.expiration_ts))
+    for e in entries
+    if e.is_verified and e.expiration_ts and e.expiration_ts > now
+  }
+  if not mapping:
+    return
+  try:
+    failed = memcache.set_multi(
+        mapping, time=MAX_PRESENCE_CACHE_DURATION,
+        namespace=PRESENCE_MEMCACHE_NAMESPACE)
+    if failed:
+      logging.warning('Failed to cache presence of %d entries', len(failed))
+  except ValueError as e:
+    logging.error(e)
+
+
+def get_cached_presence(keys):
+  """Returns the ContentEntry from |keys| known to be present.
+
+  Arguments:
+    keys: list of ndb.Key of ContentEntry.
+
+  Returns:
+    dict(key id, expanded size) of the entries known to exist. Entries missing
+    from the dict may or may not exist.
+  """
+  ids = [k.id() for k in keys]
+  if not ids:
+    return {}
+  cached = memcache.get_multi(ids, namespace=PRESENCE_MEMCACHE_NAMESPACE)
+  now = utils.datetime_to_timestamp(utils.utcnow())
+  return {
+    key_id: expanded_size
+    for key_id, (expanded_size, expiration) in cached.iteritems()
+    if expiration > now
+  }
+
+
+def uncache_presence(keys):
+  """Forgets the presence of the ContentEntry |keys|, e.g. on deletion."""
+  ids = [k.id() for k in keys]
+  if ids and not memcache.delete_multi(
+      ids, namespace=PRESENCE_MEMCACHE_NAMESPACE):
+    logging.warning('Failed to uncache presence of %d entries', len(ids))
+
+
+def filter_recently_tagged(namespace, digests):
+  """Returns the digests that need to be tagged and marks them as queued.
+
+  Digests tagged recently, or already queued for tagging by another request, are
+  filtered out. Two concurrent requests may both queue the same digest, which is
+  harmless.
+
+  Arguments:
+    namespace: isolate namespace of the digests.
+    digests: list of hex digests.
+  """
+  ids = ['%s/%s' % (namespace, d) for d in digests]
+  if not ids:
+    return []
+  now = utils.datetime_to_timestamp(utils.utcnow())
+  cached = memcache.get_multi(ids, namespace=TAGGED_MEMCACHE_NAMESPACE)
+  to_tag = [
+    (key_id, digest) for key_id, digest in zip(ids, digests)
+    if cached.get(key_id, 0) <= now
+  ]
+  if to_tag:
+    pending = now + TAG_PENDING_DURATION * 1000000
+    try:
+      memcache.set_multi(
+          {key_id: pending for key_id, _ in to_tag},
+          time=MAX_TAGGED_CACHE_DURATION,
+          namespace=TAGGED_MEMCACHE_NAMESPACE)
+    except ValueError as e:
+      logging.error(e)
+  return [digest for _, digest in to_tag]
+
+
+def cache_tagged(entries):
+  """Remembers in memcache that ContentEntry don't need tagging for now."""
+  mapping = {
+    e.key.id(): utils.datetime_to_timestamp(e.next_tag_ts)
+    for e in entries if e.next_tag_ts
+  }
+  if not mapping:
+    return
+  try:
+    memcache.set_multi(
+        mapping, time=MAX_TAGGED_CACHE_DURATION,
+        namespace=TAGGED_MEMCACHE_NAMESPACE)
+  except ValueError as e:
+    logging.error(e)
+
+
 def new_content_entry(key, **kwargs):
   """Generates a new ContentEntry for the request.
 
@@ -236,6 +423,9 @@ def delete_entry_and_gs_entry(keys_to_delete):
   futures = {}
   exc = None
   bucket = config.settings().gs_bucket
+  # Forget first, so no preupload is told the content is there while it is
+  # being deleted.
+  uncache_presence(keys_to_delete)
   # Note that some content entries may NOT have corresponding GS files. That
   # happens for small entries stored inline in the datastore or memcache. Since
   # this function operates only on keys, it can't distinguish "large" entries
@@ -0,0 +1,31 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Timeseries metrics."""
+
+import gae_ts_mon
+
+
+# A custom bucketer with 12% resolution in the range of 1..10**5.
+_bucketer = gae_ts_mon.GeometricBucketer(growth_factor=10**0.05,
+                                         num_finite_buckets=100)
+
+
+# Number of entries waiting to be batched in the 'verify-pull' queue. Set by
+# the cron job draining it.
+verify_backlog = gae_ts_mon.GaugeMetric(
+    'isolate/verify/backlog',
+    description='Number of GS entries waiting for verification.')
+
+
+# Number of GS entries processed by the batched verifier. Metric fields:
+# - result: 'verified', 'purged' or 'retried'.
+verify_entries = gae_ts_mon.CounterMetric(
+    'isolate/verify/entries',
+    description='Number of GS entries processed by the verifier.')
+
+
+verify_batch_durations = gae_ts_mon.CumulativeDistributionMetric(
+    'isolate/verify/batch_durations', bucketer=_bucketer,
+    description='Time to verify a batch of GS entries, in seconds.')
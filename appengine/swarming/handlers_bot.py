@@ -96,12 +96,8 @@ class _BotApiHandler(auth.ApiHandler):
   """Like ApiHandler, but also implements machine authentication."""
 
   # Bots are passing credentials through special headers (not cookies), no need
-  # for XSRF tokens.
-  xsrf_token_enforce_on = ()
-
-  @classmethod
-  def get_auth_methods(cls, conf):
-    return [auth.machine_authentication, auth.oauth_authentication]
+  # for XSRF tokens or other auth methods.
+  auth_profile = auth.BOT_AUTH_PROFILE
 
 
 class _BotAuthenticatingHandler(auth.AuthenticatingHandler):
@@ -116,12 +112,8 @@ class _BotAuthenticatingHandler(auth.AuthenticatingHandler):
   """
 
   # Bots are passing credentials through special headers (not cookies), no need
-  # for XSRF tokens.
-  xsrf_token_enforce_on = ()
-
-  @classmethod
-  def get_auth_methods(cls, conf):
-    return [auth.machine_authentication, auth.oauth_authentication]
+  # for XSRF tokens or other auth methods.
+  auth_profile = auth.BOT_AUTH_PROFILE
 
   def check_bot_code_access(self, bot_id, generate_token):
     """Raises AuthorizationError if caller is not authorized to access bot code.
@@ -8,15 +8,18 @@
 __version__ = '0.6.0'
 
 import base64
+import collections
 import errno
 import functools
 import io
+import itertools
 import logging
 import optparse
 import os
 import re
 import signal
 import stat
+import struct
 import sys
 import tempfile
 import threading
@@ -29,6 +32,7 @@ from third_party.depot_tools import fix_encoding
 from third_party.depot_tools import subcommand
 
 from libs import arfile
+from utils import cache_server
 from utils import file_path
 from utils import fs
 from utils import logging_utils
@@ -72,6 +76,29 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# Largest item the server stores inline in the datastore, larger ones go to GS.
+# Must match MIN_SIZE_FOR_GS in appengine/isolate/handlers_endpoints_v1.py.
+MAX_INLINE_ITEM_SIZE = 500
+
+
+# Items up to this size are pushed in batches, to amortize the per-request
+# overhead over many tiny files. A batch holds up to BATCH_PUSH_MAX_ITEMS items
+# totalling up to BATCH_PUSH_MAX_SIZE bytes. Only items stored inline can be
+# batched.
+BATCH_PUSH_MAX_ITEM_SIZE = MAX_INLINE_ITEM_SIZE
+BATCH_PUSH_MAX_ITEMS = 200
+BATCH_PUSH_MAX_SIZE = 1024*1024
+
+
+# Items up to this size are fetched in batches by FetchQueue when batching is
+# enabled. A batch holds up to BATCH_FETCH_MAX_ITEMS items totalling up to
+# BATCH_FETCH_MAX_SIZE bytes. Larger items are stored in GS and the batch would
+# only return a URL for them.
+BATCH_FETCH_MAX_ITEM_SIZE = MAX_INLINE_ITEM_SIZE
+BATCH_FETCH_MAX_ITEMS = 200
+BATCH_FETCH_MAX_SIZE = 1024*1024
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -80,6 +107,44 @@ ALREADY_COMPRESSED_TYPES = [
 ]
 
 
+# Items at least this large are sampled to pick their compression level, since
+# the file extension is only a hint of the compressibility of the content.
+COMPRESSION_SAMPLE_MIN_SIZE = 1024 * 1024
+
+
+# Size of the sample of content compressed to estimate compressibility and
+# compression throughput.
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+
+
+# Compressed to uncompressed ratio at the lowest level above which the content
+# is considered incompressible and is stored as-is (level 0).
+INCOMPRESSIBLE_RATIO = 0.9
+
+
+# Compression levels considered when sampling content.
+COMPRESSION_LEVELS = (1, 4, 7)
+
+
+# Upload throughput in bytes/s assumed when trading compression time for
+# transfer time.
+EXPECTED_UPLOAD_BANDWIDTH = 20 * 1024 * 1024
+
+
+# Items at least this large are compressed in independent blocks on all cores.
+PARALLEL_ZIP_MIN_SIZE = 32 * 1024 * 1024
+
+
+# Size of a block compressed independently.
+ZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+# Maximum size of an ar bundle created when packing small files. Bundles are
+# filled greedily in sorted path order, so a change in one file only affects
+# the bundle containing it and the following ones in the same directory.
+MAX_AR_BUNDLE_SIZE = 1024 * 1024
+
+
 # Chunk size to use when reading from network stream.
 NET_IO_FILE_CHUNK = 16 * 1024
 
@@ -278,6 +343,120 @@ def zip_compress(content_generator, level=7):
     yield tail
 
 
+def zip_compress_parallel(
+    content_generator, level, thread_pool, block_size=None):
+  """Reads chunks from |content_generator| and yields zip compressed chunks.
+
+  The content is split in blocks of |block_size| bytes, ZIP_BLOCK_SIZE by
+  default, compressed concurrently
+  on |thread_pool|. zlib releases the GIL so this scales with the number of
+  cores. Each block is raw deflate data terminated by a sync flush, so that the
+  concatenation is a single standard zlib stream, exactly what zip_compress()
+  would produce as far as zip_decompress() and the server are concerned. The
+  ratio is marginally worse since blocks do not share history.
+  """
+  def compress_block(block):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+  block_size = block_size or ZIP_BLOCK_SIZE
+  # Bound memory usage to a few blocks per thread.
+  max_pending = 2 * threading_utils.num_processors()
+  yield _zlib_header(level)
+  checksum = zlib.adler32('')
+  pending = collections.deque()
+  for block in _iter_blocks(content_generator, block_size):
+    checksum = zlib.adler32(block, checksum)
+    channel = threading_utils.TaskChannel()
+    thread_pool.add_task(
+        threading_utils.PRIORITY_MED, channel.wrap_task(compress_block), block)
+    pending.append(channel)
+    if len(pending) >= max_pending:
+      yield pending.popleft().pull()
+  while pending:
+    yield pending.popleft().pull()
+  # Empty final block, then the adler32 trailer of the zlib stream.
+  yield zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+  yield struct.pack('>I', checksum & 0xffffffff)
+
+
+def _zlib_header(level):
+  """Returns the 2 bytes header of a zlib stream with 32kb window."""
+  # FLEVEL is informative only; FCHECK makes the header a multiple of 31.
+  if level < 2:
+    return '\x78\x01'
+  if level < 6:
+    return '\x78\x5e'
+  if level == 6:
+    return '\x78\x9c'
+  return '\x78\xda'
+
+
+def _iter_blocks(content_generator, block_size):
+  """Regroups the chunks of |content_generator| into blocks of |block_size|."""
+  buf = []
+  buf_size = 0
+  for chunk in content_generator:
+    buf.append(chunk)
+    buf_size += len(chunk)
+    if buf_size >= block_size:
+      data = ''.join(buf)
+      for i in xrange(0, len(data) - block_size + 1, block_size):
+        yield data[i:i+block_size]
+      rest = len(data) % block_size
+      buf = [data[-rest:]] if rest else []
+      buf_size = rest
+  if buf_size:
+    yield ''.join(buf)
+
+
+def peek_content(content_generator, size):
+  """Returns the first |size| bytes of content and a generator of the whole.
+
+  Returns:
+    tuple(str with at most |size| bytes, generator yielding all the content).
+  """
+  content = iter(content_generator)
+  head = []
+  head_size = 0
+  for chunk in content:
+    head.append(chunk)
+    head_size += len(chunk)
+    if head_size >= size:
+      break
+  head = ''.join(head)
+  return head[:size], itertools.chain([head], content)
+
+
+def choose_zip_compression_level(sample, size, default_level, threads=1):
+  """Chooses the compression level of an item of |size| bytes from a sample.
+
+  Incompressible content is stored at level 0 whatever its file name. Otherwise
+  compresses |sample| at each of COMPRESSION_LEVELS to measure its ratio and
+  throughput and returns the level minimizing the estimated time to compress
+  the whole item on |threads| cores plus the time to upload the result.
+
+  Returns |default_level| as-is if it is 0, i.e. the content is known to be
+  compressed already, or if |sample| is empty.
+  """
+  if not default_level or not sample:
+    return default_level
+  scale = float(size) / len(sample)
+  best_level = default_level
+  best_cost = None
+  for level in COMPRESSION_LEVELS:
+    start = time.time()
+    ratio = float(len(zlib.compress(sample, level))) / len(sample)
+    duration = time.time() - start
+    if level == COMPRESSION_LEVELS[0] and ratio >= INCOMPRESSIBLE_RATIO:
+      return 0
+    cost = duration * scale / threads + size * ratio / EXPECTED_UPLOAD_BANDWIDTH
+    if best_cost is None or cost < best_cost:
+      best_level = level
+      best_cost = cost
+  return best_level
+
+
 def zip_decompress(
     content_generator, chunk_size=isolated_format.DISK_FILE_CHUNK):
   """Reads zipped data from |content_generator| and yields decompressed data.
@@ -311,9 +490,12 @@ def zip_decompress(
 
 
 def get_zip_compression_level(filename):
-  """Given a filename calculates the ideal zip compression level to use."""
+  """Given a filename calculates the ideal zip compression level to use.
+
+  This is only a first guess; Storage refines it for large items by sampling
+  their content, see choose_zip_compression_level().
+  """
   file_ext = os.path.splitext(filename)[1].lower()
-  # TODO(csharp): Profile to find what compression level works best.
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
 
@@ -436,6 +618,20 @@ class BufferItem(Item):
     return [self.buffer]
 
 
+class _SplitResultChannel(object):
+  """TaskChannel proxy sending each item of a list result separately."""
+
+  def __init__(self, channel):
+    self._channel = channel
+
+  def send_result(self, results):
+    for result in results:
+      self._channel.send_result(result)
+
+  def send_exception(self, exc_info=None):
+    self._channel.send_exception(exc_info)
+
+
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
 
@@ -456,6 +652,7 @@ class Storage(object):
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
+    self._zip_block_thread_pool = None
     self._aborted = False
     self._prev_sig_handlers = {}
 
@@ -491,6 +688,20 @@ class Storage(object):
       self._cpu_thread_pool = threading_utils.ThreadPool(2, threads, 0, 'zip')
     return self._cpu_thread_pool
 
+  @property
+  def zip_block_thread_pool(self):
+    """ThreadPool to compress blocks of large items in parallel.
+
+    It is separate from cpu_thread_pool, whose tasks wait for these ones.
+    """
+    if self._zip_block_thread_pool is None:
+      threads = max(threading_utils.num_processors(), 2)
+      if sys.maxsize <= 2L**32:
+        threads = min(threads, 16)
+      self._zip_block_thread_pool = threading_utils.ThreadPool(
+          0, threads, 0, 'zipblock')
+    return self._zip_block_thread_pool
+
   @property
   def net_thread_pool(self):
     """AutoRetryThreadPool for IO-bound tasks, retries IOError."""
@@ -509,6 +720,10 @@ class Storage(object):
       self._net_thread_pool.join()
       self._net_thread_pool.close()
       self._net_thread_pool = None
+    if self._zip_block_thread_pool:
+      self._zip_block_thread_pool.join()
+      self._zip_block_thread_pool.close()
+      self._zip_block_thread_pool = None
     logging.info('Done.')
 
   def abort(self):
@@ -565,13 +780,26 @@ class Storage(object):
     if duplicates:
       logging.info('Skipped %d files with duplicated content', duplicates)
 
-    # Enqueue all upload tasks.
+    # Enqueue all upload tasks. Small items are grouped in batches.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
+    batch = []
+    batch_size = 0
     for missing_item, push_state in self.get_missing_items(items):
       missing.add(missing_item)
-      self.async_push(channel, missing_item, push_state)
+      if missing_item.size > BATCH_PUSH_MAX_ITEM_SIZE:
+        self.async_push(channel, missing_item, push_state)
+        continue
+      batch.append((missing_item, push_state))
+      batch_size += missing_item.size
+      if (len(batch) == BATCH_PUSH_MAX_ITEMS or
+          batch_size >= BATCH_PUSH_MAX_SIZE):
+        self.async_push_batch(channel, batch)
+        batch = []
+        batch_size = 0
+    if batch:
+      self.async_push_batch(channel, batch)
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -653,7 +881,17 @@ class Storage(object):
       try:
         if self._aborted:
           raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
+        content = item.content()
+        level = item.compression_level
+        if level and item.size >= COMPRESSION_SAMPLE_MIN_SIZE:
+          sample, content = peek_content(content, COMPRESSION_SAMPLE_SIZE)
+          level = choose_zip_compression_level(
+              sample, item.size, level, threading_utils.num_processors())
+        if level and item.size >= PARALLEL_ZIP_MIN_SIZE:
+          stream = zip_compress_parallel(
+              content, level, self.zip_block_thread_pool)
+        else:
+          stream = zip_compress(content, level)
         data = ''.join(stream)
       except Exception as exc:
         logging.error('Failed to zip \'%s\': %s', item, exc)
@@ -663,6 +901,42 @@ class Storage(object):
           channel, priority, push, [data])
     self.cpu_thread_pool.add_task(priority, zip_and_push)
 
+  def async_push_batch(self, channel, batch):
+    """Starts asynchronous push of many small items in a single request.
+
+    Arguments:
+      channel: TaskChannel that receives back each item when upload ends.
+      batch: list of tuple(item, push_state) as returned by
+          'get_missing_items'.
+
+    Returns:
+      None, but |channel| later receives back each item when upload ends.
+    """
+    priority = (
+        threading_utils.PRIORITY_HIGH
+        if any(item.high_priority for item, _ in batch)
+        else threading_utils.PRIORITY_MED)
+
+    def push_batch():
+      """Pushes the Items and returns them to |channel|."""
+      if self._aborted:
+        raise Aborted()
+      to_push = []
+      for item, push_state in batch:
+        item.prepare(self._hash_algo)
+        # The items are small, compress them right there and keep them in
+        # memory, so a push can be retried.
+        content = item.content()
+        if self._use_zip:
+          content = zip_compress(content, item.compression_level)
+        to_push.append((item, push_state, [''.join(content)]))
+      self._storage_api.push_batch(to_push)
+      return [item for item, _ in batch]
+
+    # Retried on IOError like single pushes.
+    self.net_thread_pool.add_task_with_channel(
+        _SplitResultChannel(channel), priority, push_batch)
+
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
 
@@ -712,6 +986,40 @@ class Storage(object):
     # really fast and most probably IO bound anyway.
     self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
 
+  def async_fetch_batch(self, channel, priority, batch):
+    """Starts asynchronous fetch of many small items in a single request.
+
+    Items the server didn't return in the batch, or that failed verification,
+    are fetched individually via 'async_fetch'.
+
+    Arguments:
+      channel: TaskChannel that receives back each digest when its download
+          ends.
+      priority: thread pool task priority for the fetch.
+      batch: list of tuple(digest, size, sink), see 'async_fetch'.
+    """
+    def fetch_batch():
+      try:
+        contents = self._storage_api.fetch_batch([d for d, _, _ in batch])
+      except Exception as err:
+        logging.warning('Failed to fetch a batch, fetching one by one: %s', err)
+        contents = {}
+      for digest, size, sink in batch:
+        content = contents.get(digest)
+        if content is not None:
+          try:
+            stream = [content]
+            if self._use_zip:
+              stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+            sink(FetchStreamVerifier(stream, size).run())
+            channel.send_result(digest)
+            continue
+          except Exception as err:
+            logging.warning('Failed to fetch %s in a batch: %s', digest, err)
+        self.async_fetch(channel, priority, digest, size, sink)
+
+    self.net_thread_pool.add_task(priority, fetch_batch)
+
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
@@ -788,9 +1096,21 @@ class FetchQueue(object):
   other at all.
   """
 
-  def __init__(self, storage, cache):
+  def __init__(self, storage, cache, batch_fetch=False):
+    """Initializes the queue.
+
+    Arguments:
+      storage: Storage to fetch items from.
+      cache: LocalCache to put items into.
+      batch_fetch: if True, small items of known size are grouped and fetched
+          with Storage.async_fetch_batch. The batch is flushed when full or
+          when 'wait' is called.
+    """
     self.storage = storage
     self.cache = cache
+    self._batch_fetch = batch_fetch
+    self._batch = []
+    self._batch_size = 0
     self._channel = threading_utils.TaskChannel()
     self._pending = set()
     self._accessed = set()
@@ -829,9 +1149,29 @@ class FetchQueue(object):
 
     # Start fetching.
     self._pending.add(digest)
-    self.storage.async_fetch(
-        self._channel, priority, digest, size,
-        functools.partial(self.cache.write, digest))
+    sink = functools.partial(self.cache.write, digest)
+    if (self._batch_fetch and size != UNKNOWN_FILE_SIZE and
+        size <= BATCH_FETCH_MAX_ITEM_SIZE and
+        priority != threading_utils.PRIORITY_HIGH):
+      self._batch.append((digest, size, sink))
+      self._batch_size += size
+      if (len(self._batch) == BATCH_FETCH_MAX_ITEMS or
+          self._batch_size >= BATCH_FETCH_MAX_SIZE):
+        self._flush_batch()
+      return
+    self.storage.async_fetch(self._channel, priority, digest, size, sink)
+
+  def _flush_batch(self):
+    """Starts fetching the batched items, if any."""
+    if not self._batch:
+      return
+    batch, self._batch, self._batch_size = self._batch, [], 0
+    if len(batch) == 1:
+      self.storage.async_fetch(
+          self._channel, threading_utils.PRIORITY_MED, *batch[0])
+    else:
+      self.storage.async_fetch_batch(
+          self._channel, threading_utils.PRIORITY_MED, batch)
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
@@ -846,6 +1186,7 @@ class FetchQueue(object):
     # Ensure all requested items are being fetched now.
     assert all(digest in self._pending for digest in digests), (
         digests, self._pending)
+    self._flush_batch()
 
     # Wait for some requested item to finish fetching.
     while self._pending:
@@ -988,6 +1329,36 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
+  def push_batch(self, batch):
+    """Uploads many small items at once.
+
+    The default implementation pushes them one by one, implementations should
+    override it to use a single request.
+
+    Arguments:
+      batch: list of tuple(item, push_state, content), see 'push'.
+
+    Returns:
+      None.
+    """
+    for item, push_state, content in batch:
+      self.push(item, push_state, content)
+
+  def fetch_batch(self, digests):
+    """Fetches many small objects at once.
+
+    The default implementation returns nothing, so that all objects are fetched
+    individually via 'fetch'.
+
+    Arguments:
+      digests: list of hash digests of items to download.
+
+    Returns:
+      A dict digest -> content for the objects fetched, which may be a subset
+      of |digests|.
+    """
+    return {}
+
   def contains(self, items):
     """Checks for |items| on the server, prepares missing ones for upload.
 
@@ -1042,6 +1413,11 @@ class IsolateServer(StorageApi):
     self._lock = threading.Lock()
     self._server_caps = None
     self._memory_use = 0
+    # Set to False once the server failed a store_inline_batch request, e.g.
+    # because it doesn't support it.
+    self._use_batch_push = True
+    # Same for retrieve_batch requests.
+    self._use_batch_fetch = True
 
   @property
   def _server_capabilities(self):
@@ -1125,6 +1501,32 @@ class IsolateServer(StorageApi):
     for data in connection.iter_content(NET_IO_FILE_CHUNK):
       yield data
 
+  def fetch_batch(self, digests):
+    if not self._use_batch_fetch:
+      return {}
+    response = net.url_read_json(
+        url='%s/api/isolateservice/v1/retrieve_batch' % self._base_url,
+        data={'digests': digests, 'namespace': self._namespace_dict})
+    if response is None:
+      logging.warning('retrieve_batch failed, fetching items one by one')
+      self._use_batch_fetch = False
+      return {}
+    contents = {}
+    for i in response.get('items', []):
+      if i.get('content') is not None:
+        contents[i['digest']] = base64.b64decode(i['content'])
+        continue
+      # Entries stored in GS are downloaded right away, instead of asking
+      # 'retrieve' for the same URL again. Failed ones are left to 'fetch'.
+      try:
+        connection = net.url_open(i['url'])
+        if connection:
+          contents[i['digest']] = ''.join(
+              connection.iter_content(NET_IO_FILE_CHUNK))
+      except IOError as err:
+        logging.warning('Failed to download %s: %s', i['digest'], err)
+    return contents
+
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
     assert item.digest is not None
@@ -1208,6 +1610,45 @@ class IsolateServer(StorageApi):
       with self._lock:
         self._memory_use -= push_state.size
 
+  def push_batch(self, batch):
+    # Only items stored inline can be batched, the others go through GCS. Items
+    # already uploaded by a previous attempt at this batch are skipped by push.
+    inline = []
+    for item, push_state, content in batch:
+      if (push_state.finalize_url or push_state.uploaded or
+          not self._use_batch_push):
+        self.push(item, push_state, content)
+      else:
+        inline.append((item, push_state, content))
+    if not inline:
+      return
+
+    data = {
+      'items': [
+        {
+          'upload_ticket': push_state.preupload_status['upload_ticket'],
+          'content': base64.b64encode(''.join(content)),
+        } for _, push_state, content in inline
+      ],
+    }
+    response = net.url_read_json(
+        url='%s/api/isolateservice/v1/store_inline_batch' % self._base_url,
+        data=data)
+    if response is None:
+      # net already retried transient errors, the server likely doesn't
+      # support batches.
+      self._use_batch_push = False
+    if response is None or not response.get('ok'):
+      logging.warning(
+          'store_inline_batch failed, pushing %d items one by one',
+          len(inline))
+      for item, push_state, content in inline:
+        self.push(item, push_state, content)
+      return
+    for _, push_state, _ in inline:
+      push_state.uploaded = True
+      push_state.finalized = True
+
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
     assert all(i.digest is not None and i.size is not None for i in items)
@@ -1686,6 +2127,16 @@ class DiskCache(LocalCache):
     with self._lock:
       self._trim()
 
+  def set_protected(self, digest):
+    """Sets the first item that must not be evicted to map new items.
+
+    Used by LocalCacheServer, which serves several runs over the lifetime of the
+    cache, to release the items of the runs that are over. None protects
+    nothing until the next item is referenced.
+    """
+    with self._lock:
+      self._protected = digest
+
   def _load(self, trim):
     """Loads state of the cache from json file.
 
@@ -1819,6 +2270,93 @@ class DiskCache(LocalCache):
       logging.error('Error attempting to delete a file %s:\n%s' % (digest, e))
 
 
+class SharedCache(LocalCache):
+  """LocalCache implementation delegating to a LocalCacheServer.
+
+  The server owns the DiskCache and is shared by all the processes on the host
+  pointing to the same socket. Files are read directly from the server's cache
+  directory, so they can still be hardlinked.
+
+  The items referenced through an instance are protected from eviction until it
+  is exited, see LocalCacheServer.
+  """
+
+  def __init__(self, socket_path, hash_algo):
+    super(SharedCache, self).__init__()
+    self.hash_algo = hash_algo
+    self._client = cache_server.CacheServerClient(socket_path)
+    self._session = '%d-%s' % (os.getpid(), os.urandom(8).encode('hex'))
+    stats = self._call('stats')
+    self.cache_dir = stats['cache_dir']
+    self._initial_number_items = stats['initial_number_items']
+    self._initial_size = stats['initial_size']
+
+  def __contains__(self, digest):
+    return self._call('contains', digest=digest)['result']
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self._call('end_session', session=self._session)
+    return False
+
+  def cached_set(self):
+    return set(self._call('cached_set')['digests'])
+
+  def cleanup(self):
+    """No-op, the server cleans up the cache before accepting clients."""
+
+  def touch(self, digest, size):
+    return self._call(
+        'touch', digest=digest, size=size, session=self._session)['result']
+
+  def evict(self, digest):
+    self._call('evict', digest=digest)
+
+  def getfileobj(self, digest):
+    path = self._call('getfileobj', digest=digest)['path']
+    if not path:
+      raise CacheMiss(digest)
+    try:
+      f = fs.open(path, 'rb')
+    except IOError:
+      raise CacheMiss(digest)
+    with self._lock:
+      self._used.append(os.fstat(f.fileno()).st_size)
+    return f
+
+  def write(self, digest, content):
+    size = [0]
+    def gen():
+      for chunk in content:
+        size[0] += len(chunk)
+        yield chunk
+    try:
+      sent = self._client.write(
+          digest, UNKNOWN_FILE_SIZE, gen(), session=self._session)
+    except cache_server.RPCError as e:
+      raise IOError(str(e))
+    if sent:
+      with self._lock:
+        self._added.append(size[0])
+    return digest
+
+  def get_oldest(self):
+    """Returns digest of the LRU item or None."""
+    return self._call('get_oldest')['digest']
+
+  def get_timestamp(self, digest):
+    """Returns timestamp of last use of an item."""
+    return self._call('get_timestamp', digest=digest)['timestamp']
+
+  def trim(self):
+    """No-op, the server enforces retention policies on its own."""
+
+  def _call(self, method, **kwargs):
+    try:
+      return self._client.call(method, **kwargs)
+    except cache_server.RPCError as e:
+      raise Error('Cache server failed: %s' % e)
+
+
 class IsolatedBundle(object):
   """Fetched and parsed .isolated file with all dependencies."""
 
@@ -2043,7 +2581,7 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   # Hash algorithm to use, defined by namespace |storage| is using.
   algo = storage.hash_algo
   with cache:
-    fetch_queue = FetchQueue(storage, cache)
+    fetch_queue = FetchQueue(storage, cache, batch_fetch=True)
     bundle = IsolatedBundle()
 
     with tools.Profiler('GetIsolateds'):
@@ -2111,7 +2649,14 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
                 for ai, ifd in extractor:
                   fp = os.path.normpath(os.path.join(basedir, ai.name))
                   file_path.ensure_tree(os.path.dirname(fp))
-                  putfile(ifd, fp, 0700, ai.size)
+                  # Entries without a mode of their own are mapped as 0700,
+                  # see pack_small_files(). The mode is not parsed by the
+                  # reader.
+                  file_mode = int(ai.mode, 8)
+                  if file_mode == arfile.AR_DEFAULT_MODE:
+                    file_mode = 0700
+                  file_mode &= 0700
+                  putfile(ifd, fp, file_mode, ai.size)
 
               else:
                 raise isolated_format.IsolatedError(
@@ -2132,30 +2677,110 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def pack_small_files(root, metadata, algo, threshold):
+  """Packs the files up to |threshold| bytes into ar bundles.
+
+  Files are grouped by directory and each bundle is named after its content, so
+  that an unchanged directory produces the exact same bundles across builds and
+  they are deduped by the server. The user bits of the file mode are stored in
+  each ar entry, the only ones honored when mapping a file. Files without a mode
+  in |metadata| keep the default ar mode and are mapped with mode 0700.
+
+  Arguments:
+    root: directory the paths in |metadata| are relative to.
+    metadata: dict relpath -> .isolated file metadata; the packed files are
+        replaced in place by one entry of type 'ar' per bundle.
+    algo: hashing algorithm used.
+    threshold: maximum size of a file to be packed.
+
+  Returns:
+    list of BufferItem, one per bundle.
+  """
+  by_dir = {}
+  for relpath, meta in metadata.iteritems():
+    if ('h' in meta and meta['s'] <= threshold and
+        not relpath.endswith('.isolated')):
+      by_dir.setdefault(os.path.dirname(relpath), []).append(relpath)
+
+  items = []
+  for dirpath, relpaths in sorted(by_dir.iteritems()):
+    if len(relpaths) < 2:
+      # Nothing to gain.
+      continue
+    bundles = [[]]
+    bundle_size = 0
+    for relpath in sorted(relpaths):
+      if bundles[-1] and bundle_size + metadata[relpath]['s'] > (
+          MAX_AR_BUNDLE_SIZE):
+        bundles.append([])
+        bundle_size = 0
+      bundles[-1].append(relpath)
+      bundle_size += metadata[relpath]['s']
+
+    for bundle in bundles:
+      buf = io.BytesIO()
+      writer = arfile.ArFileWriter(buf)
+      for relpath in bundle:
+        info = arfile.ArInfo.fromdefault(
+            os.path.basename(relpath), metadata[relpath]['s'])
+        if 'm' in metadata[relpath]:
+          # The group bits are never set so it can't be the default ar mode.
+          info = info._replace(
+              mode=stat.S_IFREG | (metadata[relpath]['m'] & 0700))
+        with fs.open(os.path.join(root, relpath), 'rb') as f:
+          writer.addfile(info, f)
+      item = BufferItem(buf.getvalue())
+      item.prepare(algo)
+      key = os.path.join(dirpath, u'%s.ar' % item.digest)
+      if key in metadata:
+        # Paranoid check, this is very unlikely.
+        continue
+      for relpath in bundle:
+        del metadata[relpath]
+      metadata[key] = {'h': item.digest, 's': item.size, 't': 'ar'}
+      items.append(item)
+  return items
+
+
+def directory_to_metadata(
+    root, algo, blacklist, pack_threshold=0, prev_metadata=None):
+  """Returns the Item list and .isolated metadata for a directory.
+
+  If |pack_threshold| is set, files up to this size are packed in ar bundles.
+  See pack_small_files() for details.
+
+  |prev_metadata| is an optional dict relpath => metadata as returned by
+  isolated_format.file_to_metadata(), used to skip hashing the files that
+  didn't change since.
+  """
   root = file_path.get_native_path_case(root)
+  prev_metadata = prev_metadata or {}
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
   metadata = {
     relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
+        os.path.join(root, relpath), prev_metadata.get(relpath, {}), 0, algo)
     for relpath in paths
   }
   for v in metadata.itervalues():
     v.pop('t')
+  bundles = []
+  if pack_threshold:
+    bundles = pack_small_files(root, metadata, algo, pack_threshold)
   items = [
       FileItem(
           path=os.path.join(root, relpath),
           digest=meta['h'],
           size=meta['s'],
           high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
+      for relpath, meta in metadata.iteritems()
+      if 'h' in meta and meta.get('t') != 'ar'
   ]
-  return items, metadata
+  return items + bundles, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(
+    storage, files, blacklist, pack_threshold=0, prev_metadata=None):
   """Stores every entries and returns the relevant data.
 
   Arguments:
@@ -2163,9 +2788,13 @@ def archive_files_to_storage(storage, files, blacklist):
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    pack_threshold: if set, small files in directories are packed into ar
+           bundles. See pack_small_files().
+    prev_metadata: optional dict relpath => file metadata of files already
+           hashed in the directories. See directory_to_metadata().
 
   Returns:
-    tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
+    tuple(list(tuple(hash, path)), list(Item cold), list(Item hot)).
     The first file in the first item is always the isolated file.
   """
   assert all(isinstance(i, unicode) for i in files), files
@@ -2185,7 +2814,8 @@ def archive_files_to_storage(storage, files, blacklist):
         if fs.isdir(filepath):
           # Uploading a whole directory.
           items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+              filepath, storage.hash_algo, blacklist, pack_threshold,
+              prev_metadata)
 
           # Create the .isolated file.
           if not tempdir:
@@ -2231,7 +2861,7 @@ def archive_files_to_storage(storage, files, blacklist):
       file_path.rmtree(tempdir)
 
 
-def archive(out, namespace, files, blacklist):
+def archive(out, namespace, files, blacklist, pack_threshold=0):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -2242,7 +2872,8 @@ def archive(out, namespace, files, blacklist):
   blacklist = tools.gen_blacklist(blacklist)
   with get_storage(out, namespace) as storage:
     # Ignore stats.
-    results = archive_files_to_storage(storage, files, blacklist)[0]
+    results = archive_files_to_storage(
+        storage, files, blacklist, pack_threshold)[0]
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -2260,10 +2891,19 @@ def CMDarchive(parser, args):
   """
   add_isolate_server_options(parser)
   add_archive_options(parser)
+  parser.add_option(
+      '--pack-small-files',
+      type='int', metavar='NNN', default=0,
+      help='Pack the files up to this size into ar bundles when uploading '
+           'directories, grouped by directory. It reduces the number of items '
+           'to check and transfer for trees with many tiny files. Default: '
+           'disabled')
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True, True)
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        options.pack_small_files)
   except Error as e:
     parser.error(e.args[0])
   return 0
@@ -2345,6 +2985,43 @@ def CMDdownload(parser, args):
   return 0
 
 
+def CMDcache_server(parser, args):
+  """Serves a local cache to other processes on this host.
+
+  Multiple bots or run_isolated processes on the same host can then share a
+  single cache directory by passing the same --cache-server. Runs until
+  interrupted.
+  """
+  parser.add_option(
+      '--namespace', default='default-gzip',
+      help='Defines the hashing algorithm of the cache, default: %default')
+  add_cache_options(parser)
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('Unsupported arguments: %s' % args)
+  if not options.cache or not options.cache_server:
+    parser.error('--cache and --cache-server are required')
+  if sys.platform == 'win32':
+    parser.error('Not supported on Windows')
+
+  socket_path = options.cache_server
+  options.cache_server = None
+  server = cache_server.LocalCacheServer(
+      process_cache_options(options), CacheMiss)
+  try:
+    server.start(os.path.abspath(socket_path))
+  except cache_server.RPCError as e:
+    parser.error(str(e))
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.stop()
+  return 0
+
+
 def add_archive_options(parser):
   parser.add_option(
       '--blacklist',
@@ -2415,10 +3092,18 @@ def add_cache_options(parser):
       default=100000,
       help='Trim if more than this number of items are in the cache '
            'default=%default')
+  cache_group.add_option(
+      '--cache-server', metavar='SOCKET',
+      help='Unix socket of a local cache server (see the cache-server '
+           'command) to use instead of --cache. This permits sharing a single '
+           'cache between multiple processes on the host.')
   parser.add_option_group(cache_group)
 
 
 def process_cache_options(options, trim=True):
+  if options.cache_server:
+    return SharedCache(
+        options.cache_server, isolated_format.get_hash_algo(options.namespace))
   if options.cache:
     policies = CachePolicies(
         options.max_cache_size, options.min_free_space, options.max_items)
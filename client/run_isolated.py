@@ -36,13 +36,16 @@ import json
 import logging
 import optparse
 import os
+import stat
 import sys
 import tempfile
+import threading
 import time
 
 from third_party.depot_tools import fix_encoding
 
 from utils import file_path
+from utils import file_watcher
 from utils import fs
 from utils import large
 from utils import logging_utils
@@ -53,6 +56,7 @@ from utils import zip_package
 
 import auth
 import cipd
+import isolated_format
 import isolateserver
 import named_cache
 
@@ -104,6 +108,16 @@ ISOLATED_OUT_DIR = u'io'
 ISOLATED_TMP_DIR = u'it'
 
 
+# Minimum age in seconds of a file's modification time before OutputUploader
+# considers it done and uploads it. This also guarantees that a later write
+# changes the file's (rounded) timestamp, so the hash can safely be reused.
+OUTPUT_STABLE_DELAY = 2.
+
+
+# How often OutputUploader looks for new files in ${ISOLATED_OUTDIR}.
+OUTPUT_POLL_INTERVAL = 1.
+
+
 def get_as_zip_package(executable=True):
   """Returns ZipPackage with this module and all its dependencies.
 
@@ -310,9 +324,121 @@ def link_outputs_to_outdir(run_dir, out_dir, outputs):
       sys.stderr.write('<Could not return file %s: %s>' % (o, e))
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+class OutputUploader(object):
+  """Uploads the files written to out_dir while the task is still running.
+
+  Files are uploaded once they are closed and weren't modified for
+  OUTPUT_STABLE_DELAY seconds. When the task completes, only the files that
+  changed since or were written late need to be hashed and uploaded, along the
+  .isolated file.
+
+  This is best effort; delete_and_upload() does the authoritative pass.
+  """
+
+  def __init__(self, storage, out_dir):
+    self._storage = storage
+    self._out_dir = out_dir
+    self._stop = threading.Event()
+    self._thread = None
+    # Only accessed from the background thread until it is joined.
+    self._pending = set()
+    self._metadata = {} # dict relpath => file metadata
+    self._uploaded = [] # list of Item
+
+  def start(self):
+    assert not self._thread
+    self._thread = threading.Thread(
+        target=self._run, name='OutputUploader')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stops the background uploads.
+
+    Returns:
+      tuple(dict relpath => file metadata, list of Item uploaded).
+    """
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+      self._thread = None
+    return self._metadata, self._uploaded
+
+  def _run(self):
+    try:
+      watcher = file_watcher.get_watcher(self._out_dir)
+      try:
+        while not self._stop.is_set():
+          self._pending.update(watcher.poll(OUTPUT_POLL_INTERVAL))
+          self._upload_stable()
+      finally:
+        watcher.close()
+    except Exception as e:
+      # Includes isolateserver.Aborted. The outputs are uploaded at the end
+      # anyway.
+      logging.warning('Stopped uploading outputs early: %s', e)
+
+  def _upload_stable(self):
+    """Uploads the pending files that weren't modified in a while."""
+    now = time.time()
+    to_upload = []
+    for path in sorted(self._pending):
+      try:
+        st = os.lstat(path)
+      except OSError:
+        self._pending.discard(path)
+        continue
+      if not stat.S_ISREG(st.st_mode):
+        self._pending.discard(path)
+        continue
+      if now - st.st_mtime < OUTPUT_STABLE_DELAY:
+        # Still possibly being written to, check it again later.
+        continue
+      self._pending.discard(path)
+      relpath = os.path.relpath(path, self._out_dir)
+      if not self._is_current(relpath, st):
+        to_upload.append(relpath)
+    if not to_upload:
+      return
+
+    algo = self._storage.hash_algo
+    metadata = {}
+    items = []
+    for relpath in to_upload:
+      path = os.path.join(self._out_dir, relpath)
+      try:
+        meta = isolated_format.file_to_metadata(path, {}, 0, algo)
+      except isolated_format.MappingError:
+        continue
+      metadata[relpath] = meta
+      items.append(
+          isolateserver.FileItem(path=path, digest=meta['h'], size=meta['s']))
+    self._uploaded.extend(self._storage.upload_items(items))
+    for relpath, meta in metadata.iteritems():
+      # Only keep the metadata of the files that weren't modified while being
+      # hashed or uploaded.
+      try:
+        st = os.lstat(os.path.join(self._out_dir, relpath))
+      except OSError:
+        continue
+      if (st.st_size == meta['s'] and
+          int(round(st.st_mtime)) == meta['t']):
+        self._metadata[relpath] = meta
+    logging.info('Uploaded %d outputs early', len(items))
+
+  def _is_current(self, relpath, st):
+    meta = self._metadata.get(relpath)
+    return bool(
+        meta and meta['s'] == st.st_size and
+        meta['t'] == int(round(st.st_mtime)))
+
+
+def delete_and_upload(storage, out_dir, leak_temp_dir, uploader=None):
   """Deletes the temporary run directory and uploads results back.
 
+  If |uploader| is specified, it is stopped and the files it already uploaded
+  are not hashed again.
+
   Returns:
     tuple(outputs_ref, success, stats)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -328,17 +454,26 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
   cold = []
   hot = []
   start = time.time()
+  prev_metadata = {}
+  early_uploaded = set()
+  if uploader:
+    prev_metadata, early_items = uploader.stop()
+    early_uploaded = set(i.digest for i in early_items)
 
   if fs.isdir(out_dir) and fs.listdir(out_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, prev_metadata=prev_metadata)
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
           'namespace': storage.namespace,
         }
+        # Items uploaded early are reported as present by now, but they were
+        # really cold.
+        f_cold = f_cold + [i for i in f_hot if i.digest in early_uploaded]
+        f_hot = [i for i in f_hot if i.digest not in early_uploaded]
         cold = sorted(i.size for i in f_cold)
         hot = sorted(i.size for i in f_hot)
       except isolateserver.Aborted:
@@ -373,7 +508,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
 def map_and_run(
     command, isolated_hash, storage, isolate_cache, outputs, init_name_caches,
     leak_temp_dir, root_dir, hard_timeout, grace_period, bot_file, extra_args,
-    install_packages_fn, use_symlinks):
+    install_packages_fn, use_symlinks, upload_outputs_early=False):
   """Runs a command with optional isolated input/output.
 
   See run_tha_test for argument documentation.
@@ -429,6 +564,7 @@ def map_and_run(
   out_dir = make_temp_dir(ISOLATED_OUT_DIR, root_dir) if storage else None
   tmp_dir = make_temp_dir(ISOLATED_TMP_DIR, root_dir)
   cwd = run_dir
+  uploader = None
 
   try:
     cipd_info = install_packages_fn(run_dir)
@@ -470,6 +606,10 @@ def map_and_run(
 
     init_name_caches(run_dir)
 
+    if out_dir and upload_outputs_early:
+      uploader = OutputUploader(storage, out_dir)
+      uploader.start()
+
     sys.stdout.flush()
     start = time.time()
     try:
@@ -535,7 +675,7 @@ def map_and_run(
       if out_dir:
         isolated_stats = result['stats'].setdefault('isolated', {})
         result['outputs_ref'], success, isolated_stats['upload'] = (
-            delete_and_upload(storage, out_dir, leak_temp_dir))
+            delete_and_upload(storage, out_dir, leak_temp_dir, uploader))
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
     except Exception as e:
@@ -549,7 +689,7 @@ def map_and_run(
 def run_tha_test(
     command, isolated_hash, storage, isolate_cache, outputs, init_name_caches,
     leak_temp_dir, result_json, root_dir, hard_timeout, grace_period, bot_file,
-    extra_args, install_packages_fn, use_symlinks):
+    extra_args, install_packages_fn, use_symlinks, upload_outputs_early=False):
   """Runs an executable and records execution metadata.
 
   Either command or isolated_hash must be specified.
@@ -591,6 +731,8 @@ def run_tha_test(
     install_packages_fn: function (dir) => {"stats": cipd_stats, "pins":
                          cipd_pins}. Installs packages.
     use_symlinks: create tree with symlinks instead of hardlinks.
+    upload_outputs_early: hash and upload the files written to
+                          ${ISOLATED_OUTDIR} while the command is running.
 
   Returns:
     Process exit code that should be used.
@@ -616,7 +758,7 @@ def run_tha_test(
   result = map_and_run(
       command, isolated_hash, storage, isolate_cache, outputs, init_name_caches,
       leak_temp_dir, root_dir, hard_timeout, grace_period, bot_file, extra_args,
-      install_packages_fn, use_symlinks)
+      install_packages_fn, use_symlinks, upload_outputs_early)
   logging.info('Result:\n%s', tools.format_json(result, dense=True))
 
   if result_json:
@@ -800,6 +942,11 @@ def create_option_parser():
            'specified by --output option (there can be multiple) will be '
            'returned. Note that if a file in OUT_DIR has the same path '
            'as an --output option, the --output version will be returned.')
+  parser.add_option(
+      '--upload-outputs-early', action='store_true',
+      help='Hash and upload the files written to $(ISOLATED_OUTDIR) as soon '
+           'as they are closed, while the command is still running, instead '
+           'of only once it completed')
   parser.add_option(
       '-a', '--argsfile',
       # This is actually handled in parse_args; it's included here purely so it
@@ -937,7 +1084,8 @@ def main(args):
             options.grace_period,
             options.bot_file, args,
             install_packages_fn,
-            options.use_symlinks)
+            options.use_symlinks,
+            options.upload_outputs_early)
     return run_tha_test(
         command,
         options.isolated,
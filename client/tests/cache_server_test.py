@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+from depot_tools import auto_stub
+from depot_tools import fix_encoding
+
+import isolated_format
+import isolateserver
+from utils import cache_server
+from utils import file_path
+
+
+def global_test_setup():
+  # Terminate the server in tests 50x faster.
+  cache_server._UnixServer.poll_interval = 0.01
+
+
+class LocalCacheServerTest(auto_stub.TestCase):
+  def setUp(self):
+    super(LocalCacheServerTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'cache_server')
+    self.algo = isolated_format.get_hash_algo('default-gzip')
+    self.policies = isolateserver.CachePolicies(0, 0, 0)
+    self.disk_cache = isolateserver.DiskCache(
+        os.path.join(self.tempdir, u'cache'), self.policies, self.algo)
+    self.socket_path = os.path.join(self.tempdir, u'cache.sock')
+    self.server = cache_server.LocalCacheServer(
+        self.disk_cache, isolateserver.CacheMiss)
+    self.server.start(self.socket_path)
+
+  def tearDown(self):
+    try:
+      self.server.stop()
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(LocalCacheServerTest, self).tearDown()
+
+  def to_hash(self, content):
+    return self.algo(content).hexdigest(), content
+
+  def get_client(self):
+    return isolateserver.SharedCache(self.socket_path, self.algo)
+
+  def test_write_read_evict(self):
+    h_a, a = self.to_hash('a')
+    client = self.get_client()
+    self.assertEqual(self.disk_cache.cache_dir, client.cache_dir)
+    self.assertEqual(h_a, client.write(h_a, [a]))
+    self.assertIn(h_a, client)
+    self.assertEqual(set([h_a]), client.cached_set())
+    self.assertEqual([1], client.added)
+
+    # Another client sees the item, and reads it directly off the disk.
+    other = self.get_client()
+    self.assertTrue(other.touch(h_a, 1))
+    with other.getfileobj(h_a) as f:
+      self.assertEqual(
+          os.path.join(self.disk_cache.cache_dir, h_a), f.name)
+      self.assertEqual('a', f.read())
+    self.assertEqual([1], other.used)
+    self.assertEqual(h_a, other.get_oldest())
+
+    other.evict(h_a)
+    self.assertNotIn(h_a, client)
+    with self.assertRaises(isolateserver.CacheMiss):
+      client.getfileobj(h_a)
+
+  def test_write_present(self):
+    h_a, a = self.to_hash('a')
+    self.get_client().write(h_a, [a])
+    def content():
+      self.fail('Content must not be read')
+      yield a
+    client = self.get_client()
+    client.write(h_a, content())
+    self.assertEqual([], client.added)
+
+  def test_write_coalesced(self):
+    # The second writer waits for the first one and doesn't read its content.
+    h_a, a = self.to_hash('a' * 100)
+    started = threading.Event()
+    resume = threading.Event()
+    def slow_content():
+      started.set()
+      resume.wait()
+      yield a
+
+    first = self.get_client()
+    t = threading.Thread(target=first.write, args=(h_a, slow_content()))
+    t.start()
+    started.wait()
+
+    second_read = []
+    def content():
+      second_read.append(True)
+      yield a
+    second = self.get_client()
+    t2 = threading.Thread(target=second.write, args=(h_a, content()))
+    t2.start()
+    resume.set()
+    t.join()
+    t2.join()
+    self.assertEqual([], second_read)
+    self.assertEqual([100], first.added)
+    self.assertEqual([], second.added)
+    self.assertTrue(second.touch(h_a, 100))
+
+  def test_write_broken_stream(self):
+    h_a, a = self.to_hash('a')
+    def content():
+      yield a
+      raise IOError('Network blip')
+    client = self.get_client()
+    with self.assertRaises(IOError):
+      client.write(h_a, content())
+    self.assertNotIn(h_a, client)
+    # It can be retried.
+    client.write(h_a, [a])
+    self.assertIn(h_a, client)
+
+  def test_protected_per_session(self):
+    h_a, a = self.to_hash('a')
+    h_b, b = self.to_hash('b')
+    first = self.get_client()
+    second = self.get_client()
+    with first:
+      first.write(h_a, [a])
+      with second:
+        second.write(h_b, [b])
+        self.assertEqual(h_a, self.disk_cache._protected)
+      # The oldest session is still running.
+      self.assertEqual(h_a, self.disk_cache._protected)
+    self.assertEqual(None, self.disk_cache._protected)
+
+    with second:
+      self.assertTrue(second.touch(h_b, 1))
+      self.assertEqual(h_b, self.disk_cache._protected)
+    self.assertEqual(None, self.disk_cache._protected)
+
+  def test_no_cleanup_nor_trim_rpc(self):
+    client = self.get_client()
+    for method in ('cleanup', 'trim'):
+      with self.assertRaises(isolateserver.Error):
+        client._call(method)
+
+  def test_cleanup_on_start(self):
+    self.server.stop()
+    unknown = os.path.join(self.disk_cache.cache_dir, 'unknown')
+    with open(unknown, 'wb') as f:
+      f.write('x')
+    self.server.start(self.socket_path)
+    self.assertFalse(os.path.exists(unknown))
+
+  def test_getfileobj_error(self):
+    h_a, a = self.to_hash('a')
+    client = self.get_client()
+    client.write(h_a, [a])
+    def getfileobj(_digest):
+      raise OSError('Boom')
+    self.mock(self.disk_cache, 'getfileobj', getfileobj)
+    with self.assertRaises(isolateserver.Error):
+      client.getfileobj(h_a)
+
+  def test_cache_already_owned(self):
+    other = cache_server.LocalCacheServer(
+        self.disk_cache, isolateserver.CacheMiss)
+    with self.assertRaises(cache_server.RPCError):
+      other.start(os.path.join(self.tempdir, u'other.sock'))
+
+  def test_not_running(self):
+    self.server.stop()
+    with self.assertRaises(isolateserver.Error):
+      self.get_client()
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.CRITICAL)
+  global_test_setup()
+  unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+from depot_tools import fix_encoding
+from utils import file_path
+from utils import file_watcher
+
+
+def write_content(filepath, content):
+  with open(filepath, 'wb') as f:
+    f.write(content)
+
+
+class WatcherTestMixin(object):
+  watcher_class = None
+
+  def setUp(self):
+    super(WatcherTestMixin, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'file_watcher_test')
+    write_content(os.path.join(self.tempdir, u'before'), 'a')
+    self.watcher = self.watcher_class(self.tempdir)
+
+  def tearDown(self):
+    try:
+      self.watcher.close()
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(WatcherTestMixin, self).tearDown()
+
+  def join(self, *args):
+    return os.path.join(self.tempdir, *args)
+
+  def poll_until(self, expected):
+    # The polling watcher reports everything so only check inclusion.
+    seen = set()
+    for _ in xrange(50):
+      seen.update(self.watcher.poll(0.01))
+      if expected <= seen:
+        break
+    self.assertTrue(expected <= seen, (expected, seen))
+    return seen
+
+  def test_existing(self):
+    self.poll_until({self.join(u'before')})
+
+  def test_new_files(self):
+    self.poll_until({self.join(u'before')})
+    write_content(self.join(u'new'), 'b')
+    os.mkdir(self.join(u'sub'))
+    write_content(self.join(u'sub', u'inner'), 'c')
+    write_content(self.join(u'tmp'), 'd')
+    os.rename(self.join(u'tmp'), self.join(u'sub', u'moved'))
+    self.poll_until({
+      self.join(u'new'),
+      self.join(u'sub', u'inner'),
+      self.join(u'sub', u'moved'),
+    })
+
+
+class PollingWatcherTest(WatcherTestMixin, unittest.TestCase):
+  watcher_class = file_watcher.PollingWatcher
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class InotifyWatcherTest(WatcherTestMixin, unittest.TestCase):
+  watcher_class = file_watcher.InotifyWatcher
+
+  def test_only_changed(self):
+    self.assertEqual({self.join(u'before')}, self.watcher.poll(0))
+    self.assertEqual(set(), self.watcher.poll(0))
+    write_content(self.join(u'new'), 'b')
+    self.assertEqual({self.join(u'new')}, self.watcher.poll(1))
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
@@ -57,7 +57,7 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
         self._should_push_to_gs(embedded['i'], embedded['s'])]
     return FakeSigner.generate(message, embedded)
 
-  def _storage_helper(self, body, gs=False):
+  def _storage_helper(self, body, gs=False, reply=True):
     request = json.loads(body)
     message = ['datastore', 'gs'][gs]
     content = request['content'] if not gs else None
@@ -65,8 +65,11 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
     namespace = embedded['n']
     if namespace not in self.server.contents:
       self.server.contents[namespace] = {}
-    self.server.contents[namespace][embedded['d']] = content
-    self._json({'ok': True})
+    if not gs:
+      # Content pushed to GS was already saved by do_PUT.
+      self.server.contents[namespace][embedded['d']] = content
+    if reply:
+      self._json({'ok': True})
 
   ### Mocked HTTP Methods
 
@@ -100,7 +103,8 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
               'upload_ticket': self._generate_ticket(entry),
           }
           if self._should_push_to_gs(entry['i'], entry['s']):
-            status['gs_upload_url'] = self._generate_signed_url(entry['d'])
+            status['gs_upload_url'] = self._generate_signed_url(
+                entry['d'], entry['n'])
           li.append(status)
         # Don't use finalize url for the mock.
 
@@ -115,10 +119,24 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
         }, index, response['items'])
       logging.info('Returning %s' % response)
       self._json(response)
+    elif self.path.startswith('/api/isolateservice/v1/store_inline_batch'):
+      for item in json.loads(body)['items']:
+        self._storage_helper(json.dumps(item), reply=False)
+      self._json({'ok': True})
     elif self.path.startswith('/api/isolateservice/v1/store_inline'):
       self._storage_helper(body)
     elif self.path.startswith('/api/isolateservice/v1/finalize_gs_upload'):
       self._storage_helper(body, True)
+    elif self.path.startswith('/api/isolateservice/v1/retrieve_batch'):
+      request = json.loads(body)
+      namespace = request['namespace']['namespace']
+      contents = self.server.contents[namespace]
+      self._json({
+        'items': [
+          {'digest': d, 'content': contents[d]}
+          for d in request['digests'] if d in contents
+        ],
+      })
     elif self.path.startswith('/api/isolateservice/v1/retrieve'):
       request = json.loads(body)
       namespace = request['namespace']['namespace']
@@ -137,7 +155,8 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
       body = '<skipped>'
       self._drop_body()
     else:
-      body = self._read_body()
+      # Stored like inline content, so it can be retrieved the same way.
+      body = base64.b64encode(self._read_body())
     if self.path.startswith('/FAKE_GCS/'):
       namespace, h = self.path[len('/FAKE_GCS/'):].split('/', 1)
       self.server.contents.setdefault(namespace, {})[h] = body
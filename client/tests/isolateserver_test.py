@@ -34,6 +34,7 @@ from utils import logging_utils
 from utils import threading_utils
 
 import isolateserver_mock
+from libs import arfile
 
 
 CONTENTS = {
@@ -109,6 +110,45 @@ class TestZipCompression(TestCase):
     with self.assertRaises(IOError):
       ''.join(isolateserver.zip_decompress(['Im not a zip file']))
 
+  def test_compress_parallel(self):
+    """Parallel compression yields a single standard zlib stream."""
+    pool = threading_utils.ThreadPool(0, 4, 0)
+    try:
+      for original in ('', 'a', 'abcdefghij' * 1000):
+        for block_size in (1, 7, 1000, 100000):
+          compressed = ''.join(isolateserver.zip_compress_parallel(
+              [original[:5], original[5:]], 6, pool, block_size))
+          self.assertEqual(original, zlib.decompress(compressed))
+          self.assertEqual(
+              original,
+              ''.join(isolateserver.zip_decompress([compressed])))
+    finally:
+      pool.close()
+
+  def test_peek_content(self):
+    sample, content = isolateserver.peek_content(['ab', 'cd', 'ef'], 3)
+    self.assertEqual('abc', sample)
+    self.assertEqual('abcdef', ''.join(content))
+    sample, content = isolateserver.peek_content([], 3)
+    self.assertEqual('', sample)
+    self.assertEqual('', ''.join(content))
+
+  def test_choose_zip_compression_level(self):
+    # Incompressible content is not compressed whatever its name.
+    self.assertEqual(
+        0,
+        isolateserver.choose_zip_compression_level(
+            os.urandom(64 * 1024), 1024 * 1024, 7))
+    # Compressed content stays that way.
+    self.assertEqual(
+        0,
+        isolateserver.choose_zip_compression_level(
+            'a' * 64 * 1024, 1024 * 1024, 0))
+    self.assertIn(
+        isolateserver.choose_zip_compression_level(
+            'hello world' * 10000, 1024 * 1024, 7),
+        isolateserver.COMPRESSION_LEVELS)
+
 
 class FakeItem(isolateserver.Item):
   def __init__(self, data, high_priority=False):
@@ -345,6 +385,105 @@ class StorageTest(TestCase):
           [(item, 'push_state', item.zipped if use_zip else item.data)],
           storage_api.push_calls)
 
+  def test_upload_items_batch(self):
+    # Small items are pushed in batches, large ones one by one.
+    self.mock(isolateserver, 'BATCH_PUSH_MAX_ITEM_SIZE', 10)
+    self.mock(isolateserver, 'BATCH_PUSH_MAX_ITEMS', 3)
+    small = [FakeItem(str(i)) for i in xrange(5)]
+    large = FakeItem('0123456789' * 10)
+    items = small + [large]
+    batch_calls = []
+    class BatchStorageApi(MockedStorageApi):
+      def push_batch(self, batch):
+        batch_calls.append(sorted(item.data for item, _, _ in batch))
+        super(BatchStorageApi, self).push_batch(batch)
+    storage_api = BatchStorageApi({i.digest: 'push_state' for i in items})
+    with isolateserver.Storage(storage_api) as storage:
+      uploaded = storage.upload_items(items)
+    self.assertEqualIgnoringOrder(items, uploaded)
+    self.assertEqual(['0', '1', '2', '3', '4'], sorted(sum(batch_calls, [])))
+    self.assertEqual([3, 2], sorted(map(len, batch_calls), reverse=True))
+    self.assertEqualIgnoringOrder(
+        [(i, 'push_state', i.data) for i in items], storage_api.push_calls)
+
+  def test_upload_items_batch_retried(self):
+    # A batch that failed with an IOError is retried like single pushes.
+    self.mock(isolateserver, 'BATCH_PUSH_MAX_ITEM_SIZE', 10)
+    items = [FakeItem(str(i)) for i in xrange(3)]
+    batch_calls = []
+    class FlakyStorageApi(MockedStorageApi):
+      def push_batch(self, batch):
+        batch_calls.append(sorted(item.data for item, _, _ in batch))
+        if len(batch_calls) == 1:
+          raise IOError('Network blip')
+        super(FlakyStorageApi, self).push_batch(batch)
+    storage_api = FlakyStorageApi({i.digest: 'push_state' for i in items})
+    with isolateserver.Storage(storage_api) as storage:
+      uploaded = storage.upload_items(items)
+    self.assertEqualIgnoringOrder(items, uploaded)
+    self.assertEqual([['0', '1', '2'], ['0', '1', '2']], batch_calls)
+
+  def test_fetch_queue_batch(self):
+    # Small items are fetched in batches, the ones missing from the batch
+    # response and the large ones are fetched one by one.
+    self.mock(isolateserver, 'BATCH_FETCH_MAX_ITEM_SIZE', 10)
+    self.mock(isolateserver, 'BATCH_FETCH_MAX_ITEMS', 3)
+    contents = {
+      hashlib.sha1(c).hexdigest(): c
+      for c in ('a', 'b', 'c', 'd', 'e', '0123456789ab')
+    }
+    skipped = hashlib.sha1('d').hexdigest()
+    batch_calls = []
+    fetch_calls = []
+    class BatchStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0):
+        fetch_calls.append(digest)
+        yield contents[digest]
+      def fetch_batch(self, digests):
+        batch_calls.append(sorted(digests))
+        return {d: contents[d] for d in digests if d != skipped}
+    cache = isolateserver.MemoryCache()
+    with isolateserver.Storage(BatchStorageApi({})) as storage:
+      queue = isolateserver.FetchQueue(storage, cache, batch_fetch=True)
+      for digest, content in contents.iteritems():
+        queue.add(digest, len(content))
+      pending = set(contents)
+      while pending:
+        pending.discard(queue.wait(pending))
+    for digest, content in contents.iteritems():
+      with cache.getfileobj(digest) as f:
+        self.assertEqual(content, f.read())
+    self.assertEqual([3, 2], sorted(map(len, batch_calls), reverse=True))
+    self.assertEqual(
+        sorted([skipped, hashlib.sha1('0123456789ab').hexdigest()]),
+        sorted(fetch_calls))
+
+  def test_async_push_large(self):
+    # Large items are sampled and compressed in parallel blocks.
+    self.mock(isolateserver, 'COMPRESSION_SAMPLE_MIN_SIZE', 1000)
+    self.mock(isolateserver, 'COMPRESSION_SAMPLE_SIZE', 100)
+    self.mock(isolateserver, 'PARALLEL_ZIP_MIN_SIZE', 1000)
+    self.mock(isolateserver, 'ZIP_BLOCK_SIZE', 100)
+    blocks = []
+    def iter_blocks(content_generator, block_size):
+      for block in orig_iter_blocks(content_generator, block_size):
+        blocks.append(block)
+        yield block
+    orig_iter_blocks = self.mock(isolateserver, '_iter_blocks', iter_blocks)
+    # Incompressible content is stored at level 0, so it's not compressed at
+    # all.
+    for data, block_count in (
+        ('0123456789' * 1000, 100), (os.urandom(10000), 0)):
+      del blocks[:]
+      item = FakeItem(data)
+      storage_api = MockedStorageApi(
+          {item.digest: 'push_state'}, namespace='default-gzip')
+      with isolateserver.Storage(storage_api) as storage:
+        storage.push(item, self.get_push_state(storage, item))
+      self.assertEqual(1, len(storage_api.push_calls))
+      self.assertEqual(data, zlib.decompress(storage_api.push_calls[0][2]))
+      self.assertEqual([100] * block_count, map(len, blocks))
+
   def test_async_push_generator_errors(self):
     class FakeException(Exception):
       pass
@@ -744,6 +883,196 @@ class IsolateServerStorageApiTest(TestCase):
           push_state.upload_url, 'api/isolateservice/v1/store_inline')
       self.assertEqual(push_state.finalize_url, None)
 
+  def test_push_batch(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    items = [FakeItem('a'), FakeItem('b')]
+    push_states = [
+      isolateserver._IsolateServerPushState(
+          {'upload_ticket': 'ticket_%d' % i}, 1)
+      for i in xrange(2)
+    ]
+    self.expected_requests([
+      (
+        server + '/api/isolateservice/v1/store_inline_batch',
+        {
+          'data': {
+            'items': [
+              {'content': base64.b64encode('a'), 'upload_ticket': 'ticket_0'},
+              {'content': base64.b64encode('b'), 'upload_ticket': 'ticket_1'},
+            ],
+          },
+        },
+        {'ok': True},
+      ),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    storage.push_batch(
+        [(i, s, [i.data]) for i, s in zip(items, push_states)])
+    self.assertTrue(all(s.finalized for s in push_states))
+
+  def test_push_batch_unsupported(self):
+    # Falls back to one by one pushes, for this batch and the next ones.
+    server = 'http://example.com'
+    namespace = 'default'
+    items = [FakeItem('a'), FakeItem('b')]
+    push_states = [
+      isolateserver._IsolateServerPushState(
+          {'upload_ticket': 'ticket_%d' % i}, 1)
+      for i in xrange(2)
+    ]
+    self.expected_requests([
+      (
+        server + '/api/isolateservice/v1/store_inline_batch',
+        {
+          'data': {
+            'items': [
+              {'content': base64.b64encode('a'), 'upload_ticket': 'ticket_0'},
+            ],
+          },
+        },
+        None,
+      ),
+      self.mock_upload_request(
+          server, base64.b64encode('a'), 'ticket_0', {'ok': True}),
+      self.mock_upload_request(
+          server, base64.b64encode('b'), 'ticket_1', {'ok': True}),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    for i in xrange(2):
+      storage.push_batch([(items[i], push_states[i], [items[i].data])])
+    self.assertTrue(all(s.finalized for s in push_states))
+
+  def test_push_batch_failed_once(self):
+    # Only the failed batch is pushed one by one.
+    server = 'http://example.com'
+    namespace = 'default'
+    items = [FakeItem('a'), FakeItem('b')]
+    push_states = [
+      isolateserver._IsolateServerPushState(
+          {'upload_ticket': 'ticket_%d' % i}, 1)
+      for i in xrange(2)
+    ]
+    def batch_request(i, response):
+      return (
+        server + '/api/isolateservice/v1/store_inline_batch',
+        {
+          'data': {
+            'items': [
+              {
+                'content': base64.b64encode(items[i].data),
+                'upload_ticket': 'ticket_%d' % i,
+              },
+            ],
+          },
+        },
+        response,
+      )
+    self.expected_requests([
+      batch_request(0, {'ok': False}),
+      self.mock_upload_request(
+          server, base64.b64encode('a'), 'ticket_0', {'ok': True}),
+      batch_request(1, {'ok': True}),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    for i in xrange(2):
+      storage.push_batch([(items[i], push_states[i], [items[i].data])])
+    self.assertTrue(all(s.finalized for s in push_states))
+
+  def test_fetch_batch(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    self.expected_requests([
+      (
+        server + '/api/isolateservice/v1/retrieve_batch',
+        {
+          'data': {
+            'digests': ['a', 'b', 'c'],
+            'namespace': {
+              'compression': '',
+              'digest_hash': 'sha-1',
+              'namespace': namespace,
+            },
+          },
+        },
+        {
+          'items': [
+            {'digest': 'a', 'content': base64.b64encode('A')},
+            {'digest': 'b', 'url': server + '/some/gs/url/default/b'},
+          ],
+        },
+      ),
+      self.mock_gs_request(server, namespace, 'b', 'B'),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    self.assertEqual(
+        {'a': 'A', 'b': 'B'}, storage.fetch_batch(['a', 'b', 'c']))
+
+  def test_async_fetch_batch_gs(self):
+    # An entry stored in GS is downloaded from the URL returned by
+    # retrieve_batch, without a 'retrieve' call.
+    server = 'http://example.com'
+    namespace = 'default'
+    digest = isolateserver_mock.hash_content('B')
+    self.expected_requests([
+      (
+        server + '/api/isolateservice/v1/retrieve_batch',
+        {
+          'data': {
+            'digests': [digest],
+            'namespace': {
+              'compression': '',
+              'digest_hash': 'sha-1',
+              'namespace': namespace,
+            },
+          },
+        },
+        {
+          'items': [
+            {
+              'digest': digest,
+              'url': server + '/some/gs/url/default/%s' % digest,
+            },
+          ],
+        },
+      ),
+      self.mock_gs_request(server, namespace, digest, 'B'),
+    ])
+    fetched = []
+    def sink(stream):
+      fetched.append(''.join(stream))
+    with isolateserver.Storage(
+        isolateserver.IsolateServer(server, namespace)) as storage:
+      channel = threading_utils.TaskChannel()
+      storage.async_fetch_batch(
+          channel, threading_utils.PRIORITY_MED, [(digest, 1, sink)])
+      self.assertEqual(digest, channel.pull())
+    self.assertEqual(['B'], fetched)
+
+  def test_fetch_batch_unsupported(self):
+    # Batching is disabled after the first failure.
+    server = 'http://example.com'
+    namespace = 'default'
+    self.expected_requests([
+      (
+        server + '/api/isolateservice/v1/retrieve_batch',
+        {
+          'data': {
+            'digests': ['a'],
+            'namespace': {
+              'compression': '',
+              'digest_hash': 'sha-1',
+              'namespace': namespace,
+            },
+          },
+        },
+        None,
+      ),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual({}, storage.fetch_batch(['a']))
+
   def test_contains_network_failure(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -1228,6 +1557,65 @@ class TestArchive(TestCase):
     with test_utils.EnvVars({'ISOLATE_SERVER': 'https://localhost:1'}):
       self.help_test_archive(['archive'])
 
+  def test_directory_to_metadata_pack_small_files(self):
+    self.make_tree({
+      'a/1.txt': '1',
+      'a/2.txt': 'two',
+      'a/large.bin': 'x' * 100,
+      'b/alone.txt': 'alone',
+    })
+    if sys.platform != 'win32':
+      os.chmod(os.path.join(self.tempdir, 'a', '1.txt'), 0644)
+      os.chmod(os.path.join(self.tempdir, 'a', '2.txt'), 0755)
+    algo = isolated_format.get_hash_algo('default-gzip')
+    items, metadata = isolateserver.directory_to_metadata(
+        self.tempdir, algo, None, 10)
+    # 'a/1.txt' and 'a/2.txt' were packed, 'b/alone.txt' is not worth it.
+    ar_key = [k for k, v in metadata.iteritems() if v.get('t') == 'ar']
+    self.assertEqual(1, len(ar_key))
+    ar_key = ar_key[0]
+    self.assertEqual('a', os.path.dirname(ar_key))
+    self.assertEqual(
+        sorted([ar_key, os.path.join('a', 'large.bin'),
+                os.path.join('b', 'alone.txt')]),
+        sorted(metadata))
+    self.assertEqual(3, len(items))
+    bundle = [i for i in items if i.digest == metadata[ar_key]['h']][0]
+    self.assertEqual(metadata[ar_key]['s'], bundle.size)
+    extracted = [
+      (ai.name, f.read(ai.size))
+      for ai, f in arfile.ArFileReader(
+          io.BytesIO(''.join(bundle.content())), fullparse=False)
+    ]
+    self.assertEqual([(u'1.txt', '1'), (u'2.txt', 'two')], extracted)
+    if sys.platform != 'win32':
+      # The user bits of the mode are kept.
+      modes = [
+        int(ai.mode, 8)
+        for ai, _ in arfile.ArFileReader(
+            io.BytesIO(''.join(bundle.content())), fullparse=False)
+      ]
+      self.assertEqual([0100600, 0100700], modes)
+
+    # Packing is deterministic.
+    _, metadata2 = isolateserver.directory_to_metadata(
+        self.tempdir, algo, None, 10)
+    self.assertEqual(metadata, metadata2)
+
+  def test_pack_small_files_split(self):
+    self.mock(isolateserver, 'MAX_AR_BUNDLE_SIZE', 4)
+    self.make_tree({'1': 'aa', '2': 'bb', '3': 'cc'})
+    metadata = {
+      unicode(k): {'h': isolateserver_mock.hash_content(v), 's': 2}
+      for k, v in (('1', 'aa'), ('2', 'bb'), ('3', 'cc'))
+    }
+    algo = isolated_format.get_hash_algo('default-gzip')
+    items = isolateserver.pack_small_files(self.tempdir, metadata, algo, 10)
+    self.assertEqual(2, len(items))
+    self.assertEqual(
+        [{'t': 'ar'}, {'t': 'ar'}],
+        [{'t': v['t']} for v in metadata.itervalues()])
+
 
 class DiskCacheTest(TestCase):
   def setUp(self):
@@ -13,6 +13,7 @@ import logging
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
@@ -67,6 +68,10 @@ class StorageFake(object):
     sink([self._files[digest]])
     channel.send_result(digest)
 
+  def async_fetch_batch(self, channel, priority, batch):
+    for digest, size, sink in batch:
+      self.async_fetch(channel, priority, digest, size, sink)
+
   def upload_items(self, items_to_upload):
     # Return all except the first one.
     return items_to_upload[1:]
@@ -795,6 +800,71 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     self.assertEqual(expected, actual)
 
 
+class UploadRecorder(object):
+  """Storage that records the uploaded items, which are all missing."""
+  namespace = 'default-gzip'
+  location = 'http://localhost:1'
+  hash_algo = isolateserver_mock.ALGO
+
+  def __init__(self):
+    self.uploaded = []
+
+  def upload_items(self, items):
+    for i in items:
+      i.prepare(self.hash_algo)
+    self.uploaded.extend(items)
+    return items
+
+
+class OutputUploaderTest(auto_stub.TestCase):
+  def setUp(self):
+    super(OutputUploaderTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'run_isolated_test')
+    self.mock(run_isolated, 'OUTPUT_POLL_INTERVAL', 0.01)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(OutputUploaderTest, self).tearDown()
+
+  def test_upload_early(self):
+    storage = UploadRecorder()
+    old = os.path.join(self.tempdir, u'old')
+    write_content(old, 'old')
+    past = time.time() - 60
+    os.utime(old, (past, past))
+    uploader = run_isolated.OutputUploader(storage, self.tempdir)
+    uploader.start()
+    for _ in xrange(500):
+      if storage.uploaded:
+        break
+      time.sleep(0.01)
+    # Too recent to be uploaded.
+    write_content(os.path.join(self.tempdir, u'new'), 'new')
+    metadata, uploaded = uploader.stop()
+    self.assertEqual([old], [i.path for i in uploaded])
+    self.assertEqual(['old'], metadata.keys())
+    self.assertEqual(
+        isolateserver_mock.hash_content('old'), metadata['old']['h'])
+
+    hashed = []
+    hash_file = isolated_format.hash_file
+    def hash_file_mock(filepath, algo):
+      hashed.append(os.path.basename(filepath))
+      return hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', hash_file_mock)
+    outputs_ref, success, stats = run_isolated.delete_and_upload(
+        storage, self.tempdir, True, uploader)
+    self.assertTrue(success)
+    self.assertTrue(outputs_ref['isolated'])
+    # Only the new file and the .isolated were hashed at the end.
+    self.assertEqual(
+        ['new'], [h for h in hashed if not h.endswith('.isolated')])
+    self.assertEqual(
+        [3, 3], large.unpack(base64.b64decode(stats['items_cold']))[:2])
+
+
 if __name__ == '__main__':
   fix_encoding.fix_encoding()
   if '-v' in sys.argv:
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiler to compare archiving a tree with and without small files packing.
+
+Archives then downloads a directory through a local fake isolate server, once
+as individual items and once with small files packed into ar bundles, and
+prints the number of items and the wall time of each step.
+
+By default, generates a synthetic tree with many tiny files.
+"""
+
+import optparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+
+from third_party.depot_tools import fix_encoding
+from utils import file_path
+from utils import tools
+
+import isolateserver
+import isolateserver_mock
+
+
+def make_tree(root_dir, dirs, files_per_dir, max_size):
+  random.seed(0)
+  for d in xrange(dirs):
+    dirpath = os.path.join(root_dir, 'dir%d' % d)
+    os.makedirs(dirpath)
+    for f in xrange(files_per_dir):
+      with open(os.path.join(dirpath, 'file%d.txt' % f), 'wb') as fd:
+        fd.write(os.urandom(random.randint(0, max_size)))
+
+
+def profile(root_dir, namespace, pack_threshold):
+  server = isolateserver_mock.MockIsolateServer()
+  try:
+    start = time.time()
+    with isolateserver.get_storage(server.url, namespace) as storage:
+      results, cold, hot = isolateserver.archive_files_to_storage(
+          storage, [root_dir], None, pack_threshold)
+    upload_time = time.time() - start
+
+    outdir = tempfile.mkdtemp(prefix=u'ar_packing_profiler')
+    try:
+      start = time.time()
+      with isolateserver.get_storage(server.url, namespace) as storage:
+        isolateserver.fetch_isolated(
+            results[0][0], storage, isolateserver.MemoryCache(), outdir, False)
+      download_time = time.time() - start
+    finally:
+      file_path.rmtree(outdir)
+  finally:
+    server.close()
+
+  print('pack threshold %7d: %6d items, upload %6.3fs, download %6.3fs' % (
+      pack_threshold, len(cold) + len(hot), upload_time, download_time))
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '-d', '--dir', help='Directory to profile with instead of a synthetic one')
+  parser.add_option(
+      '--dirs', type='int', default=20,
+      help='Number of directories in the synthetic tree, default: %default')
+  parser.add_option(
+      '--files', type='int', default=200,
+      help='Number of files per directory in the synthetic tree, '
+           'default: %default')
+  parser.add_option(
+      '--max-size', type='int', default=2048,
+      help='Maximum size of a file in the synthetic tree, default: %default')
+  parser.add_option(
+      '--threshold', type='int', default=16*1024,
+      help='Size threshold for packing, default: %default')
+  parser.add_option('--namespace', default='default-gzip')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  temp_dir = None
+  try:
+    root_dir = options.dir
+    if not root_dir:
+      temp_dir = tempfile.mkdtemp(prefix=u'ar_packing_profiler')
+      root_dir = os.path.join(temp_dir, u'tree')
+      make_tree(root_dir, options.dirs, options.files, options.max_size)
+    root_dir = unicode(os.path.abspath(root_dir))
+
+    for threshold in (0, options.threshold):
+      profile(root_dir, options.namespace, threshold)
+  finally:
+    if temp_dir:
+      file_path.rmtree(temp_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
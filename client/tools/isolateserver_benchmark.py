@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks the client side hot paths of isolateserver.py offline.
+
+Unlike isolateserver_load_test.py, it doesn't need a server: every operation
+goes through Storage against an in-memory StorageApi that simulates the
+network with a configurable per-request latency and bandwidth. This permits
+catching regressions in archive, fetch_isolated, upload_items and DiskCache
+before they ship to the bots.
+
+The benchmarks are run over synthetic trees of different shapes:
+  - small: many small files in a few directories.
+  - large: few huge files.
+  - deep: files spread in a deep directory hierarchy, fetched through a chain
+          of .isolated includes.
+
+Results are printed as a table and optionally saved as JSON with --json, one
+entry per (shape, benchmark) with the min and median durations in seconds.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+
+import isolated_format
+import isolateserver
+
+from utils import file_path
+from utils import logging_utils
+from utils import tools
+
+
+# Synthetic tree shapes; tuple(number of directories, files per directory,
+# file size range, directory depth).
+SHAPES = {
+  'small': (20, 250, (0, 4*1024), 1),
+  'large': (1, 4, (32*1024*1024, 64*1024*1024), 1),
+  'deep': (50, 20, (0, 64*1024), 10),
+}
+
+
+# Number of files per .isolated in the 'deep' shape chain of includes.
+FILES_PER_INCLUDE = 100
+
+
+class FakeStorageApi(isolateserver.StorageApi):
+  """In-memory StorageApi that simulates the latency and bandwidth of a
+  network.
+
+  Each RPC sleeps |latency| seconds and each transfer sleeps the time it would
+  take at |bandwidth| bytes per second. Counts the RPCs and transferred bytes.
+  """
+
+  def __init__(self, namespace, latency, bandwidth):
+    super(FakeStorageApi, self).__init__()
+    self._namespace = namespace
+    self._latency = latency
+    self._bandwidth = bandwidth
+    self._lock = threading.Lock()
+    self._contents = {}
+    self.rpcs = 0
+    self.bytes_up = 0
+    self.bytes_down = 0
+
+  @property
+  def location(self):
+    return 'fake://'
+
+  @property
+  def namespace(self):
+    return self._namespace
+
+  def reset_counters(self):
+    with self._lock:
+      self.rpcs = 0
+      self.bytes_up = 0
+      self.bytes_down = 0
+
+  def fetch(self, digest, offset=0):
+    self._rpc(0)
+    with self._lock:
+      data = self._contents[digest][offset:]
+      self.bytes_down += len(data)
+    self._transfer(len(data))
+    yield data
+
+  def push(self, item, push_state, content=None):
+    data = ''.join(item.content() if content is None else content)
+    self._rpc(len(data))
+    self._transfer(len(data))
+    with self._lock:
+      self._contents[item.digest] = data
+      self.bytes_up += len(data)
+
+  def contains(self, items):
+    self._rpc(0)
+    with self._lock:
+      return {i: None for i in items if i.digest not in self._contents}
+
+  def _rpc(self, _size):
+    with self._lock:
+      self.rpcs += 1
+    if self._latency:
+      time.sleep(self._latency)
+
+  def _transfer(self, size):
+    if self._bandwidth:
+      time.sleep(float(size) / self._bandwidth)
+
+
+def make_tree(root_dir, shape):
+  """Creates a synthetic tree of the requested shape in |root_dir|."""
+  dirs, files_per_dir, (min_size, max_size), depth = SHAPES[shape]
+  rnd = random.Random(0)
+  # Incompressible content, so compression is exercised on realistic data.
+  pool = os.urandom(max_size + 1)
+  for d in xrange(dirs):
+    parts = ['d%d' % ((d + i) % 7) for i in xrange(depth - 1)] + ['dir%d' % d]
+    dirpath = os.path.join(root_dir, *parts)
+    os.makedirs(dirpath)
+    for f in xrange(files_per_dir):
+      size = rnd.randint(min_size, max_size)
+      offset = rnd.randint(0, len(pool) - size)
+      with open(os.path.join(dirpath, 'file%d' % f), 'wb') as fd:
+        fd.write(pool[offset:offset+size])
+
+
+def upload_includes(storage, root_dir):
+  """Uploads |root_dir| as a chain of .isolated files including each other.
+
+  Returns the hash of the root .isolated.
+  """
+  algo = storage.hash_algo
+  items, metadata = isolateserver.directory_to_metadata(root_dir, algo, None)
+  relpaths = sorted(metadata)
+  chunks = [
+    relpaths[i:i+FILES_PER_INCLUDE]
+    for i in xrange(0, len(relpaths), FILES_PER_INCLUDE)
+  ]
+  child = None
+  for chunk in reversed(chunks):
+    data = {
+      'algo': isolated_format.SUPPORTED_ALGOS_REVERSE[algo],
+      'files': {k: metadata[k] for k in chunk},
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    if child:
+      data['includes'] = [child.digest]
+    child = isolateserver.BufferItem(
+        json.dumps(data, sort_keys=True, separators=(',', ':')),
+        high_priority=True)
+    child.prepare(algo)
+    items.append(child)
+  storage.upload_items(items)
+  return child.digest
+
+
+class Benchmark(object):
+  """Runs the benchmarks for one tree shape.
+
+  The benchmarks that do not depend on a tree are run when |shape| is None.
+  """
+
+  def __init__(self, options, shape, work_dir):
+    self.options = options
+    self.shape = shape
+    self.work_dir = work_dir
+    self.tree = os.path.join(work_dir, u'tree')
+    self.isolated_hash = None
+    self.api = None
+    self.results = []
+
+  def new_api(self):
+    return FakeStorageApi(
+        self.options.namespace, self.options.latency, self.options.bandwidth)
+
+  def measure(self, name, setup, func):
+    """Runs |func| --repeat times, after calling |setup| each time.
+
+    |func| receives what |setup| returns and returns a dict of stats about the
+    last run, that are added to the result.
+    """
+    durations = []
+    stats = {}
+    for _ in xrange(self.options.repeat):
+      arg = setup()
+      start = time.time()
+      stats = func(arg) or {}
+      durations.append(time.time() - start)
+    durations.sort()
+    result = {
+      'shape': self.shape,
+      'benchmark': name,
+      'min': round(durations[0], 4),
+      'median': round(durations[len(durations) / 2], 4),
+    }
+    result.update(stats)
+    self.results.append(result)
+    print('%-6s %-16s min %8.3fs  median %8.3fs  %s' % (
+        self.shape or '-', name, result['min'], result['median'],
+        ' '.join('%s=%s' % i for i in sorted(stats.iteritems()))))
+
+  def api_stats(self, api):
+    return {
+      'rpcs': api.rpcs,
+      'bytes_up': api.bytes_up,
+      'bytes_down': api.bytes_down,
+    }
+
+  def run(self):
+    if self.shape:
+      make_tree(self.tree, self.shape)
+      self.bench_archive()
+      self.bench_fetch()
+    else:
+      self.bench_upload_dedup()
+      self.bench_disk_cache()
+    return self.results
+
+  def bench_archive(self):
+    def archive(api):
+      with isolateserver.Storage(api) as storage:
+        if self.shape == 'deep':
+          self.isolated_hash = upload_includes(storage, self.tree)
+        else:
+          results, _cold, _hot = isolateserver.archive_files_to_storage(
+              storage, [self.tree], None)
+          self.isolated_hash = results[0][0]
+      self.api = api
+      return self.api_stats(api)
+    self.measure('archive_cold', self.new_api, archive)
+
+    def warm():
+      self.api.reset_counters()
+      return self.api
+    self.measure('archive_warm', warm, archive)
+
+  def bench_fetch(self):
+    cache_dir = os.path.join(self.work_dir, u'cache')
+    algo = isolated_format.get_hash_algo(self.options.namespace)
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    count = [0]
+
+    def fetch(cache):
+      count[0] += 1
+      outdir = os.path.join(self.work_dir, u'out%d' % count[0])
+      with cache:
+        with isolateserver.Storage(self.api) as storage:
+          isolateserver.fetch_isolated(
+              self.isolated_hash, storage, cache, outdir, False)
+      file_path.rmtree(outdir)
+      return self.api_stats(self.api)
+
+    def cold():
+      if os.path.isdir(cache_dir):
+        file_path.rmtree(cache_dir)
+      self.api.reset_counters()
+      return isolateserver.DiskCache(cache_dir, policies, algo)
+    self.measure('fetch_cold', cold, fetch)
+
+    def warm():
+      self.api.reset_counters()
+      return isolateserver.DiskCache(cache_dir, policies, algo)
+    self.measure('fetch_warm', warm, fetch)
+    file_path.rmtree(cache_dir)
+
+  def bench_upload_dedup(self):
+    rnd = random.Random(0)
+    unique = [os.urandom(rnd.randint(0, 1024)) for _ in xrange(1000)]
+    contents = [rnd.choice(unique) for _ in xrange(self.options.dedup_items)]
+
+    def setup():
+      api = self.new_api()
+      return api, [isolateserver.BufferItem(c) for c in contents]
+
+    def upload(args):
+      api, items = args
+      with isolateserver.Storage(api) as storage:
+        uploaded = storage.upload_items(items)
+      stats = self.api_stats(api)
+      stats['uploaded'] = len(uploaded)
+      return stats
+    self.measure('upload_dedup', setup, upload)
+
+  def bench_disk_cache(self):
+    cache_dir = os.path.join(self.work_dir, u'diskcache')
+    algo = isolated_format.get_hash_algo(self.options.namespace)
+    items = self.options.cache_items
+    with isolateserver.DiskCache(
+        cache_dir, isolateserver.CachePolicies(0, 0, 0), algo) as cache:
+      for i in xrange(items):
+        content = str(i)
+        cache.write(algo(content).hexdigest(), [content])
+
+    def load(policies):
+      cache = isolateserver.DiskCache(cache_dir, policies, algo, trim=False)
+      return {'items': len(cache.cached_set())}
+    self.measure(
+        'diskcache_load', lambda: isolateserver.CachePolicies(0, 0, 0), load)
+
+    trim_dir = os.path.join(self.work_dir, u'diskcache_trim')
+    def setup_trim():
+      # Trimming deletes files, work on a fresh copy every time.
+      if os.path.isdir(trim_dir):
+        file_path.rmtree(trim_dir)
+      shutil.copytree(cache_dir, trim_dir)
+      return isolateserver.DiskCache(
+          trim_dir, isolateserver.CachePolicies(0, 0, items / 2), algo,
+          trim=False)
+
+    def trim(cache):
+      cache.trim()
+      return {'items': len(cache.cached_set())}
+    self.measure('diskcache_trim', setup_trim, trim)
+    file_path.rmtree(trim_dir)
+    file_path.rmtree(cache_dir)
+
+
+def main():
+  tools.disable_buffering()
+  parser = logging_utils.OptionParserWithLogging(
+      usage='%prog [options]', description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--shape', action='append', choices=sorted(SHAPES),
+      help='Tree shapes to benchmark, default: all')
+  parser.add_option(
+      '--latency', type='float', default=0.01,
+      help='Simulated latency of each request in seconds, default: %default')
+  parser.add_option(
+      '--bandwidth', type='int', default=100*1024*1024,
+      help='Simulated bandwidth in bytes per second, 0 for infinite, default: '
+           '%default')
+  parser.add_option('--namespace', default='default-gzip')
+  parser.add_option(
+      '--repeat', type='int', default=3,
+      help='Number of runs of each benchmark, default: %default')
+  parser.add_option(
+      '--dedup-items', type='int', default=20000,
+      help='Number of items to upload in upload_dedup, default: %default')
+  parser.add_option(
+      '--cache-items', type='int', default=5000,
+      help='Number of items in the DiskCache benchmarks, default: %default')
+  parser.add_option('--json', help='Path to save the results as JSON')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+  if options.repeat < 1:
+    parser.error('--repeat must be at least 1')
+
+  results = []
+  for shape in [None] + (options.shape or sorted(SHAPES)):
+    work_dir = tempfile.mkdtemp(prefix=u'isolateserver_benchmark')
+    try:
+      results.extend(Benchmark(options, shape, work_dir).run())
+    finally:
+      file_path.rmtree(work_dir)
+
+  if options.json:
+    tools.write_json(
+        options.json,
+        {
+          'config': {
+            'bandwidth': options.bandwidth,
+            'latency': options.latency,
+            'namespace': options.namespace,
+            'repeat': options.repeat,
+          },
+          'results': results,
+        },
+        False)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
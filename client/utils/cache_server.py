@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Local content-addressed cache service shared by processes on one host.
+
+LocalCacheServer owns a single LocalCache instance (usually a DiskCache) and
+serves it over a Unix domain socket, so that several bots or concurrent
+run_isolated processes on the same host share one cache directory instead of
+each keeping a copy of the same gigabytes.
+
+The wire protocol is intentionally trivial. Each connection carries exactly one
+RPC: the client sends a JSON dict terminated by a new line, the server replies
+with a JSON dict terminated by a new line. The 'write' RPC additionally streams
+the content as a sequence of '<hex length>\\n<data>' chunks terminated by a
+zero length chunk once the server replied {'status': 'send'}.
+
+Concurrent writes of the same digest are coalesced: the first client to ask
+streams the content, the other ones wait for it to finish and are told the
+item is already present, so they never start their download.
+
+Clients never clean up or trim the cache themselves, since other clients may be
+writing to it. The server cleans it up when it starts, before accepting
+connections, and trims it periodically from its own thread.
+
+Not supported on Windows, since it relies on AF_UNIX sockets and flock().
+"""
+
+import collections
+import json
+import logging
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+if sys.platform != 'win32':
+  import fcntl  # pylint: disable=F0401
+
+
+# Maximum time (in seconds) a client waits for another client fetching the same
+# digest before trying to fetch it itself.
+COALESCE_TIMEOUT = 10 * 60
+
+
+# Size of the chunks to send over the socket.
+STREAM_CHUNK = 64 * 1024
+
+
+# How often (in seconds) the server enforces the cache retention policies.
+TRIM_INTERVAL = 5 * 60
+
+
+# Time (in seconds) after which a client session that didn't reference any item
+# is considered gone, e.g. because the client crashed without ending it.
+SESSION_TIMEOUT = 30 * 60
+
+
+class RPCError(Exception):
+  """Raised on protocol errors or when the server reports a failure."""
+
+
+class LocalCacheServer(object):
+  """Serves a LocalCache to other processes on the host via a Unix socket.
+
+  The cache methods are called from the server threads, so the cache must be
+  thread safe, which both MemoryCache and DiskCache are.
+
+  Each client has a session. The first item referenced in a session, and all
+  the items more recent than it, must not be evicted to make room for new items
+  until the session ends, see DiskCache.set_protected().
+  """
+
+  def __init__(self, cache, cache_miss_error):
+    """
+    Arguments:
+      cache: LocalCache to serve.
+      cache_miss_error: exception class raised by cache.getfileobj() when the
+          item is not in the cache.
+    """
+    self._cache = cache
+    self._cache_miss_error = cache_miss_error
+    self._lock = threading.Lock() # guards everything below
+    self._accept_thread = None
+    self._inflight = {} # dict digest => threading.Event
+    self._lock_file = None
+    self._server = None
+    # Session id => (first digest referenced, time of the last reference),
+    # ordered by the time of the first reference.
+    self._sessions = collections.OrderedDict()
+    self._socket_path = None
+    self._stop_event = None
+    self._trim_thread = None
+
+  def start(self, socket_path):
+    """Starts serving the cache on |socket_path|.
+
+    Takes an exclusive lock on a file next to the cache directory, so that two
+    servers never mutate the same state.json concurrently. A standalone
+    DiskCache doesn't take this lock, so it must not be used on the directory of
+    a running server.
+
+    Returns:
+      A dict describing the server, suitable to be passed to clients.
+    """
+    lock_file = None
+    if self._cache.cache_dir:
+      lock_file = open(self._cache.cache_dir.rstrip(os.path.sep) + '.lock', 'w')
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        lock_file.close()
+        raise RPCError(
+            'Cache %s is already owned by another process' %
+            self._cache.cache_dir)
+    # No client is connected yet, so there's no partially written item that
+    # would be mistaken for an unknown file.
+    if hasattr(self._cache, 'cleanup'):
+      self._cache.cleanup()
+    if os.path.exists(socket_path):
+      # A stale socket from a previous server instance.
+      os.remove(socket_path)
+    server = _UnixServer(self, socket_path)
+    os.chmod(socket_path, 0600)
+
+    with self._lock:
+      assert not self._server, 'Already running'
+      logging.info('Local cache server: %s', socket_path)
+      self._lock_file = lock_file
+      self._server = server
+      self._socket_path = socket_path
+      self._stop_event = threading.Event()
+      self._accept_thread = threading.Thread(target=self._server.serve_forever)
+      self._accept_thread.start()
+      self._trim_thread = threading.Thread(
+          target=self._trim_loop, args=(self._stop_event,))
+      self._trim_thread.daemon = True
+      self._trim_thread.start()
+      return {
+        'cache_dir': self._cache.cache_dir,
+        'socket_path': socket_path,
+      }
+
+  def stop(self):
+    """Stops the server, saves the cache state and releases the lock."""
+    with self._lock:
+      if not self._server:
+        return
+      server, self._server = self._server, None
+      thread, self._accept_thread = self._accept_thread, None
+      trim_thread, self._trim_thread = self._trim_thread, None
+      stop_event, self._stop_event = self._stop_event, None
+      lock_file, self._lock_file = self._lock_file, None
+      socket_path, self._socket_path = self._socket_path, None
+      inflight, self._inflight = self._inflight, {}
+      self._sessions.clear()
+    logging.debug('Stopping the local cache server...')
+    stop_event.set()
+    trim_thread.join()
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    for event in inflight.itervalues():
+      event.set()
+    try:
+      os.remove(socket_path)
+    except OSError:
+      pass
+    if hasattr(self._cache, 'trim'):
+      self._cache.trim()
+    if lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+      lock_file.close()
+    logging.info('The local cache server is stopped')
+
+  def handle_rpc(self, method, request, connection):
+    """Called by _RequestHandler to handle one RPC call.
+
+    Args:
+      method: name of the invoked RPC method, e.g. "touch".
+      request: JSON dict with the request.
+      connection: _RequestHandler, used by 'write' to send an intermediary
+          reply and read the content.
+
+    Returns:
+      JSON dict with the response body.
+
+    Raises:
+      RPCError to return an error to the client.
+    """
+    handler = getattr(self, 'handle_%s' % method, None)
+    if not handler or method == 'rpc':
+      raise RPCError('Unknown RPC method "%s".' % method)
+    with self._lock:
+      if not self._server:
+        raise RPCError('Stopped already.')
+    if method == 'write':
+      return handler(request, connection)
+    return handler(request)
+
+  ### RPC method handlers. Called from internal threads.
+
+  def handle_stats(self, _request):
+    return {
+      'cache_dir': self._cache.cache_dir,
+      'initial_number_items': self._cache.initial_number_items,
+      'initial_size': self._cache.initial_size,
+    }
+
+  def handle_cached_set(self, _request):
+    return {'digests': sorted(self._cache.cached_set())}
+
+  def handle_contains(self, request):
+    return {'result': _get_digest(request) in self._cache}
+
+  def handle_touch(self, request):
+    digest = _get_digest(request)
+    result = self._cache.touch(digest, request['size'])
+    if result:
+      self._reference(request.get('session'), digest)
+    return {'result': result}
+
+  def handle_evict(self, request):
+    self._cache.evict(_get_digest(request))
+    return {}
+
+  def handle_getfileobj(self, request):
+    """Returns the path to the file in the cache.
+
+    The client opens it itself, which permits hardlinking out of the cache.
+    Returns a None path on cache miss.
+    """
+    digest = _get_digest(request)
+    try:
+      f = self._cache.getfileobj(digest)
+    except self._cache_miss_error:
+      return {'path': None}
+    try:
+      path = getattr(f, 'name', None)
+    finally:
+      f.close()
+    if not path:
+      raise RPCError('Cache is not backed by files')
+    return {'path': path}
+
+  def handle_get_oldest(self, _request):
+    return {'digest': self._cache.get_oldest()}
+
+  def handle_get_timestamp(self, request):
+    return {'timestamp': self._cache.get_timestamp(_get_digest(request))}
+
+  def handle_end_session(self, request):
+    """Releases the protection of the items referenced in a session."""
+    with self._lock:
+      self._sessions.pop(request.get('session'), None)
+      self._update_protection()
+    return {}
+
+  def handle_write(self, request, connection):
+    """Stores an item, coalescing concurrent writes of the same digest.
+
+    Returns {'status': 'present'} without reading any content when the item is
+    already in the cache, possibly after waiting for another client that was
+    fetching it.
+    """
+    digest = _get_digest(request)
+    size = request.get('size')
+    self._reference(request.get('session'), digest)
+    while True:
+      with self._lock:
+        event = self._inflight.get(digest)
+        owner = event is None
+        if owner:
+          if self._is_present(digest, size):
+            return {'status': 'present'}
+          event = threading.Event()
+          self._inflight[digest] = event
+      if owner:
+        break
+      # Another client is fetching this item, wait for it.
+      event.wait(COALESCE_TIMEOUT)
+      if self._is_present(digest, size):
+        return {'status': 'present'}
+
+    try:
+      return {'status': 'stored', 'size': self._store(digest, connection)}
+    finally:
+      with self._lock:
+        self._inflight.pop(digest, None)
+      event.set()
+
+  def _reference(self, session, digest):
+    """Records that |session| referenced |digest|."""
+    if not session:
+      return
+    with self._lock:
+      first = self._sessions.get(session, (digest, None))[0]
+      self._sessions[session] = (first, time.time())
+
+  def _update_protection(self):
+    """Protects the first item referenced by the oldest live session.
+
+    Items referenced by more recent sessions are more recent in the LRU, so
+    they are protected too.
+    """
+    assert self._lock.locked()
+    if hasattr(self._cache, 'set_protected'):
+      first = next(iter(self._sessions.itervalues()), (None, None))[0]
+      self._cache.set_protected(first)
+
+  def _trim_loop(self, stop_event):
+    """Periodically trims the cache, until |stop_event| is set.
+
+    Also forgets the sessions of clients that went away without ending them.
+    """
+    while not stop_event.wait(TRIM_INTERVAL):
+      with self._lock:
+        cutoff = time.time() - SESSION_TIMEOUT
+        for session, (_, last_seen) in self._sessions.items():
+          if last_seen < cutoff:
+            logging.warning('Session %s timed out', session)
+            del self._sessions[session]
+        self._update_protection()
+      if hasattr(self._cache, 'trim'):
+        self._cache.trim()
+
+  def _is_present(self, digest, size):
+    return digest in self._cache and self._cache.touch(digest, size)
+
+  def _store(self, digest, connection):
+    """Tells the client to send the content and stores it in the cache."""
+    connection.send_reply({'status': 'send'})
+    size = [0]
+    def gen():
+      for chunk in read_chunks(connection.rfile):
+        size[0] += len(chunk)
+        yield chunk
+    self._cache.write(digest, gen())
+    return size[0]
+
+
+class CacheServerClient(object):
+  """Client side of the LocalCacheServer protocol."""
+
+  def __init__(self, socket_path):
+    self.socket_path = socket_path
+
+  def call(self, method, **kwargs):
+    """Calls a simple RPC method and returns its JSON reply."""
+    conn = self._connect()
+    try:
+      rfile = conn.makefile('rb')
+      _send_message(conn, dict(kwargs, method=method))
+      return _read_reply(rfile)
+    finally:
+      _close(conn)
+
+  def write(self, digest, size, content, session=None):
+    """Streams |content| to the server unless the item is already there.
+
+    The |content| generator is not consumed at all if another client stored the
+    item in the meantime, which skips the download entirely.
+
+    Returns:
+      True if the content was sent, False if the item was already present.
+    """
+    conn = self._connect()
+    try:
+      rfile = conn.makefile('rb')
+      _send_message(conn, {
+        'method': 'write',
+        'digest': digest,
+        'session': session,
+        'size': size,
+      })
+      reply = _read_reply(rfile)
+      if reply['status'] == 'present':
+        return False
+      if reply['status'] != 'send':
+        raise RPCError('Unexpected reply %r' % reply)
+      # If |content| raises, the connection is closed without the terminating
+      # chunk, so the server discards the partial item.
+      for data in content:
+        for i in xrange(0, len(data), STREAM_CHUNK):
+          chunk = data[i:i+STREAM_CHUNK]
+          conn.sendall('%x\n%s' % (len(chunk), chunk))
+      conn.sendall('0\n')
+      _read_reply(rfile)
+      return True
+    finally:
+      _close(conn)
+
+  def _connect(self):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      conn.connect(self.socket_path)
+    except socket.error as e:
+      conn.close()
+      raise RPCError('Failed to connect to %s: %s' % (self.socket_path, e))
+    return conn
+
+
+def read_chunks(rfile):
+  """Yields the chunks of a streamed content.
+
+  Raises IOError if the stream is truncated.
+  """
+  while True:
+    line = rfile.readline()
+    if not line.endswith('\n'):
+      raise IOError('Truncated stream')
+    try:
+      length = int(line, 16)
+    except ValueError:
+      raise IOError('Invalid chunk header %r' % line)
+    if not length:
+      return
+    data = rfile.read(length)
+    if len(data) != length:
+      raise IOError('Truncated stream')
+    yield data
+
+
+def _close(conn):
+  """Closes the connection even if file objects still reference it."""
+  try:
+    conn.shutdown(socket.SHUT_RDWR)
+  except socket.error:
+    pass
+  conn.close()
+
+
+def _get_digest(request):
+  digest = request.get('digest')
+  if not isinstance(digest, basestring) or not digest:
+    raise RPCError('Field "digest" is required.')
+  return str(digest)
+
+
+def _send_message(conn, msg):
+  conn.sendall(json.dumps(msg) + '\n')
+
+
+def _read_reply(rfile):
+  line = rfile.readline()
+  if not line:
+    raise RPCError('Connection closed by the cache server')
+  try:
+    reply = json.loads(line)
+  except ValueError as e:
+    raise RPCError('Invalid reply: %s' % e)
+  if 'error' in reply:
+    raise RPCError(reply['error'])
+  return reply
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Used internally by LocalCacheServer."""
+
+  # How often to poll 'select' in the local server.
+  #
+  # Defines minimal amount of time 'stop' would block. Overridden in tests to
+  # speed them up.
+  poll_interval = 0.5
+
+  # From SocketServer.ThreadingMixIn.
+  daemon_threads = True
+  # From SocketServer.TCPServer.
+  request_queue_size = 50
+
+  def __init__(self, local_cache_server, path):
+    SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+    self.local_cache_server = local_cache_server
+
+  def serve_forever(self, poll_interval=None):
+    """Overrides default poll interval."""
+    SocketServer.UnixStreamServer.serve_forever(
+        self, poll_interval or self.poll_interval)
+
+  def handle_error(self, request, client_address):
+    """Overrides default handle_error that dumbs stuff to stdout."""
+    logging.exception('local cache server: Exception happened')
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+  """Used internally by LocalCacheServer.
+
+  Parses the request, serializes and write the response.
+  """
+
+  def handle(self):
+    line = self.rfile.readline()
+    try:
+      req = json.loads(line)
+      if not isinstance(req, dict):
+        raise ValueError('Not a JSON dictionary')
+    except ValueError as exc:
+      self.send_reply({'error': 'Invalid request: %s' % exc})
+      return
+    try:
+      resp = self.server.local_cache_server.handle_rpc(
+          str(req.get('method')), req, self)
+    except RPCError as exc:
+      resp = {'error': str(exc)}
+    except Exception as exc:
+      logging.exception('local cache server: %s failed', req.get('method'))
+      resp = {'error': 'Internal error: %s' % exc}
+    self.send_reply(resp)
+
+  def send_reply(self, msg):
+    try:
+      _send_message(self.connection, msg)
+    except socket.error as e:
+      logging.warning('local cache server: failed to reply: %s', e)
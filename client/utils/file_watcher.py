@@ -0,0 +1,167 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Watches a directory tree for files being written to.
+
+The watchers only report *candidate* paths, i.e. files that may have been
+created or modified since the last call. The caller is responsible to stat the
+files to decide if they are worth processing.
+
+On Linux, inotify is used so that only the files that were actually closed
+after a write or moved into the tree are reported. Everywhere else, or if
+inotify can't be initialized, the whole tree is scanned on each poll.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from utils import fs
+
+
+# inotify constants, from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _walk_files(root):
+  """Yields the path of all the files in |root|, recursively."""
+  for dirpath, _dirnames, filenames in fs.walk(root):
+    for filename in filenames:
+      yield os.path.join(dirpath, filename)
+
+
+class PollingWatcher(object):
+  """Reports all the files in the tree on every poll.
+
+  It is the portable fallback, so it is as dumb as possible.
+  """
+
+  def __init__(self, root):
+    self.root = root
+
+  def poll(self, timeout):
+    """Returns the set of files that may have changed.
+
+    Sleeps |timeout| seconds first, so the tree is not scanned in a busy loop.
+    """
+    time.sleep(timeout)
+    return set(_walk_files(self.root))
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher(object):
+  """Reports the files closed for writing or moved into the tree.
+
+  New directories are watched as they are created. If the kernel event queue
+  overflows, the whole tree is reported to not miss anything.
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self._libc = _get_libc()
+    self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+    self._wds = {} # dict watch descriptor => directory
+    # Files present before the watches are set are reported on the first poll.
+    self._pending = self._add_tree(root)
+
+  def poll(self, timeout):
+    """Returns the set of files that may have changed, waiting up to |timeout|
+    seconds for one.
+    """
+    changed, self._pending = self._pending, set()
+    if changed:
+      timeout = 0
+    r, _, _ = select.select([self._fd], [], [], timeout)
+    if not r:
+      return changed
+    try:
+      data = os.read(self._fd, 64 * 1024)
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+      return changed
+    offset = 0
+    while offset < len(data):
+      wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+      offset += _EVENT_HEADER.size
+      name = data[offset:offset+length].rstrip('\0')
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        logging.warning('inotify queue overflow, rescanning %s', self.root)
+        changed.update(_walk_files(self.root))
+        continue
+      if mask & IN_IGNORED:
+        self._wds.pop(wd, None)
+        continue
+      parent = self._wds.get(wd)
+      if not parent or not name:
+        continue
+      path = os.path.join(parent, name.decode(sys.getfilesystemencoding()))
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          changed.update(self._add_tree(path))
+      elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        changed.add(path)
+    return changed
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+  def _add_tree(self, root):
+    """Watches |root| and its subdirectories.
+
+    Returns the files already present, since their creation may have happened
+    before the watch was set.
+    """
+    files = set()
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    for dirpath, _dirnames, filenames in fs.walk(root):
+      wd = self._libc.inotify_add_watch(
+          self._fd, fs.extend(dirpath).encode(sys.getfilesystemencoding()),
+          mask)
+      if wd < 0:
+        logging.warning('Failed to watch %s', dirpath)
+        continue
+      self._wds[wd] = dirpath
+      files.update(os.path.join(dirpath, f) for f in filenames)
+    return files
+
+
+def _get_libc():
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  libc.inotify_init1.argtypes = [ctypes.c_int]
+  libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_uint32]
+  return libc
+
+
+def get_watcher(root):
+  """Returns the most efficient watcher available for |root|."""
+  if sys.platform.startswith('linux'):
+    try:
+      return InotifyWatcher(root)
+    except (AttributeError, OSError) as e:
+      logging.warning('inotify is not available, polling instead: %s', e)
+  return PollingWatcher(root)